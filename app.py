@@ -1,54 +1,55 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import pandas as pd
 import altair as alt
-import json
-import os
 import random
 import datetime
-import folium
+import uuid
 from streamlit_folium import st_folium
-from utils import load_data, calculate_recommendations, create_txt, load_night_markets, TAG_MAPPING, get_coordinates
+from user_store import UserStore, WriteBehindWriter
+from itinerary import Itinerary
+from opening_hours import format_day_mask, open_at, open_on
+from route_planner import optimize_day, build_itinerary
+from search_index import SORT_OPTIONS
+from trip_map import MapCache
+from utils import load_data, load_score_matrix, calculate_recommendations, compact_recommendations, expand_recommendations, create_txt, load_night_markets, load_search_index, preference_scores, result_page, load_spatial_index, load_distance_matrix, load_schedule_checker, load_catalog_points, get_static_map_image, thumbnail, prefetch_thumbnails, TAG_MAPPING, get_coordinates
 
 # ==========================================
 # 1. 全域設定
 # ==========================================
 st.set_page_config(page_title="高雄旅遊智慧規劃助手", layout="wide", page_icon="🧳")
 
-USER_DB_FILE = "users_db.json"
+USER_DB_FILE = "users_db.json" # 舊版 JSON 資料庫 (首次啟動時匯入 SQLite)
+USER_STORE_FILE = "users.sqlite"
 HOURS_OPTIONS = [f"{i:02d}:00" for i in range(24)] # Deprecated but kept for compatibility logic
+HERO_SIZE = 900   # 首頁直式大圖的縮圖最長邊
 CATEGORY_OPTIONS = ["景點", "飲食", "交通", "住宿", "購物", "活動", "其他"]
 WEEKDAYS = ["週一", "週二", "週三", "週四", "週五", "週六", "週日"]
 GOOGLE_MAPS_API_KEY = "" 
 
 # --- 本地資料庫函式 ---
-def load_db():
-    if not os.path.exists(USER_DB_FILE): return {}
-    try:
-        with open(USER_DB_FILE, "r", encoding="utf-8") as f: return json.load(f)
-    except: return {}
-
-def save_db(db):
-    with open(USER_DB_FILE, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=4)
-
-def update_user_data(username, data_key, data_value):
-    db = load_db()
-    if username in db:
-        db[username][data_key] = data_value
-        save_db(db)
-
-def change_password(username, new_password):
-    db = load_db()
-    if username in db:
-        db[username]["password"] = new_password
-        save_db(db)
-        return True
-    return False
+@st.cache_resource
+def get_user_store():
+    store = UserStore(USER_STORE_FILE)
+    store.migrate_from_json(USER_DB_FILE)
+    return store
+
+@st.cache_resource
+def get_state_writer():
+    # 行程狀態延遲寫入：連續編輯合併成每 3 秒最多一次寫入
+    return WriteBehindWriter(get_user_store(), interval=3.0)
+
+def flush_current_state(username=None):
+    """立即寫入這個分頁待寫入的狀態；指定 username 時寫入該帳號所有分頁的狀態 (登入前使用)"""
+    if username: get_state_writer().flush(username=username)
+    else: get_state_writer().flush(session_id=st.session_state.state_session)
 
 # --- Session State 初始化 ---
 if 'logged_in' not in st.session_state: st.session_state.logged_in = False
+if 'state_session' not in st.session_state: st.session_state.state_session = uuid.uuid4().hex # 延遲寫入用的分頁識別
+if 'state_version' not in st.session_state: st.session_state.state_version = None # 此分頁持有的資料版本 (樂觀鎖)
 if 'user_name' not in st.session_state: st.session_state.user_name = ""
-if 'itinerary' not in st.session_state: st.session_state.itinerary = []
+if 'itinerary' not in st.session_state: st.session_state.itinerary = Itinerary()
 if 'preferences' not in st.session_state: st.session_state.preferences = None
 if 'recommendations' not in st.session_state: st.session_state.recommendations = None
 if 'trip_info' not in st.session_state:
@@ -57,6 +58,9 @@ if 'map_center' not in st.session_state: st.session_state.map_center = [22.6273,
 if 'map_zoom' not in st.session_state: st.session_state.map_zoom = 12
 if 'focus_spot' not in st.session_state: st.session_state.focus_spot = None
 if 'candidates' not in st.session_state: st.session_state.candidates = [] # New: Candidate List
+st.session_state.itinerary = Itinerary.coerce(st.session_state.itinerary) # 舊版 list -> 帶 id 的行程結構
+st.session_state.dirty_regions = set() # 整頁執行會重繪所有區塊，清除上次 fragment 留下的重繪要求
+budget_slot = None # 側欄預算佔位元件 (見 render_budget_metrics)
 
 # [Architecture Change] Merged History into Home, removed Page 5
 PAGES = ["🏠 首頁 (我的旅程)", "1. 建立新旅程", "2. 旅遊偏好", "3. 行程規劃", "4. 總覽與匯出"]
@@ -66,64 +70,47 @@ if st.session_state.current_page not in PAGES:
     st.session_state.current_page = PAGES[0]
 
 # --- Helper Functions ---
-def navigate_to(page_name): st.session_state.current_page = page_name
+def navigate_to(page_name):
+    st.session_state.current_page = page_name
+    flush_current_state()
 
 def save_current_state():
     if st.session_state.logged_in and st.session_state.user_name:
-        rec_data = None
-        if st.session_state.recommendations is not None and not st.session_state.recommendations.empty:
-            rec_data = st.session_state.recommendations.to_dict('records')
+        # 推薦結果只存 [景點 id, 分數]，載入時再與景點資料庫合併
+        rec_data = compact_recommendations(st.session_state.recommendations)
         user_data = {
             "trip_info": st.session_state.trip_info,
-            "itinerary": st.session_state.itinerary,
+            "itinerary": st.session_state.itinerary.to_list(),
             "preferences": st.session_state.preferences,
             "recommendations": rec_data,
             "candidates": st.session_state.candidates, # [Fix] Save candidates
             "current_page": st.session_state.current_page,
             "last_modified": str(datetime.datetime.now())
         }
-        update_user_data(st.session_state.user_name, "data", user_data)
+        # 帶著此分頁持有的版本排入；先取回此分頁自己已完成寫入後的版本
+        writer, sid = get_state_writer(), st.session_state.state_session
+        st.session_state.state_version = writer.current_version(sid, st.session_state.state_version)
+        writer.enqueue(sid, st.session_state.user_name, user_data, st.session_state.state_version)
 
 def save_to_history(history_name):
     if st.session_state.logged_in and st.session_state.user_name:
-        db = load_db()
-        user_entry = db[st.session_state.user_name]
-        if "history" not in user_entry: user_entry["history"] = {}
-        rec_data = None
-        if st.session_state.recommendations is not None and not st.session_state.recommendations.empty:
-            rec_data = st.session_state.recommendations.to_dict('records')
+        rec_data = compact_recommendations(st.session_state.recommendations)
         current_snapshot = {
             "trip_info": st.session_state.trip_info,
-            "itinerary": st.session_state.itinerary,
+            "itinerary": st.session_state.itinerary.to_list(),
             "preferences": st.session_state.preferences,
             "recommendations": rec_data,
             "saved_at": str(datetime.datetime.now())
         }
-        user_entry["history"][history_name] = current_snapshot
-        save_db(db)
+        get_user_store().save_history(st.session_state.user_name, history_name, current_snapshot)
         st.success(f"已儲存：{history_name}")
 
 def delete_history(history_name):
     if st.session_state.logged_in:
-        db = load_db()
-        user_entry = db[st.session_state.user_name]
-        if "history" in user_entry and history_name in user_entry["history"]:
-            del user_entry["history"][history_name]
-            save_db(db)
+        if get_user_store().delete_history(st.session_state.user_name, history_name):
             st.success(f"已刪除：{history_name}")
             st.rerun()
 
-def delete_item(index):
-    st.session_state.itinerary.pop(index)
-    save_current_state()
-
-def move_item(index, direction):
-    items = st.session_state.itinerary
-    new_index = index + direction
-    if 0 <= new_index < len(items):
-        items[index], items[new_index] = items[new_index], items[index]
-        save_current_state()
-
 # 輔助：確保 SubBudgets 結構存在
 def ensure_sub_budgets(item):
     if 'SubBudgets' not in item or not isinstance(item['SubBudgets'], list):
@@ -139,6 +126,47 @@ def ensure_sub_budgets(item):
             item['SubBudgets'] = []
     return item
 
+# --- 局部重繪 (st.fragment) ---
+# 規劃頁分成 來源分頁 (sources) / 地圖 (map) / 看板卡片 (card) / 側欄預算 (budget) 幾個可單獨重跑的區塊。
+# fragment 內的操作預設只重繪自己；資料變動影響到其他區塊時以 invalidate() 標記，
+# 由 sync_regions() 處理：只影響預算時直接重畫側欄佔位元件，其他區塊則整頁 rerun。
+def invalidate(*regions):
+    st.session_state.dirty_regions.update(regions)
+
+def sync_regions(current=None):
+    """處理其他區塊的重繪要求 (fragment 開頭，以及 fragment 內修改資料之後呼叫)"""
+    dirty = st.session_state.dirty_regions - {current}
+    st.session_state.dirty_regions = set()
+    if dirty - {"budget"}: st.rerun()
+    if "budget" in dirty: render_budget_metrics()
+
+def rerun_fragment():
+    """重跑目前的 fragment；整頁執行中 (例如第一次顯示) 不能只重跑 fragment，改為整頁 rerun"""
+    try: st.rerun(scope="fragment")
+    except StreamlitAPIException: st.rerun()
+
+def render_budget_metrics():
+    """側欄的預算使用率與金額，畫在 budget_slot 內 (fragment 可單獨重畫)"""
+    if budget_slot is None: return
+    cur_budget = st.session_state.trip_info['budget']
+    plan_spent = sum(item['Cost'] for item in st.session_state.itinerary)
+    total_spent = st.session_state.trip_info.get('pre_spent', 0) + plan_spent
+    remaining_budget = cur_budget - total_spent
+
+    # Progress Bar logic
+    if cur_budget > 0:
+        usage_pct = min(1.0, max(0.0, total_spent / cur_budget))
+    else:
+        usage_pct = 0.0
+
+    with budget_slot.container():
+        st.progress(usage_pct, text=f"預算使用率 {int(usage_pct*100)}%")
+
+        # Metrics Grid
+        m1, m2 = st.columns(2)
+        m1.metric("已使用", f"${total_spent:,}")
+        m2.metric("剩餘", f"${remaining_budget:,}", delta_color="normal" if remaining_budget >= 0 else "inverse")
+
 # [新增 Callback] 處理新增預算細項，避免 StreamlitAPIException
 def add_sub_budget_callback(item, key_cat, key_desc, key_val):
     # 從 session_state 讀取輸入值
@@ -146,8 +174,14 @@ def add_sub_budget_callback(item, key_cat, key_desc, key_val):
     desc = st.session_state[key_desc]
     val_str = st.session_state[key_val]
     
+    # [Mod] Validation: no negative, int check (錯誤訊息由卡片顯示，callback 內不畫元素)
     try: cost = int(val_str)
-    except: cost = 0
+    except:
+        st.session_state[f"sub_err_{item['id']}"] = "請輸入有效數字"
+        return
+    if cost < 0:
+        st.session_state[f"sub_err_{item['id']}"] = "金額不能為負"
+        return
     
     # 新增資料
     item['SubBudgets'].append({
@@ -162,6 +196,40 @@ def add_sub_budget_callback(item, key_cat, key_desc, key_val):
     st.session_state[key_val] = ""
     
     save_current_state()
+    invalidate("budget")
+
+def update_sub_budget_callback(item, idx, key_cat, key_cost):
+    sub = item['SubBudgets'][idx]
+    try: cost = int(st.session_state[key_cost])
+    except: cost = sub.get("Cost", 0)
+    sub['Category'] = st.session_state[key_cat]
+    sub['Cost'] = cost
+    item['Cost'] = sum(x['Cost'] for x in item['SubBudgets'])
+    save_current_state()
+    invalidate("budget")
+
+def delete_sub_budget_callback(item, idx, key_prefixes):
+    item['SubBudgets'].pop(idx)
+    item['Cost'] = sum(x['Cost'] for x in item['SubBudgets'])
+    # 細項的輸入框以順序為 key，刪除後清掉舊值，避免後面的細項顯示成前一筆的內容
+    for k in [k for k in st.session_state if isinstance(k, str) and k.startswith(key_prefixes)]:
+        del st.session_state[k]
+    save_current_state()
+    invalidate("budget")
+
+# 載入使用者儲存的行程狀態，並記錄其版本 (樂觀鎖)
+def load_user_state(user):
+    saved_data = user.get("data", {})
+    if saved_data:
+        st.session_state.trip_info = saved_data.get("trip_info", st.session_state.trip_info)
+        st.session_state.itinerary = Itinerary(saved_data.get("itinerary", []))
+        st.session_state.preferences = saved_data.get("preferences", None)
+        st.session_state.candidates = saved_data.get("candidates", []) # [Fix] Load candidates
+        st.session_state.current_page = saved_data.get("current_page", PAGES[0])
+        rec_data = saved_data.get("recommendations", None)
+        if rec_data: st.session_state.recommendations = expand_recommendations(rec_data, load_data())
+    st.session_state.state_version = user.get("version")
+    get_state_writer().forget(st.session_state.state_session)
 
 # [新增 Callback] 關閉新增模式
 def close_add_mode_callback(key_mode):
@@ -180,19 +248,12 @@ if not st.session_state.logged_in:
                 login_user = st.text_input("帳號")
                 login_pass = st.text_input("密碼", type="password")
                 if st.form_submit_button("登入", type="primary", use_container_width=True):
-                    db = load_db()
-                    if login_user in db and db[login_user]["password"] == login_pass:
+                    flush_current_state(login_user) # 先寫入其他分頁尚未寫入的狀態
+                    user = get_user_store().get_user(login_user)
+                    if user and user["password"] == login_pass:
                         st.session_state.logged_in = True
                         st.session_state.user_name = login_user
-                        saved_data = db[login_user].get("data", {})
-                        if saved_data:
-                            st.session_state.trip_info = saved_data.get("trip_info", st.session_state.trip_info)
-                            st.session_state.itinerary = saved_data.get("itinerary", [])
-                            st.session_state.preferences = saved_data.get("preferences", None)
-                            st.session_state.candidates = saved_data.get("candidates", []) # [Fix] Load candidates
-                            st.session_state.current_page = saved_data.get("current_page", PAGES[0])
-                            rec_data = saved_data.get("recommendations", None)
-                            if rec_data: st.session_state.recommendations = pd.DataFrame(rec_data)
+                        load_user_state(user)
                         st.success("登入成功！")
                         st.rerun()
                     else: st.error("帳號或密碼錯誤")
@@ -201,19 +262,22 @@ if not st.session_state.logged_in:
                 reg_user = st.text_input("設定帳號")
                 reg_pass = st.text_input("設定密碼", type="password")
                 if st.form_submit_button("註冊", use_container_width=True):
-                    db = load_db()
-                    if reg_user in db: st.error("此帳號已被註冊")
-                    elif reg_user and reg_pass:
-                        db[reg_user] = {"password": reg_pass, "data": {}, "history": {}}
-                        save_db(db)
+                    if not (reg_user and reg_pass): st.error("請輸入帳號與密碼")
+                    elif get_user_store().create_user(reg_user, reg_pass):
                         st.success("註冊成功！請登入。")
-                    else: st.error("請輸入帳號與密碼")
+                    else: st.error("此帳號已被註冊")
     st.stop()
 
+# [Fix] 其他副本/裝置已更新此帳號的行程時，改用資料庫中的最新版本
+if get_state_writer().pop_conflict(st.session_state.state_session) is not None:
+    latest_user = get_user_store().get_user(st.session_state.user_name)
+    if latest_user:
+        load_user_state(latest_user)
+        st.toast("⚠️ 行程已在其他裝置更新，已載入最新版本", icon="🔄")
+
 # ==========================================
 # 3. 側邊欄控制
 # ==========================================
-# ==========================================
 # 3. 側邊欄控制 (Modern UI)
 # ==========================================
 with st.sidebar:
@@ -234,6 +298,7 @@ with st.sidebar:
     
     if selected_page != st.session_state.current_page:
         st.session_state.current_page = selected_page
+        flush_current_state()
         st.rerun()
         
     st.divider()
@@ -248,24 +313,10 @@ with st.sidebar:
             days = st.session_state.trip_info['days']
             st.caption(f"📅 {s_date} ({days} 天)")
 
-            # Budget Viz
+            # Budget Viz (看板卡片修改費用時只重畫這一塊)
             cur_budget = st.session_state.trip_info['budget']
-            plan_spent = sum(item['Cost'] for item in st.session_state.itinerary)
-            total_spent = st.session_state.trip_info.get('pre_spent', 0) + plan_spent
-            remaining_budget = cur_budget - total_spent
-            
-            # Progress Bar logic
-            if cur_budget > 0:
-                usage_pct = min(1.0, max(0.0, total_spent / cur_budget))
-            else:
-                usage_pct = 0.0
-            
-            st.progress(usage_pct, text=f"預算使用率 {int(usage_pct*100)}%")
-            
-            # Metrics Grid
-            m1, m2 = st.columns(2)
-            m1.metric("已使用", f"${total_spent:,}")
-            m2.metric("剩餘", f"${remaining_budget:,}", delta_color="normal" if remaining_budget >= 0 else "inverse")
+            budget_slot = st.empty()
+            render_budget_metrics()
             
             # Budget Edit inside Expander to keep clean
             with st.expander("⚙️ 設定預算", expanded=False):
@@ -295,9 +346,11 @@ with st.sidebar:
     st.markdown("---")
     if st.button("🚪 登出", type="secondary", use_container_width=True):
         save_current_state()
+        flush_current_state()
         st.session_state.logged_in = False
         st.session_state.user_name = ""
-        st.session_state.itinerary = []
+        st.session_state.state_version = None
+        st.session_state.itinerary = Itinerary()
         st.session_state.recommendations = None
         st.session_state.current_page = PAGES[0]
         st.rerun()
@@ -306,8 +359,7 @@ with st.sidebar:
 if st.session_state.current_page == PAGES[0]:
     st.title(f"👋 嗨，{st.session_state.user_name}！")
     
-    db = load_db()
-    hist = db.get(st.session_state.user_name, {}).get("history", {})
+    hist = get_user_store().get_history(st.session_state.user_name)
     
     # === 情境 A：新使用者 (無歷史紀錄) ===
     if not hist:
@@ -340,7 +392,7 @@ if st.session_state.current_page == PAGES[0]:
                 st.write("") # Spacer
                 if st.button("🚀 開始規劃我的旅程", type="primary", use_container_width=True):
                     # 清空狀態，開始新 Session
-                    st.session_state.itinerary = []
+                    st.session_state.itinerary = Itinerary()
                     st.session_state.recommendations = None
                     st.session_state.preferences = None
                     st.session_state.trip_info = {"name": "高雄首遊", "days": 2, "start_date": datetime.date.today(), "budget": 5000, "pre_spent": 0}
@@ -357,7 +409,7 @@ if st.session_state.current_page == PAGES[0]:
                     "https://i.meee.com.tw/ObYVXZN.jpg"  # Image 3 
                 ]
                 selected_hero = random.choice(hero_images)
-                st.image(selected_hero, use_container_width=True)
+                st.image(thumbnail(selected_hero, size=HERO_SIZE), use_container_width=True)
 
     # === 情境 B：老朋友 (有歷史紀錄) ===
     else:
@@ -368,7 +420,7 @@ if st.session_state.current_page == PAGES[0]:
             c1.caption("建立一個全新的高雄旅遊計畫，AI 會協助您安排最合適的景點。")
             if c2.button("➕ 建立新旅程", type="primary", use_container_width=True):
                 # 清空狀態，開始新 Session
-                st.session_state.itinerary = []
+                st.session_state.itinerary = Itinerary()
                 st.session_state.recommendations = None
                 st.session_state.preferences = None
                 st.session_state.trip_info = {"name": "新旅程", "days": 2, "start_date": datetime.date.today(), "budget": 5000, "pre_spent": 0}
@@ -391,13 +443,10 @@ if st.session_state.current_page == PAGES[0]:
                     st.caption(f"📅 最後儲存：{saved_time} • ⏳ 天數：{days_count} 天")
                 
                 if hc2.button("✏️ 繼續編輯", key=f"load_{name}", use_container_width=True):
-                    st.session_state.itinerary = data.get('itinerary', [])
+                    st.session_state.itinerary = Itinerary(data.get('itinerary', []))
                     st.session_state.trip_info = data.get('trip_info', {})
                     st.session_state.preferences = data.get('preferences', None)
-                    if data.get('recommendations'):
-                        st.session_state.recommendations = pd.DataFrame(data['recommendations'])
-                    else:
-                        st.session_state.recommendations = None
+                    st.session_state.recommendations = expand_recommendations(data.get('recommendations'), load_data())
                     navigate_to(PAGES[3]) # 直接進入規劃頁
                     save_current_state()
                     st.rerun()
@@ -457,7 +506,7 @@ elif st.session_state.current_page == PAGES[1]:
                 'pre_spent': pre_spent
             })
             # [Fix] Reset itinerary and candidates to ensure clean state for "New Trip"
-            st.session_state.itinerary = []
+            st.session_state.itinerary = Itinerary()
             st.session_state.candidates = []
             st.session_state.recommendations = None
             save_current_state()
@@ -571,7 +620,8 @@ elif st.session_state.current_page == PAGES[2]:
             st.session_state.preferences = prefs
             
             st.session_state.recommendations = calculate_recommendations(
-                df, prefs, st.session_state.q_tags, days=st.session_state.trip_info.get('days', 1)
+                df, prefs, st.session_state.q_tags, days=st.session_state.trip_info.get('days', 1),
+                matrix=load_score_matrix()
             )
             save_current_state()
             navigate_to(PAGES[3])
@@ -592,36 +642,100 @@ elif st.session_state.current_page == PAGES[3]:
     
     # --- Helper: 安全新增行程 ---
     def safe_add_item(new_item):
-        is_dup = any(
-            x['Name'] == new_item['Name'] and 
-            x['Day'] == new_item['Day'] and 
-            x['Start'] == new_item['Start'] 
-            for x in st.session_state.itinerary
-        )
-        if is_dup:
+        itinerary = st.session_state.itinerary
+        if itinerary.has_duplicate(new_item['Name'], new_item['Day'], new_item['Start']):
             st.toast(f"⚠️ 行程 '{new_item['Name']}' 已存在", icon="⚠️")
         else:
-            st.session_state.itinerary.append(new_item)
+            item_id = itinerary.add(new_item)
             save_current_state()
+            invalidate("kanban", "map", "budget")
             st.toast(f"✅ 已新增：{new_item['Name']}", icon="🎉")
+            # 只檢查新增的那一天，提示時段衝突 / 交通時間不足 / 夜市公休
+            day_items = itinerary.day_items(new_item['Day'])
+            day_date = datetime.datetime.strptime(st.session_state.trip_info['start_date'], "%Y-%m-%d").date() + datetime.timedelta(days=new_item['Day'] - 1)
+            issues = load_schedule_checker().check_day(day_items, day_date)
+            for _, msg in issues[itinerary.day_ids(new_item['Day']).index(item_id)]:
+                st.toast(f"⚠️ {new_item['Name']}：{msg}", icon="⚠️")
 
     # --- Callbacks ---
-    def move_item_callback(item_idx, new_day):
-        if 0 <= item_idx < len(st.session_state.itinerary):
-            st.session_state.itinerary[item_idx]['Day'] = new_day
+    def update_item_callback(item_id, key_start, key_end, key_note, key_day):
+        # 從 session_state 讀取 ⚙️ 內的輸入值；Day/Start 改變時 Itinerary 會重新分桶排序
+        if item_id in st.session_state.itinerary:
+            st.session_state.itinerary.update(
+                item_id, Start=str(st.session_state[key_start])[:5], End=str(st.session_state[key_end])[:5],
+                Note=st.session_state[key_note], Day=int(st.session_state[key_day].split(" ")[1]))
             save_current_state()
+            invalidate("kanban", "map", "budget")
 
-    def delete_item_callback(item_idx):
-        if 0 <= item_idx < len(st.session_state.itinerary):
-            st.session_state.itinerary.pop(item_idx)
+    def delete_item_callback(item_id):
+        if st.session_state.itinerary.remove(item_id) is not None:
             save_current_state()
+            invalidate("kanban", "map", "budget")
+
+    # --- 精簡列表：每列只有一個 ➕，天數 / 時間等設定只在共用的加入對話框中建立 ---
+    def make_spot(name, row, note, cand_note, cost=0, start=datetime.time(10, 0), minutes=60):
+        return {"Name": name, "Note": note, "CandidateNote": cand_note, "Cost": cost, "Start": start, "Minutes": minutes,
+                "latitude": row.get('latitude'), "longitude": row.get('longitude'), "image_url": row.get('image_url') or ""}
+
+    def open_add_dialog(spot):
+        st.session_state.add_target = spot
+        for k in ("dlg_day", "dlg_time"): st.session_state.pop(k, None)
+
+    def close_add_dialog():
+        st.session_state.pop('add_target', None)
+
+    @st.dialog("➕ 加入行程", on_dismiss=close_add_dialog)
+    def add_item_dialog(spot):
+        day_options = [f"Day {i}" for i in range(1, st.session_state.trip_info['days'] + 1)]
+        st.markdown(f"#### {spot['Name']}")
+        if spot['image_url']: st.image(thumbnail(spot['image_url']), use_container_width=True)
+        c1, c2 = st.columns(2)
+        sel_day_str = c1.selectbox("加入天數", day_options, key="dlg_day")
+        sel_time = c2.time_input("開始時間", value=spot['Start'], key="dlg_time", step=60)
+
+        b1, b2, b3 = st.columns(3)
+        if b1.button("❤️ 候選", key="dlg_fav", use_container_width=True):
+            if spot['Name'] not in [x['Name'] for x in st.session_state.candidates]:
+                st.session_state.candidates.append({
+                    "Name": spot['Name'], "Note": spot['CandidateNote'], "Cost": spot['Cost'],
+                    "latitude": spot['latitude'], "longitude": spot['longitude'], "image_url": spot['image_url']
+                })
+                save_current_state()
+                st.toast(f"已加入候選：{spot['Name']}")
+            close_add_dialog(); st.rerun()
+        if b2.button("📍 地圖", key="dlg_loc", use_container_width=True):
+            st.session_state.map_center = [spot['latitude'] or 22.62, spot['longitude'] or 120.30]
+            st.session_state.focus_spot = {"name": spot['Name'], "lat": spot['latitude'], "lon": spot['longitude']}
+            close_add_dialog(); st.rerun()
+        if b3.button("➕ 加入", key="dlg_add", type="primary", use_container_width=True):
+            safe_add_item({
+                "Name": spot['Name'], "Day": int(sel_day_str.split(" ")[1]), "Start": str(sel_time)[:5],
+                "End": str((datetime.datetime.combine(datetime.date.today(), sel_time) + datetime.timedelta(minutes=spot['Minutes'])).time())[:5],
+                "Cost": spot['Cost'], "Note": spot['Note'],
+                "latitude": spot['latitude'] or 0.0, "longitude": spot['longitude'] or 0.0
+            })
+            close_add_dialog(); st.rerun()
+
+    def set_filter_page(page):
+        st.session_state.sf_page = page
+
+    def compact_row(key, title, caption, spot, delete_key=None):
+        """精簡列表的一列 (唯讀文字 + ➕)；有 delete_key 時多一個 🗑️，回傳是否按下刪除"""
+        cols = st.columns([5, 1, 1] if delete_key else [5, 1], vertical_alignment="center")
+        cols[0].markdown(f"**{title}**  \n:gray[{caption}]")
+        cols[1].button("➕", key=key, help="加入行程", on_click=open_add_dialog, args=(spot,))
+        return bool(delete_key) and cols[2].button("🗑️", key=delete_key, help="移除")
 
     # === Split Layout ===
     col_source, col_planner = st.columns([0.4, 0.6], gap="medium")
     
     # === 左側：來源區 ===
-    with col_source:
+    @st.fragment
+    def render_sources():
+        """景點來源分頁；❤️ / 切換分頁等操作只重跑這個區塊"""
+        sync_regions("sources")
         st.subheader("🎯 景點來源")
+        compact = st.toggle("📃 精簡列表", value=True, key="compact_sources", help="列表只顯示名稱，按 ➕ 後才開啟天數與時間設定")
         # [Mod] Rename & Add Candidate Tab
         tab_ai, tab_filter, tab_night, tab_custom, tab_fav = st.tabs(["🤖 AI推薦", "🔍 自行選擇", "🌙 夜市專區", "✏️ 手動加入", "❤️ 候選清單"])
         
@@ -637,20 +751,45 @@ elif st.session_state.current_page == PAGES[3]:
         # [Tab 1] AI 推薦 (Compact)
         with tab_ai:
             if st.session_state.recommendations is not None:
+                # 自動排程：依推薦分數與距離排出每天的景點 + 晚上的夜市
+                with st.popover("🪄 自動排程", use_container_width=True):
+                    keep_existing = st.checkbox("保留現有行程 (只排入空白的天數)", value=True, key="auto_keep")
+                    if st.button("產生行程", key="auto_build", type="primary", use_container_width=True):
+                        info = st.session_state.trip_info
+                        kept = list(st.session_state.itinerary) if keep_existing else []
+                        spent = info.get('pre_spent', 0) + sum(item.get('Cost', 0) for item in kept)
+                        new_items = build_itinerary(
+                            st.session_state.recommendations, load_night_markets(),
+                            days=info['days'], start_date=info['start_date'], budget=info['budget'] - spent,
+                            skip_days={item['Day'] for item in kept}, exclude_names={item['Name'] for item in kept})
+                        if new_items:
+                            st.session_state.itinerary = Itinerary(kept + new_items)
+                            save_current_state()
+                            st.toast(f"✅ 已排入 {len(new_items)} 個行程", icon="🪄")
+                            st.rerun()
+                        else:
+                            st.toast("⚠️ 沒有可排入的天數或景點", icon="⚠️")
+
                 df_rec = st.session_state.recommendations.copy()
                 # Safeguard for stale session state
                 if 'district' not in df_rec.columns:
                     df_rec['district'] = "未分類"
                     
+                # 卡片模式：先平行下載所有卡片的縮圖 (收合的區塊也會繪製)
+                if not compact: prefetch_thumbnails(df_rec['image_url'])
                 districts = df_rec['district'].unique()
                 for dist in districts:
                     dist_items = df_rec[df_rec['district'] == dist]
                     with st.expander(f"📍 {dist} ({len(dist_items)})", expanded=False):
                         for _, row in dist_items.iterrows():
+                            if compact:
+                                compact_row(f"pick_ai_{row['id']}", row['name'], f"❤️ {int(row['similarity']*100)}% | {', '.join(row.get('mapped_tags',[])[:2])}",
+                                            make_spot(row['name'], row, f"AI推薦 - {dist}", "AI推薦"))
+                                continue
                             with st.container(border=True):
                                 c_img, c_info = st.columns([1, 2])
                                 with c_img:
-                                    if row['image_url']: st.image(row['image_url'], use_container_width=True)
+                                    if row['image_url']: st.image(thumbnail(row['image_url']), use_container_width=True)
                                     else: st.markdown("📷 無圖")
                                 with c_info:
                                     # [Refine] Header Layout: Name (Left) | Heart (Right)
@@ -680,7 +819,7 @@ elif st.session_state.current_page == PAGES[3]:
                                     if ac3.button("📍", key=f"loc_ai_{row['id']}", help="在地圖上顯示"):
                                         st.session_state.map_center = [row.get('latitude', 22.62), row.get('longitude', 120.30)]
                                         st.session_state.focus_spot = {"name": row['name'], "lat": row.get('latitude'), "lon": row.get('longitude')}
-                                        # st.rerun() # Rerun might happen auto or we can force it
+                                        invalidate("map"); sync_regions("sources")
                                         
                                     # Add
                                     if ac4.button("➕", key=f"ai_btn_{row['id']}", use_container_width=True):
@@ -692,36 +831,58 @@ elif st.session_state.current_page == PAGES[3]:
                                             "Cost": 0, "Note": f"AI推薦 - {dist}",
                                             "latitude": row.get('latitude', 0.0), "longitude": row.get('longitude', 0.0)
                                         })
-                                        st.rerun()
+                                        sync_regions("sources")
 
         # [Tab 2] 自選 (Compact)
         with tab_filter:
             full_df = load_data()
-            all_districts = sorted(full_df['district'].unique().tolist())
+            search_index = load_search_index()
+            all_districts = list(search_index.district_bits)
             all_categories = list(TAG_MAPPING.keys())
             
+            # 先以目前的條件查詢 (bitset 交集)，各選項旁顯示的筆數也來自同一次查詢
+            sel_districts = st.session_state.get('sf_districts', [])
+            sel_categories = st.session_state.get('sf_categories', [])
+            keyword = st.session_state.get('sf_keyword', "")
+            result = search_index.query(sel_districts, sel_categories, keyword)
             with st.expander("篩選條件", expanded=True):
-                sel_districts = st.multiselect("📍 行政區", all_districts)
-                sel_categories = st.multiselect("🏷️ 類型", all_categories)
-                keyword = st.text_input("🔍 搜尋", placeholder="關鍵字...")
+                st.multiselect("📍 行政區", all_districts, key="sf_districts",
+                               format_func=lambda d: f"{d} ({result.district_counts.get(d, 0)})")
+                st.multiselect("🏷️ 類型", all_categories, key="sf_categories",
+                               format_func=lambda c: f"{c} ({result.category_counts.get(c, 0)})")
+                st.text_input("🔍 搜尋", placeholder="名稱或標籤關鍵字...", key="sf_keyword")
             
-            filtered_df = full_df.copy()
-            if sel_districts: filtered_df = filtered_df[filtered_df['district'].isin(sel_districts)]
-            if sel_categories: filtered_df = filtered_df[filtered_df['mapped_tags'].apply(lambda tags: any(cat in tags for cat in sel_categories))]
-            if keyword: filtered_df = filtered_df[filtered_df['name'].str.contains(keyword, na=False)]
-            
-            if filtered_df.empty: st.info("無結果")
+            s1, s2 = st.columns([2, 1])
+            sort_by = s1.selectbox("↕️ 排序", SORT_OPTIONS, key="sf_sort")
+            page_size = s2.selectbox("每頁筆數", [10, 20, 50], key="sf_page_size")
+            # 頁碼游標存在 session_state；條件或排序改變時回到第一頁
+            query = (tuple(sel_districts), tuple(sel_categories), keyword, sort_by, page_size)
+            if st.session_state.get('sf_query') != query:
+                st.session_state.sf_query = query
+                st.session_state.sf_page = 0
+
+            if not result.count: st.info("無結果")
             else:
-                st.caption(f"找到 {len(filtered_df)} 筆")
-                if len(filtered_df) > 15:
-                    st.warning("僅顯示前 15 筆")
-                    filtered_df = filtered_df.head(15)
+                positions = search_index.positions(result.bits)
+                scores = None
+                if sort_by == "符合偏好" and st.session_state.preferences:
+                    scores = preference_scores(st.session_state.preferences, positions)
+                positions = search_index.sort(positions, sort_by, center=st.session_state.map_center, scores=scores)
+                # 只取出並建立目前這一頁的列
+                page_df, page, n_pages = result_page(full_df, positions, st.session_state.sf_page, page_size)
+                st.session_state.sf_page = page
+                st.caption(f"找到 {result.count} 筆 · 第 {page + 1} / {n_pages} 頁")
+                if not compact: prefetch_thumbnails(page_df['image_url'])
                 
-                for _, row in filtered_df.iterrows():
+                for _, row in page_df.iterrows():
+                    if compact:
+                        compact_row(f"pick_sf_{row['id']}", row['name'], row['district'],
+                                    make_spot(row['name'], row, f"自選 - {row['district']}", "自選", start=datetime.time(14, 0)))
+                        continue
                     with st.container(border=True):
                         c_img, c_info = st.columns([1, 2])
                         with c_img:
-                            if row['image_url']: st.image(row['image_url'], use_container_width=True)
+                            if row['image_url']: st.image(thumbnail(row['image_url']), use_container_width=True)
                         with c_info:
                             # Header
                             h1, h2 = st.columns([4, 1])
@@ -747,6 +908,7 @@ elif st.session_state.current_page == PAGES[3]:
                             if ac3.button("📍", key=f"loc_sf_{row['id']}", help="在地圖上顯示"):
                                 st.session_state.map_center = [row.get('latitude', 22.62), row.get('longitude', 120.30)]
                                 st.session_state.focus_spot = {"name": row['name'], "lat": row.get('latitude'), "lon": row.get('longitude')}
+                                invalidate("map"); sync_regions("sources")
                                 
                             add_day = int(sel_day_str.split(" ")[1])
 
@@ -757,7 +919,13 @@ elif st.session_state.current_page == PAGES[3]:
                                     "Cost": 0, "Note": f"自選 - {row['district']}",
                                     "latitude": row.get('latitude', 0.0), "longitude": row.get('longitude', 0.0)
                                 })
-                                st.rerun()
+                                sync_regions("sources")
+
+                if n_pages > 1:
+                    p1, p2, p3 = st.columns([1, 2, 1], vertical_alignment="center")
+                    p1.button("⬅️", key="sf_prev", disabled=page == 0, on_click=set_filter_page, args=(page - 1,), use_container_width=True)
+                    p2.markdown(f"<div style='text-align:center'>{page + 1} / {n_pages}</div>", unsafe_allow_html=True)
+                    p3.button("➡️", key="sf_next", disabled=page >= n_pages - 1, on_click=set_filter_page, args=(page + 1,), use_container_width=True)
 
         # [Tab 3] 夜市
         with tab_night:
@@ -770,35 +938,39 @@ elif st.session_state.current_page == PAGES[3]:
             today_weekday = datetime.datetime.today().weekday()
             default_ix = today_weekday + 1 # +1 because 0 is "全部"
             
-            sel_nm_filter = st.selectbox("📅 營業日篩選", nm_days_list, index=default_ix)
-            
-            if sel_nm_filter != "全部":
-                idx = nm_days_list.index(sel_nm_filter)
-                target_d = str(idx % 7) 
-                df_night = df_night[df_night['days'].astype(str).apply(lambda x: target_d in x)]
-            
-            # Format days logic
-            def format_days(d_str):
-                mapping = {"0":"日", "1":"一", "2":"二", "3":"三", "4":"四", "5":"五", "6":"六"}
-                res = ""
-                for char in str(d_str):
-                    if char in mapping: res += mapping[char] + " "
-                    elif char in ", ": pass
-                    else: res += char
-                return res
+            nf1, nf2 = st.columns(2)
+            sel_nm_filter = nf1.selectbox("📅 營業日篩選", nm_days_list, index=default_ix)
+            sel_nm_time = nf2.selectbox("🕖 營業中時段", ["不限"] + [f"{h:02d}:00" for h in range(16, 24)], key="nm_time")
+
+            # 營業日 / 時段以載入時建立的 day_mask / open_min / close_min 向量化篩選 (weekday 0=週一)
+            if not df_night.empty and sel_nm_filter != "全部":
+                weekday = nm_days_list.index(sel_nm_filter) - 1
+                if sel_nm_time == "不限":
+                    df_night = df_night[open_on(df_night['day_mask'], weekday)]
+                else:
+                    h, m = map(int, sel_nm_time.split(":"))
+                    df_night = df_night[open_at(df_night['day_mask'], df_night['open_min'], df_night['close_min'], weekday, h * 60 + m)]
+
+            def nm_caption(row):
+                return f"營業：{format_day_mask(row['day_mask'])}　{row.get('time', '')}"
             
             if df_night.empty: st.info("無營業夜市")
+            elif not compact: prefetch_thumbnails(df_night['image_url'])
             
             for _, row in df_night.iterrows():
+                if compact:
+                    compact_row(f"pick_nm_{row['name']}", row['name'], nm_caption(row),
+                                make_spot(row['name'], row, "夜市", "夜市", cost=300, start=datetime.time(18, 0), minutes=90))
+                    continue
                 with st.container(border=True):
                     c1, c2 = st.columns([1, 2])
                     with c1:
-                        if row['image_url']: st.image(row['image_url'], use_container_width=True)
+                        if row['image_url']: st.image(thumbnail(row['image_url']), use_container_width=True)
                     with c2:
                         h1, h2 = st.columns([4, 1])
                         with h1:
                             st.markdown(f"**{row['name']}**")
-                            st.caption(f"營業：{format_days(row['days'])}") # Display formatted string
+                            st.caption(nm_caption(row))
                         with h2:
                             if st.button("❤️", key=f"fav_nm_{row['name']}", help="加入候選"):
                                  if row['name'] not in [x['Name'] for x in st.session_state.candidates]:
@@ -817,38 +989,19 @@ elif st.session_state.current_page == PAGES[3]:
                         if ac3.button("📍", key=f"loc_nm_{row['name']}", help="在地圖上顯示"):
                             st.session_state.map_center = [row.get('latitude', 22.62), row.get('longitude', 120.30)]
                             st.session_state.focus_spot = {"name": row['name'], "lat": row.get('latitude'), "lon": row.get('longitude')}
+                            invalidate("map"); sync_regions("sources")
 
                         add_day = int(nm_day_str.split(" ")[1])
 
                         if ac4.button("➕", key=f"add_nm_{row['name']}", use_container_width=True):
-                            # [Refine 5] Check if operating day matches selected day
-                            # Day 1 is start_date.
-                            # We need weekday of (start_date + add_day - 1)
-                            start_dt = datetime.datetime.strptime(st.session_state.trip_info['start_date'], "%Y-%m-%d").date()
-                            target_date = start_dt + datetime.timedelta(days=add_day - 1)
-                            target_weekday = target_date.weekday() # 0=Mon, 6=Sun
-                            
-                            # Row['days'] usually "0,1,2" (if 0=Mon) or based on previous logic.
-                            # We used nm_days_map earlier: {"ㄧ": "0", ... "日": "6"} assuming 0=Mon ?
-                            # Actually our nm_days_map assumed mapping to whatever the CSV uses.
-                            # Let's assume CSV uses 0=Mon, 6=Sun or whatever matches datetime.weekday().
-                            # If row['days'] contains str(target_weekday), it is open.
-                            
-                            # However, 'days' column might be "1,3,5" or "0123456". 
-                            # Let's just check if str(target_weekday) is in row['days'].
-                            # But wait, earlier we mapped using nm_days_map.
-                            # Let's trust the check: if str(target_weekday) not in row['days']: warning.
-                            if str(target_weekday) not in str(row['days']):
-                                w_map = {0:"一", 1:"二", 2:"三", 3:"四", 4:"五", 5:"六", 6:"日"}
-                                st.toast(f"⚠️ 注意：{row['name']} 星期{w_map.get(target_weekday)} 可能沒開！", icon="⚠️")
-                                
+                            # 公休 / 營業時間外由 safe_add_item 的行程檢查提示
                             safe_add_item({
                                 "Name": row['name'], "Day": add_day, "Start": str(n_time)[:5],
                                 "End": str((datetime.datetime.combine(datetime.date.today(), n_time) + datetime.timedelta(minutes=90)).time())[:5],
                                 "Cost": 300, "Note": "夜市",
                                 "latitude": row.get('latitude', 0.0), "longitude": row.get('longitude', 0.0)
                             })
-                            st.rerun()
+                            sync_regions("sources")
                             
         # [Tab 4] 手動 (Restore)
         with tab_custom:
@@ -876,8 +1029,12 @@ elif st.session_state.current_page == PAGES[3]:
                     note = "自訂"
                     if c_addr:
                         st.toast(f"🔍 搜尋：{c_addr}")
-                        coords = get_coordinates(c_addr)
-                        if coords:
+                        coords, approximate = get_coordinates(c_addr)
+                        if coords and approximate:
+                            lat, lon = coords
+                            note += f" | {c_addr} (概略位置)"
+                            st.toast("📍 無法連線定位服務，暫用行政區/路名的概略位置")
+                        elif coords:
                             lat, lon = coords
                             note += f" | {c_addr}"
                             st.toast("📍 定位成功")
@@ -892,19 +1049,28 @@ elif st.session_state.current_page == PAGES[3]:
                         "End": str((datetime.datetime.combine(datetime.date.today(), c_time) + datetime.timedelta(minutes=60)).time())[:5],
                         "Cost": 0, "Note": note, "latitude": lat, "longitude": lon
                     })
-                    st.rerun()
+                    sync_regions("sources")
 
         # [Tab 5] 候選清單
         with tab_fav:
             if not st.session_state.candidates:
                 st.info("尚未加入任何候選景點。請在其他頁籤點擊 ❤️ 加入。")
             else:
+                if not compact: prefetch_thumbnails([c.get('image_url') for c in st.session_state.candidates])
                 for i, cand in enumerate(st.session_state.candidates):
+                    if compact:
+                        if compact_row(f"pick_fav_{i}", cand['Name'], f"📝 {cand.get('Note', '')}",
+                                       make_spot(cand['Name'], cand, f"候選 - {cand.get('Note', '')}", cand.get('Note', ''), cost=cand.get('Cost', 0)),
+                                       delete_key=f"del_fav_{i}"):
+                            st.session_state.candidates.pop(i)
+                            save_current_state()
+                            rerun_fragment()
+                        continue
                     with st.container(border=True):
                         c1, c2 = st.columns([1, 2])
                         with c1:
                             if cand.get('image_url'):
-                                st.image(cand['image_url'], use_container_width=True)
+                                st.image(thumbnail(cand['image_url']), use_container_width=True)
                             else:
                                 st.markdown("📷 無圖")
                         
@@ -917,7 +1083,7 @@ elif st.session_state.current_page == PAGES[3]:
                                 if st.button("🗑️", key=f"del_fav_{i}", help="移除"):
                                     st.session_state.candidates.pop(i)
                                     save_current_state()
-                                    st.rerun()
+                                    rerun_fragment()
 
                             # Controls
                             ac1, ac2, ac3, ac4 = st.columns([1.5, 1.2, 0.6, 0.8], vertical_alignment="bottom")
@@ -927,6 +1093,7 @@ elif st.session_state.current_page == PAGES[3]:
                             if ac3.button("📍", key=f"loc_fav_{i}", help="地圖"):
                                 st.session_state.map_center = [cand.get('latitude', 22.62), cand.get('longitude', 120.30)]
                                 st.session_state.focus_spot = {"name": cand['Name'], "lat": cand.get('latitude'), "lon": cand.get('longitude')}
+                                invalidate("map"); sync_regions("sources")
 
                             if ac4.button("➕", key=f"add_fav_{i}", type="secondary", use_container_width=True):
                                 add_day = int(sel_day_str.split(" ")[1])
@@ -939,33 +1106,131 @@ elif st.session_state.current_page == PAGES[3]:
                                     "latitude": cand.get('latitude'), "longitude": cand.get('longitude')
                                 })
                                 st.toast(f"已從候選加入：{cand['Name']}")
-                                st.rerun()
+                                sync_regions("sources")
+
+        # 共用的加入對話框 (只有被選中的那一列才建立天數 / 時間輸入)
+        if st.session_state.get('add_target'): add_item_dialog(st.session_state.add_target)
+
+    with col_source:
+        render_sources()
+
+    @st.fragment
+    def render_map():
+        """行程地圖；地圖本身的互動 (縮放、點選) 只重跑這個區塊"""
+        sync_regions("map")
+        with st.expander("🗺️ 行程地圖", expanded=False):
+            show_catalog = st.toggle("顯示所有景點", key="map_catalog")
+            if not st.session_state.itinerary and not show_catalog: st.info("尚無行程")
+            else:
+                # 內容 (行程 / 焦點 / 圖層) 沒變時重用已 render 的地圖；不回傳互動資料，拖曳縮放不會觸發 rerun
+                if 'map_cache' not in st.session_state: st.session_state.map_cache = MapCache()
+                m = st.session_state.map_cache.get(st.session_state.map_center, st.session_state.itinerary,
+                                                   st.session_state.focus_spot, load_catalog_points() if show_catalog else None)
+                st_folium(m, height=300, use_container_width=True, key="trip_map", returned_objects=[], render=False)
+
+    @st.fragment
+    def render_card(item_id, day_i, issues):
+        """看板上的一張行程卡片；💰 / 🧭 / ⚙️ 的操作只重繪這張卡片 (必要時再通知其他區塊)"""
+        sync_regions("card")
+        item = st.session_state.itinerary.get(item_id)
+        if item is None: return
+        total_days = st.session_state.trip_info['days']
+        spatial_index = load_spatial_index()
+        with st.container(border=True):
+            st.markdown(f"**{item['Name']}**")
+            st.caption(f"{item.get('Start')}-{item.get('End')}")
+            for _, msg in issues: st.caption(f":orange[⚠️ {msg}]")
+            if item.get('Cost'): st.markdown(f":green[${item['Cost']}]")
+
+            # [Refine 1] Wallet button for detailed budget
+            # [Refine 2] Settings button
+            # [New] Nearby suggestions button
+            # Use 7 columns for precise control: [Spacer, Btn1, Gap, Btn2, Gap, Btn3, Spacer]
+            btns = st.columns([0.5, 2, 0.3, 2, 0.3, 2, 0.5]) 
+            with btns[1]:
+                 with st.popover("💰", use_container_width=True):
+                     # Budget Wallet UI
+                     ensure_sub_budgets(item)
+                     st.markdown(f"#### {item['Name']} - 費用管理")
+
+                     # 1. Add New Item
+                     with st.form(f"add_sub_{item_id}"):
+                         c_sub1, c_sub2 = st.columns([1, 1.5])
+                         c_sub1.selectbox("類別", CATEGORY_OPTIONS, key=f"scat_{item_id}_{day_i}") 
+                         c_sub2.text_input("金額 (TWD)", placeholder="0", key=f"sval_{item_id}_{day_i}")
+                         st.text_input("備註", placeholder="例：門票", key=f"snote_{item_id}")
+
+                         # callback 內更新資料，fragment 重跑時卡片與側欄預算即為最新
+                         st.form_submit_button("➕ 新增費用", on_click=add_sub_budget_callback,
+                                               args=(item, f"scat_{item_id}_{day_i}", f"snote_{item_id}", f"sval_{item_id}_{day_i}"))
+                         sub_err = st.session_state.pop(f"sub_err_{item_id}", None)
+                         if sub_err: st.error(sub_err)
+
+                     # 2. List Items (Editable)
+                     st.divider()
+                     if item['SubBudgets']:
+                         for idx, sub in enumerate(item['SubBudgets']):
+                             # Edit Mode
+                             # Layout: [Cat Select] [Cost Input] [Del Button]
+                             # But limited space. Let's show text and enable edit if needed?
+                             # User requested "Enable modification".
+
+                             ec1, ec2, ec3 = st.columns([1.2, 1, 0.5])
+
+                             # If we make everything editable directly in list:
+                             # Streamlit inputs trigger on_change on blur/enter.
+                             sub_keys = (f"ecat_{item_id}_{idx}", f"ecost_{item_id}_{idx}")
+                             ec1.selectbox("類別", CATEGORY_OPTIONS, index=CATEGORY_OPTIONS.index(sub.get("Category", "其他")), key=sub_keys[0], label_visibility="collapsed",
+                                           on_change=update_sub_budget_callback, args=(item, idx) + sub_keys)
+                             ec2.text_input("金額", value=str(sub.get("Cost", 0)), key=sub_keys[1], label_visibility="collapsed",
+                                            on_change=update_sub_budget_callback, args=(item, idx) + sub_keys)
+
+                             ec3.button("❌", key=f"del_sub_{item_id}_{idx}", on_click=delete_sub_budget_callback,
+                                        args=(item, idx, (f"ecat_{item_id}_", f"ecost_{item_id}_")))
+                     else:
+                         st.caption("尚無細項")
+
+            with btns[3]:
+                with st.popover("🧭", use_container_width=True, help="附近景點"):
+                    st.markdown(f"#### {item['Name']} 附近")
+                    nearby = spatial_index.nearest(item.get('latitude'), item.get('longitude'), k=5, exclude_names=[item['Name']])
+                    if not nearby: st.caption("此行程沒有座標")
+                    for n_i, spot in enumerate(nearby):
+                        nc1, nc2 = st.columns([4, 1], vertical_alignment="center")
+                        icon = "🌙" if spot['kind'] == 'night_market' else "📍"
+                        nc1.markdown(f"{icon} **{spot['name']}**  \n:gray[{spot['distance_km']:.1f} km · {spot.get('district') or ''}]")
+                        if nc2.button("❤️", key=f"near_fav_{item_id}_{n_i}", help="加入候選"):
+                            if spot['name'] not in [x['Name'] for x in st.session_state.candidates]:
+                                st.session_state.candidates.append({
+                                    "Name": spot['name'], "Note": f"附近 - {item['Name']}",
+                                    "Cost": 300 if spot['kind'] == 'night_market' else 0,
+                                    "latitude": spot['latitude'], "longitude": spot['longitude'],
+                                    "image_url": spot.get('image_url') or ""
+                                })
+                                save_current_state()
+                                st.toast(f"已加入候選：{spot['name']}")
+                                invalidate("sources"); sync_regions("card")
+
+            with btns[5]:
+                with st.popover("⚙️", use_container_width=True):
+                    st.time_input("開始", value=datetime.datetime.strptime(item.get('Start', '10:00'), "%H:%M").time(), key=f"ks_{item_id}", step=60)
+                    st.time_input("結束", value=datetime.datetime.strptime(item.get('End', '11:00'), "%H:%M").time(), key=f"ke_{item_id}", step=60)
+                    st.text_input("備註", value=item.get('Note', ''), key=f"kn_{item_id}")
+
+                    # [Refine 3] Clarity on Move
+                    st.selectbox("移動至...", [f"Day {d}" for d in range(1, total_days+1)], index=day_i-1, key=f"kmv_{item_id}")
+
+                    c1, c2 = st.columns(2)
+                    c1.button("存", key=f"ksv_{item_id}", on_click=update_item_callback,
+                              args=(item_id, f"ks_{item_id}", f"ke_{item_id}", f"kn_{item_id}", f"kmv_{item_id}"))
+                    c2.button("刪", key=f"kdel_{item_id}", type="primary", on_click=delete_item_callback, args=(item_id,))
 
     # === 右側：看板區 ===
     with col_planner:
         st.subheader("📋 行程看板")
         
         # Map Expander (Moved here)
-        with st.expander("🗺️ 行程地圖", expanded=False):
-            if not st.session_state.itinerary: st.info("尚無行程")
-            else:
-                m = folium.Map(location=[st.session_state.map_center[0], st.session_state.map_center[1]], zoom_start=12)
-                # Simple logic to add markers
-                # Simple logic to add markers
-                # 1. Existing Itinerary Items (Blue)
-                for item in st.session_state.itinerary:
-                     # Attempt to use lat/lon if exists, else skip or guess
-                     flat, flon = item.get('latitude'), item.get('longitude')
-                     if flat and flon:
-                         folium.Marker([flat, flon], popup=item['Name'], tooltip=item['Name'], icon=folium.Icon(color="blue", icon="info-sign")).add_to(m)
-                
-                # 2. Focus Spot (Red)
-                if st.session_state.focus_spot:
-                    f = st.session_state.focus_spot
-                    if f.get('lat') and f.get('lon'):
-                        folium.Marker([f['lat'], f['lon']], popup=f['name'], tooltip=f"📍 {f['name']}", icon=folium.Icon(color="red", icon="star")).add_to(m)
-
-                st_folium(m, height=300, use_container_width=True)
+        render_map()
 
         # Kanban
         total_days = st.session_state.trip_info['days']
@@ -997,7 +1262,9 @@ elif st.session_state.current_page == PAGES[3]:
             start_dt = datetime.datetime.strptime(st.session_state.trip_info['start_date'], "%Y-%m-%d").date()
         w_map = {0:"一", 1:"二", 2:"三", 3:"四", 4:"五", 5:"六", 6:"日"}
         
-        sorted_items = sorted(st.session_state.itinerary, key=lambda x: x.get('Start', '00:00'))
+        itinerary = st.session_state.itinerary
+        spatial_index = load_spatial_index()
+        checker = load_schedule_checker()
         
         for day_i, col in enumerate(day_cols, 1):
             # Calculate current date
@@ -1007,104 +1274,22 @@ elif st.session_state.current_page == PAGES[3]:
             with col:
                 st.markdown(f"#### Day {day_i}")
                 st.caption(f"{curr_date.strftime('%m/%d')} ({curr_w})")
-                day_items = [x for x in sorted_items if x['Day'] == day_i]
-                for item in day_items:
-                    real_idx = st.session_state.itinerary.index(item)
-                    with st.container(border=True):
-                        st.markdown(f"**{item['Name']}**")
-                        st.caption(f"{item.get('Start')}-{item.get('End')}")
-                        if item.get('Cost'): st.markdown(f":green[${item['Cost']}]")
-                        
-                        # [Refine 1] Wallet button for detailed budget
-                        # [Refine 2] Settings button
-                        # Use 5 columns for precise control: [Spacer, Btn1, Gap, Btn2, Spacer]
-                        # Ratios: [1, 2, 0.5, 2, 1] puts a 0.5 gap in the middle
-                        btns = st.columns([1, 2, 0.5, 2, 1]) 
-                        with btns[1]:
-                             with st.popover("💰", use_container_width=True):
-                                 # Budget Wallet UI
-                                 ensure_sub_budgets(item)
-                                 st.markdown(f"#### {item['Name']} - 費用管理")
-                                 
-                                 # 1. Add New Item
-                                 with st.form(f"add_sub_{real_idx}"):
-                                     c_sub1, c_sub2 = st.columns([1, 1.5])
-                                     s_cat = c_sub1.selectbox("類別", CATEGORY_OPTIONS, key=f"scat_{real_idx}_{day_i}") 
-                                     s_cost = c_sub2.text_input("金額 (TWD)", placeholder="0", key=f"sval_{real_idx}_{day_i}")
-                                     s_note = st.text_input("備註", placeholder="例：門票", key=f"snote_{real_idx}")
-                                     
-                                     if st.form_submit_button("➕ 新增費用"):
-                                         # [Mod] Validation: no negative, int check
-                                         try: 
-                                             cost_v = int(s_cost)
-                                             if cost_v < 0: 
-                                                 st.error("金額不能為負")
-                                                 st.stop()
-                                         except: 
-                                             st.error("請輸入有效數字")
-                                             st.stop()
-                                         item['SubBudgets'].append({"Category": s_cat, "Cost": cost_v, "Note": s_note})
-                                         item['Cost'] = sum(x['Cost'] for x in item['SubBudgets']) # Update total
-                                         save_current_state()
-                                         st.rerun()
-
-                                 # 2. List Items (Editable)
-                                 st.divider()
-                                 if item['SubBudgets']:
-                                     for idx, sub in enumerate(item['SubBudgets']):
-                                         # Edit Mode
-                                         # Layout: [Cat Select] [Cost Input] [Del Button]
-                                         # But limited space. Let's show text and enable edit if needed?
-                                         # User requested "Enable modification".
-                                         
-                                         ec1, ec2, ec3 = st.columns([1.2, 1, 0.5])
-                                         
-                                         # If we make everything editable directly in list:
-                                         new_sub_cat = ec1.selectbox("類別", CATEGORY_OPTIONS, index=CATEGORY_OPTIONS.index(sub.get("Category", "其他")), key=f"ecat_{real_idx}_{idx}", label_visibility="collapsed")
-                                         new_sub_cost_str = ec2.text_input("金額", value=str(sub.get("Cost", 0)), key=f"ecost_{real_idx}_{idx}", label_visibility="collapsed")
-                                         
-                                         # Check for changes
-                                         try: new_sub_cost = int(new_sub_cost_str)
-                                         except: new_sub_cost = sub.get("Cost", 0)
-                                         
-                                         if new_sub_cat != sub.get("Category") or new_sub_cost != sub.get("Cost"):
-                                             sub['Category'] = new_sub_cat
-                                             sub['Cost'] = new_sub_cost
-                                             item['Cost'] = sum(x['Cost'] for x in item['SubBudgets'])
-                                             save_current_state()
-                                             
-                                             # Trick: To avoid continuous rerun on every keystroke, users usually click away or Enter.
-                                             # Streamlit inputs trigger rerun on blur/enter.
-                                             # Should be fine.
-                                         
-                                         if ec3.button("❌", key=f"del_sub_{real_idx}_{idx}"):
-                                             item['SubBudgets'].pop(idx)
-                                             item['Cost'] = sum(x['Cost'] for x in item['SubBudgets'])
-                                             save_current_state()
-                                             st.rerun()
-                                 else:
-                                     st.caption("尚無細項")
-
-                        with btns[3]:
-                            with st.popover("⚙️", use_container_width=True):
-                                new_start = st.time_input("開始", value=datetime.datetime.strptime(item.get('Start', '10:00'), "%H:%M").time(), key=f"ks_{real_idx}", step=60)
-                                new_end = st.time_input("結束", value=datetime.datetime.strptime(item.get('End', '11:00'), "%H:%M").time(), key=f"ke_{real_idx}", step=60)
-                                new_note = st.text_input("備註", value=item.get('Note', ''), key=f"kn_{real_idx}")
-                                
-                                # [Refine 3] Clarity on Move
-                                target_day = st.selectbox("移動至...", [f"Day {d}" for d in range(1, total_days+1)], index=day_i-1, key=f"kmv_{real_idx}")
-                                target_day_int = int(target_day.split(" ")[1])
-                                
-                                c1, c2 = st.columns(2)
-                                if c1.button("存", key=f"ksv_{real_idx}"):
-                                    st.session_state.itinerary[real_idx].update({
-                                        'Start': str(new_start)[:5], 'End': str(new_end)[:5],
-                                        'Note': new_note, 'Day': target_day_int
-                                    })
-                                    save_current_state(); st.rerun()
-                                if c2.button("刪", key=f"kdel_{real_idx}", type="primary"):
-                                    st.session_state.itinerary.pop(real_idx)
-                                    save_current_state(); st.rerun()
+                day_items = itinerary.day_items(day_i)
+                day_issues = checker.check_day(day_items, curr_date)
+                n_issues = sum(1 for x in day_issues if x)
+                if n_issues: st.caption(f":orange[⚠️ {n_issues} 個行程需要確認]")
+                if len(day_items) > 2 and st.button("🔀 路線最佳化", key=f"opt_route_{day_i}", help="以第一個行程為起點，重新排列順序並依交通時間調整時段 (夜市等有營業時間的行程維持原時段)", use_container_width=True):
+                    _, before_km, after_km, problem = optimize_day(day_items, keep_first=True, spatial_index=spatial_index,
+                                                                   distances=load_distance_matrix(), fixed=checker.markets)
+                    if problem:
+                        st.toast(f"⚠️ Day {day_i} 未調整：{problem}", icon="⚠️")
+                    else:
+                        itinerary.resort_day(day_i)
+                        save_current_state()
+                        st.toast(f"🔀 Day {day_i} 路線：{before_km:.1f} km → {after_km:.1f} km")
+                        st.rerun()
+                for item, issues in zip(day_items, day_issues):
+                    render_card(item['id'], day_i, issues)
 
     st.divider()
     if st.button("完成規劃，查看總覽 ➡️", type="primary", use_container_width=True):
@@ -1238,6 +1423,17 @@ elif st.session_state.current_page == PAGES[4]:
                 if st.button("產生 TXT 預覽與下載", use_container_width=True):
                      txt_bytes = create_txt(st.session_state.itinerary, st.session_state.trip_info['name'], st.session_state.trip_info['budget'])
                      st.download_button("✅ 點擊下載 TXT", txt_bytes, "trip.txt", "text/plain", type="primary", use_container_width=True)
+
+            st.divider()
+            st.markdown("##### 行程地圖 (PNG)")
+            st.caption("每天的路線與停留順序，可搭配 TXT 一起列印 (地圖圖磚會快取在本機)")
+            if st.button("產生行程地圖", key="export_map", use_container_width=True):
+                map_png = get_static_map_image(st.session_state.itinerary)
+                if map_png is None:
+                    st.info("行程中沒有可標示座標的地點")
+                else:
+                    st.image(map_png, use_container_width=True)
+                    st.download_button("✅ 點擊下載地圖", map_png, "trip_map.png", "image/png", type="primary", use_container_width=True)
     
     st.divider()
     st.subheader("💾 儲存此行程")
@@ -0,0 +1,90 @@
+"""
+資料集二進位快取 (Arrow IPC / Feather 欄式檔案)
+
+將 load_data / load_night_markets 整理好的 DataFrame 寫成未壓縮的 Arrow 檔，
+並以 CSV 的 大小 / 修改時間 / SHA-256 作為鍵值；
+快取新鮮時直接以 memory map 讀取，省去 CSV 解析與標籤推導。
+
+建置快取：python data_cache.py
+"""
+import hashlib
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # pyarrow 為 streamlit 的相依套件，缺少時退回讀 CSV
+    pa = None
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", ".cache")
+
+def cache_path_for(csv_path):
+    """CSV 對應的快取檔路徑 (data/.cache/<檔名>.arrow)"""
+    base = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(CACHE_DIR, f"{base}.arrow")
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def csv_fingerprint(csv_path, with_hash=True):
+    """CSV 的快取鍵：大小、修改時間 (ns) 與內容雜湊"""
+    info = os.stat(csv_path)
+    key = {"size": str(info.st_size), "mtime_ns": str(info.st_mtime_ns)}
+    if with_hash: key["sha256"] = file_sha256(csv_path)
+    return key
+
+def _read_meta(reader):
+    meta = reader.schema.metadata or {}
+    return {k.decode(): v.decode() for k, v in meta.items()}
+
+def read_cached_frame(csv_path, version=""):
+    """
+    快取新鮮時以 memory map 讀出 DataFrame，否則回傳 None
+    判斷順序：大小+修改時間相同即視為新鮮；大小相同但時間不同時再比對內容雜湊
+    """
+    if pa is None: return None
+    path = cache_path_for(csv_path)
+    if not os.path.exists(path) or not os.path.exists(csv_path): return None
+    try:
+        with pa.memory_map(path, "r") as source:
+            reader = pa.ipc.open_file(source)
+            meta = _read_meta(reader)
+            current = csv_fingerprint(csv_path, with_hash=False)
+            if meta.get("version") != version or meta.get("size") != current["size"]:
+                return None
+            if meta.get("mtime_ns") != current["mtime_ns"]:
+                if meta.get("sha256") != file_sha256(csv_path): return None
+            return reader.read_all().to_pandas()
+    except Exception as e:
+        print(f"Cache read error ({path}): {e}")
+        return None
+
+def write_cached_frame(csv_path, df, version=""):
+    """將整理好的 DataFrame 寫入快取 (先寫暫存檔再改名，避免讀到寫一半的檔案)"""
+    if pa is None: return None
+    path = cache_path_for(csv_path)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        meta = dict(table.schema.metadata or {})
+        meta.update({k.encode(): v.encode() for k, v in csv_fingerprint(csv_path).items()})
+        meta[b"version"] = version.encode()
+        table = table.replace_schema_metadata(meta)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+        return path
+    except Exception as e:
+        print(f"Cache write error ({path}): {e}")
+        return None
+
+if __name__ == "__main__":
+    from utils import build_data_caches
+    for p in build_data_caches():
+        print(f"[cache] {p}")
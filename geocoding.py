@@ -0,0 +1,335 @@
+"""
+地理編碼 (地址 -> 經緯度) 輔助工具
+
+GeocodeCache: 以 SQLite 持久化的地理編碼快取，重新啟動或多個副本間都能共用
+- 地址先正規化 (全形轉半形、臺 -> 台、去除空白) 再當作鍵值
+- 查無結果 (negative) 也會記錄，但保存期限較短
+- 超過筆數上限時依最後使用時間淘汰 (LRU)
+
+geocode_candidates: 多個候選查詢 (完整地址、路名...) 同時送出，
+依排名回傳最佳命中，整體受單一期限限制，並透過共用的 TokenBucket 遵守服務端的頻率限制
+
+Gazetteer: 由本地資料集 (景點/夜市名稱、行政區、名稱中的路名) 建立的離線地名索引，
+在呼叫網路服務之前先查詢，支援模糊比對
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from data_cache import CACHE_DIR
+
+GEOCODE_DB_FILE = os.path.join(CACHE_DIR, "geocode.sqlite")
+POSITIVE_TTL = 180 * 24 * 3600   # 查得到的地址保存 180 天
+NEGATIVE_TTL = 24 * 3600         # 查不到的地址只保存 1 天，之後重新查詢
+MAX_ENTRIES = 20000
+
+GEOCODE_DEADLINE = 6.0   # 一次地址查詢 (含所有候選) 的總時間上限 (秒)
+# Nominatim 使用政策：每秒最多 1 次請求 (不允許突發)
+NOMINATIM_RATE = 1.0
+NOMINATIM_BURST = 1
+
+def normalize_address(address):
+    """地址正規化：全形轉半形、統一「台」字、去除所有空白"""
+    addr = unicodedata.normalize("NFKC", str(address or ""))
+    addr = addr.replace("臺", "台")
+    return "".join(addr.split())
+
+class GeocodeCache:
+    """SQLite 地理編碼快取 (執行緒安全)"""
+
+    def __init__(self, path=GEOCODE_DB_FILE, positive_ttl=POSITIVE_TTL,
+                 negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS geocode (
+                    address   TEXT PRIMARY KEY,
+                    lat       REAL,
+                    lon       REAL,
+                    found     INTEGER NOT NULL,
+                    expires   REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_geocode_last_used ON geocode(last_used)")
+
+    def get(self, address):
+        """
+        查詢快取，回傳 (是否命中, 座標)
+        命中但為 negative 記錄時回傳 (True, None)；未命中或已過期回傳 (False, None)
+        """
+        key = normalize_address(address)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT lat, lon, found, expires FROM geocode WHERE address = ?", (key,)
+            ).fetchone()
+            if row is None or row[3] < now:
+                self.misses += 1
+                return False, None
+            self._conn.execute("UPDATE geocode SET last_used = ? WHERE address = ?", (now, key))
+        if not row[2]:
+            self.negative_hits += 1
+            return True, None
+        self.hits += 1
+        return True, (row[0], row[1])
+
+    def put(self, address, coords):
+        """寫入查詢結果；coords 為 None 時記錄為 negative 結果"""
+        key = normalize_address(address)
+        now = time.time()
+        if coords:
+            values = (key, float(coords[0]), float(coords[1]), 1, now + self.positive_ttl, now)
+        else:
+            values = (key, None, None, 0, now + self.negative_ttl, now)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?, ?)", values)
+            self._evict()
+
+    def _evict(self):
+        """先清除過期記錄，仍超過上限時刪除最久未使用的記錄"""
+        count = self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+        if count <= self.max_entries: return
+        removed = self._conn.execute("DELETE FROM geocode WHERE expires < ?", (time.time(),)).rowcount
+        over = count - removed - self.max_entries
+        if over > 0:
+            removed += self._conn.execute(
+                "DELETE FROM geocode WHERE address IN "
+                "(SELECT address FROM geocode ORDER BY last_used LIMIT ?)", (over,)
+            ).rowcount
+        self.evictions += removed
+
+    def stats(self):
+        """命中/未命中計數與目前筆數"""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+        return {
+            "hits": self.hits, "negative_hits": self.negative_hits,
+            "misses": self.misses, "evictions": self.evictions, "entries": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class TokenBucket:
+    """簡單的權杖桶限流器 (執行緒安全)，所有地理編碼請求共用"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """取得一個權杖；在 timeout 秒內取不到時回傳 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait_s = (1 - self._tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait_s > deadline:
+                return False
+            time.sleep(wait_s)
+
+NOMINATIM_BUCKET = TokenBucket(NOMINATIM_RATE, NOMINATIM_BURST)
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="geocode")
+_PENDING = object()
+
+def geocode_candidates(queries, lookup, deadline=GEOCODE_DEADLINE, bucket=None, executor=None):
+    """
+    同時查詢多個候選字串，回傳排名最前的命中座標
+    - queries: 依優先順序排列的查詢字串
+    - lookup(query, timeout): 回傳 (lat, lon) 或 None，網路錯誤時拋出例外
+    排名較前的候選都確定查無時，才採用後面的命中；期限內無結果時拋出 TimeoutError，
+    全部查無回傳 None (任一候選發生錯誤時改為拋出該錯誤，避免被當成查無結果快取)
+    """
+    if not queries: return None
+    bucket = bucket or NOMINATIM_BUCKET
+    executor = executor or _EXECUTOR
+    end = time.monotonic() + deadline
+
+    def run(query):
+        remaining = end - time.monotonic()
+        if remaining <= 0 or not bucket.acquire(remaining):
+            raise TimeoutError(f"rate limit wait exceeded deadline: {query}")
+        return lookup(query, max(0.1, end - time.monotonic()))
+
+    futures = [executor.submit(run, q) for q in queries]
+    rank = {f: i for i, f in enumerate(futures)}
+    results = [_PENDING] * len(futures)
+    errors = []
+    pending = set(futures)
+
+    while pending:
+        remaining = end - time.monotonic()
+        if remaining <= 0: break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for f in done:
+            try:
+                results[rank[f]] = f.result()
+            except Exception as e:
+                results[rank[f]] = None
+                errors.append(e)
+        # 依排名檢查：遇到尚未完成的候選就先等待，遇到命中即為最佳結果
+        for r in results:
+            if r is _PENDING: break
+            if r:
+                for p in pending: p.cancel()
+                return r
+
+    for p in pending: p.cancel()
+    hits = [r for r in results if r is not _PENDING and r]
+    if hits: return hits[0]
+    if pending: raise TimeoutError(f"geocoding deadline ({deadline}s) exceeded")
+    if errors: raise errors[0]
+    return None
+
+# 地址開頭可省略的區域前綴
+REGION_PREFIXES = ("台灣", "高雄市")
+# 名稱中的路名 (兩個字 + 路/街/大道)，排除「自行車路線」「XX老街」這類非路名
+ROAD_PATTERN = re.compile(r"([\u4e00-\u9fff]{2}(?:大道|路|街))(?!線)")
+
+def _is_road(token):
+    return not token.endswith("老街") and not token.startswith("高雄")
+FUZZY_THRESHOLD = 0.6
+
+def strip_region(address):
+    """正規化地址並去除「台灣」「高雄市」等前綴"""
+    addr = normalize_address(address)
+    stripped = True
+    while stripped:
+        stripped = False
+        for p in REGION_PREFIXES:
+            if addr.startswith(p) and len(addr) > len(p):
+                addr = addr[len(p):]
+                stripped = True
+    return addr
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+class Gazetteer:
+    """
+    離線地名索引
+    lookup(): 高信心的比對 (名稱完全/包含/模糊相符，或整個查詢就是行政區/路名)
+    approximate(): 查詢中包含行政區或路名時的概略位置 (網路查詢失敗時的後備)
+    """
+
+    def __init__(self, places):
+        """places: 可迭代的 (名稱, 緯度, 經度, 行政區)"""
+        self.names = {}
+        groups = {"district": defaultdict(list), "road": defaultdict(list)}
+        for name, lat, lon, district in places:
+            try: lat, lon = float(lat), float(lon)
+            except (TypeError, ValueError): continue
+            if not name or not lat or not lon or lat != lat or lon != lon: continue
+            key = strip_region(name)
+            self.names.setdefault(key, (lat, lon))
+            if district and district == district:
+                groups["district"][normalize_address(district)].append((lat, lon))
+            for road in ROAD_PATTERN.findall(key):
+                if _is_road(road):
+                    groups["road"][road].append((lat, lon))
+
+        # 行政區 / 路名以所屬地點的平均座標代表
+        def centroid(points):
+            return (sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points))
+        self.districts = {k: centroid(v) for k, v in groups["district"].items()}
+        self.roads = {k: centroid(v) for k, v in groups["road"].items()}
+        # 「美濃」也能對應到「美濃區」
+        self.district_aliases = {k[:-1]: k for k in self.districts if k.endswith("區") and len(k) > 2}
+
+        # 模糊比對用的雙字 (bigram) 反向索引
+        self.bigram_index = defaultdict(list)
+        self.name_list = list(self.names)
+        self.name_gram_counts = []
+        for i, key in enumerate(self.name_list):
+            grams = _bigrams(key)
+            self.name_gram_counts.append(len(grams))
+            for g in grams:
+                self.bigram_index[g].append(i)
+
+    @classmethod
+    def from_frames(cls, *frames):
+        """由 load_data() / load_night_markets() 的 DataFrame 建立 (行政區欄位為 district 或 area)"""
+        places = []
+        for df in frames:
+            if df is None or df.empty or 'name' not in df.columns: continue
+            district_col = 'district' if 'district' in df.columns else ('area' if 'area' in df.columns else None)
+            districts = df[district_col] if district_col else [None] * len(df)
+            places.extend(zip(df['name'], df['latitude'], df['longitude'], districts))
+        return cls(places)
+
+    def _match_name(self, query):
+        if query in self.names: return self.names[query]
+        # 查詢中包含某個地點名稱 (取最長的)
+        contained = [k for k in self.names if len(k) >= 3 and k in query]
+        if contained: return self.names[max(contained, key=len)]
+        # 查詢是唯一一個地點名稱的一部分，例如「駁二」
+        if len(query) >= 2:
+            containing = [k for k in self.names if query in k]
+            if len(containing) == 1: return self.names[containing[0]]
+        # 雙字 Dice 相似度
+        q_grams = _bigrams(query)
+        common = defaultdict(int)
+        for g in q_grams:
+            for i in self.bigram_index.get(g, ()):
+                common[i] += 1
+        best, best_score = None, FUZZY_THRESHOLD
+        for i, c in common.items():
+            score = 2 * c / (len(q_grams) + self.name_gram_counts[i])
+            if score >= best_score and (best is None or score > best_score):
+                best, best_score = i, score
+        return self.names[self.name_list[best]] if best is not None else None
+
+    def _district_of(self, query):
+        """查詢開頭的行政區 (回傳行政區名稱與剩餘字串)"""
+        for d in sorted(self.districts, key=len, reverse=True):
+            if query.startswith(d): return d, query[len(d):]
+        for alias, d in self.district_aliases.items():
+            if query == alias: return d, ""
+        return None, query
+
+    def lookup(self, address):
+        """高信心比對；找不到時回傳 None"""
+        query = strip_region(address)
+        if not query: return None
+        district, rest = self._district_of(query)
+        if district and not rest: return self.districts[district]
+        if rest in self.roads: return self.roads[rest]
+        return self._match_name(query) or (self._match_name(rest) if district and len(rest) >= 2 else None)
+
+    def approximate(self, address):
+        """概略位置：查詢中出現的路名優先，其次為行政區"""
+        query = strip_region(address)
+        if not query: return None
+        roads = [r for r in self.roads if r in query]
+        if roads: return self.roads[max(roads, key=len)]
+        district, _ = self._district_of(query)
+        if district: return self.districts[district]
+        districts = [d for d in self.districts if d in query]
+        return self.districts[max(districts, key=len)] if districts else None
@@ -0,0 +1,168 @@
+"""
+資料集圖片網址健康檢查 (離線維護指令)
+
+data.csv / night_markets.csv 的 image_url 多是第三方網址，失效時要等到使用者的卡片顯示破圖才會發現。
+本指令以有上限的執行緒池平行檢查所有網址 (共用連線池)，把狀態碼 / 大小 / Content-Type / 延遲
+寫到 data/image_health.csv；load_data / load_night_markets 讀取時會把記錄為失效的網址換成預設圖。
+只有確定的失敗 (404 / 410，或回應不是圖片) 才算失效；逾時、429、5xx 等暫時性錯誤沿用上一次的結果。
+Content-Type 不是 image/* 時 (例如 CDN 回 application/octet-stream) 再以檔頭判斷是不是圖片。
+
+執行：python image_health.py [--workers 16] [--timeout 10] [CSV ...]
+"""
+import argparse
+import csv
+import datetime
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from thumbnails import DEAD_STATUSES, make_session
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+HEALTH_FILE = os.path.join(DATA_DIR, "image_health.csv")
+DEFAULT_SOURCES = [os.path.join(DATA_DIR, "data.csv"), os.path.join(DATA_DIR, "night_markets.csv")]
+FIELDS = ["url", "ok", "status", "bytes", "content_type", "sniffed_type", "latency_ms", "error", "checked_at"]
+WORKERS = 16
+TIMEOUT = 10
+MAX_BODY = 5 * 1024 * 1024   # 沒有 Content-Length 時最多讀取的位元組數 (超過時大小記為 "≥上限")
+
+def collect_urls(paths=DEFAULT_SOURCES):
+    """CSV 檔案中所有不重複的 image_url (保持出現順序)"""
+    urls = {}
+    for path in paths:
+        if not os.path.exists(path): continue
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                url = (row.get("image_url") or "").strip()
+                if url.startswith(("http://", "https://")): urls[url] = None
+    return list(urls)
+
+def sniff_image(head):
+    """依檔頭判斷圖片格式 (JPEG / PNG / GIF / WebP)，不是圖片時回傳空字串"""
+    if head.startswith(b"\xff\xd8\xff"): return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"): return "image/png"
+    if head[:6] in (b"GIF87a", b"GIF89a"): return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP": return "image/webp"
+    return ""
+
+def _read_body(resp, limit=MAX_BODY):
+    """讀取 GET 串流：回傳 (大小, 開頭 16 bytes)；有 Content-Length 時只讀第一塊，否則最多讀 limit bytes"""
+    size = resp.headers.get("Content-Length")
+    if not resp.ok: return size, b""
+    head, total = b"", 0
+    for chunk in resp.iter_content(64 * 1024):
+        if not head: head = chunk[:16]
+        total += len(chunk)
+        if size is not None: break
+        if total >= limit: return f"≥{limit}", head
+    return (size if size is not None else total), head
+
+def check_url(session, url, timeout=TIMEOUT, limit=MAX_BODY):
+    """
+    檢查單一網址：先送 HEAD；伺服器不支援 (405/403/501)、沒有 Content-Length 或 Content-Type 不是圖片時
+    改用 GET 串流 (最多讀 limit bytes，並以檔頭判斷圖片格式)
+    回傳一筆記錄 (ok = 狀態 2xx 且 Content-Type 或檔頭為圖片)
+    """
+    record = {"url": url, "ok": False, "status": "", "bytes": "", "content_type": "", "sniffed_type": "",
+              "latency_ms": "", "error": "", "checked_at": datetime.datetime.now().isoformat(timespec="seconds")}
+    start = time.perf_counter()
+    head = b""
+    try:
+        resp = session.head(url, timeout=timeout, allow_redirects=True)
+        size = resp.headers.get("Content-Length")
+        if (resp.status_code in (403, 405, 501) or size is None
+                or (resp.ok and not resp.headers.get("Content-Type", "").startswith("image/"))):
+            with session.get(url, timeout=timeout, stream=True) as resp:
+                size, head = _read_body(resp, limit)
+    except requests.RequestException as e:
+        record["error"] = type(e).__name__
+        record["latency_ms"] = round((time.perf_counter() - start) * 1000)
+        return record
+
+    content_type = resp.headers.get("Content-Type", "").split(";")[0].strip()
+    sniffed = sniff_image(head)
+    record.update(status=resp.status_code, bytes=size if size is not None else "", content_type=content_type,
+                  sniffed_type=sniffed, latency_ms=round((time.perf_counter() - start) * 1000),
+                  ok=resp.ok and (content_type.startswith("image/") or bool(sniffed)))
+    if not record["ok"]: record["error"] = f"HTTP {resp.status_code}" if not resp.ok else "not an image"
+    return record
+
+def check_urls(urls, workers=WORKERS, timeout=TIMEOUT, session=None, progress=None):
+    """平行檢查 (最多 workers 個同時連線，共用 session 的連線池)；回傳與 urls 同順序的記錄"""
+    session = session or make_session(workers)
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i, record in enumerate(pool.map(lambda u: check_url(session, u, timeout), urls), 1):
+            results.append(record)
+            if progress: progress(i, len(urls), record)
+    return results
+
+def is_dead(record):
+    """確定失效：404 / 410，或 2xx 但 Content-Type 與檔頭都不是圖片 (record 可為 check_url 的結果或結果檔的一列)"""
+    try:
+        status = int(record.get("status") or 0)
+    except (TypeError, ValueError):
+        return False
+    if status in DEAD_STATUSES: return True
+    if not 200 <= status < 300: return False
+    return not any(str(record.get(k) or "").startswith("image/") for k in ("content_type", "sniffed_type"))
+
+def read_report(path=HEALTH_FILE):
+    """上一次的檢查結果 {網址: 記錄} (沒有記錄檔時為空)"""
+    if not os.path.exists(path): return {}
+    with open(path, encoding="utf-8", newline="") as f:
+        return {row["url"]: row for row in csv.DictReader(f)}
+
+def merge_results(results, previous):
+    """暫時性錯誤 (不是正常也不是確定失效) 的網址沿用上一次的記錄"""
+    return [previous.get(r["url"], r) if not r["ok"] and not is_dead(r) else r for r in results]
+
+def write_report(results, path=HEALTH_FILE):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    os.replace(tmp, path)
+    return path
+
+def dead_urls(path=HEALTH_FILE):
+    """檢查記錄中確定失效的網址 (沒有記錄檔時為空集合)"""
+    return {url for url, row in read_report(path).items() if is_dead(row)}
+
+def replace_dead_images(df, default, path=HEALTH_FILE):
+    """把 image_url 中記錄為失效的網址換成 default"""
+    dead = dead_urls(path)
+    if dead and 'image_url' in df.columns:
+        df.loc[df['image_url'].isin(dead), 'image_url'] = default
+    return df
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="檢查資料集中的 image_url 是否仍可使用")
+    parser.add_argument("sources", nargs="*", default=DEFAULT_SOURCES, help="要檢查的 CSV (預設為 data/ 下的兩個資料集)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="同時連線數")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="單一網址的逾時秒數")
+    parser.add_argument("--out", default=HEALTH_FILE, help="結果檔路徑")
+    args = parser.parse_args(argv)
+
+    urls = collect_urls(args.sources)
+    print(f"[image] 檢查 {len(urls)} 個網址 ({args.workers} 個連線)")
+    start = time.perf_counter()
+    def progress(i, n, record):
+        if not record["ok"]:
+            print(f"[image] {'✗' if is_dead(record) else '?'} {record['url']} ({record['error']})")
+    results = check_urls(urls, args.workers, args.timeout, progress=progress)
+    n_retry = sum(not r["ok"] and not is_dead(r) for r in results)
+    # 暫時性錯誤沿用上一次的結果 (例如本機沒有網路時不會把所有圖片都換成預設圖)
+    results = merge_results(results, read_report(args.out))
+    write_report(results, args.out)
+    n_dead = sum(is_dead(r) for r in results)
+    print(f"[image] 完成：{n_dead} 個失效、{n_retry} 個暫時無法確認 (沿用上次結果)，"
+          f"耗時 {time.perf_counter() - start:.1f} 秒 -> {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,110 @@
+"""
+行程資料結構
+
+每個行程 (dict) 帶有穩定唯一的 id 欄位 (會一起存檔)，Itinerary 另外維護：
+- id -> 行程 的對照表
+- 每天依開始時間排序的 id 列表 (新增 / 移動 / 刪除時只更新受影響的那一天)
+
+存檔格式仍是行程 dict 的列表 (to_list())；舊資料沒有 id 時載入會自動補上。
+"""
+import bisect
+import uuid
+
+def _start_key(item):
+    return item.get('Start') or '00:00'
+
+class Itinerary:
+    """以 id 為鍵、依天分桶的行程集合；迭代順序為加入順序"""
+
+    def __init__(self, items=()):
+        self._items = {}
+        self._days = {}
+        for item in items: self.add(item)
+
+    @classmethod
+    def coerce(cls, value):
+        """session_state 中可能是舊版的 list (或 None)，統一轉為 Itinerary"""
+        if isinstance(value, cls): return value
+        return cls(value or [])
+
+    def _new_id(self):
+        while True:
+            item_id = uuid.uuid4().hex[:10]
+            if item_id not in self._items: return item_id
+
+    def _bucket_insert(self, item_id):
+        item = self._items[item_id]
+        bucket = self._days.setdefault(item['Day'], [])
+        bisect.insort(bucket, item_id, key=lambda i: _start_key(self._items[i]))
+
+    def _bucket_remove(self, item_id):
+        bucket = self._days.get(self._items[item_id]['Day'], [])
+        if item_id in bucket: bucket.remove(item_id)
+
+    # --- 修改 ---
+    def add(self, item):
+        """加入行程 (沒有 id 或 id 重複時配發新的)，回傳 id"""
+        item_id = item.get('id')
+        if not item_id or item_id in self._items:
+            item_id = item['id'] = self._new_id()
+        self._items[item_id] = item
+        self._bucket_insert(item_id)
+        return item_id
+
+    def extend(self, items):
+        return [self.add(item) for item in items]
+
+    def remove(self, item_id):
+        """刪除行程，回傳被刪除的行程 (不存在時回傳 None)"""
+        if item_id not in self._items: return None
+        self._bucket_remove(item_id)
+        return self._items.pop(item_id)
+
+    def update(self, item_id, **fields):
+        """更新欄位；Day 或 Start 改變時重新放入對應天數的排序位置"""
+        item = self._items.get(item_id)
+        if item is None: return None
+        rebucket = 'Day' in fields or 'Start' in fields
+        if rebucket: self._bucket_remove(item_id)
+        item.update(fields)
+        if rebucket: self._bucket_insert(item_id)
+        return item
+
+    def move(self, item_id, day):
+        return self.update(item_id, Day=day)
+
+    def resort_day(self, day):
+        """行程時間被直接修改後 (例如路線最佳化) 重新排序該天"""
+        if day in self._days:
+            self._days[day].sort(key=lambda i: _start_key(self._items[i]))
+
+    def clear(self):
+        self._items.clear()
+        self._days.clear()
+
+    # --- 查詢 ---
+    def get(self, item_id):
+        return self._items.get(item_id)
+
+    def day_items(self, day):
+        """該天的行程 (依開始時間排序)"""
+        return [self._items[i] for i in self._days.get(day, [])]
+
+    def day_ids(self, day):
+        return list(self._days.get(day, []))
+
+    def has_duplicate(self, name, day, start):
+        return any(x['Name'] == name and x['Start'] == start for x in self.day_items(day))
+
+    def to_list(self):
+        """存檔用：行程 dict 列表 (含 id)"""
+        return list(self._items.values())
+
+    def __iter__(self):
+        return iter(list(self._items.values()))
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item_id):
+        return item_id in self._items
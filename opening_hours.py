@@ -0,0 +1,105 @@
+"""
+夜市營業時間索引
+
+CSV 的 days 欄為營業日字串 (例如 "0,1,2"，0=週一 … 6=週日，與 datetime.weekday() 相同)，
+time 欄為 "18:00~24:00" 這類文字。載入時轉為：
+- day_mask:  營業日位元遮罩 (第 w 位元 = 週 w 有營業)
+- open_min:  開始營業的分鐘數 (0~1439)
+- close_min: 結束營業的分鐘數；過午夜 (例如 "16:00~01:00") 時加 24 小時，因此可能大於 1440
+無法解析時 open_min / close_min 為 -1 (視為全天)；沒有營業日資料時 day_mask 為 0 (視為每天)。
+
+open_at() 以整份夜市陣列一次算出某個時間點是否營業 (含前一天營業到凌晨的情況)。
+to_minutes() / to_hhmm() 為行程 Start / End ("HH:MM") 與分鐘數的互換，供排程與檢查共用。
+"""
+import datetime
+
+import numpy as np
+
+DAY_MINUTES = 24 * 60
+WEEKDAY_NAMES = "一二三四五六日"
+
+def to_minutes(hhmm, default=None):
+    """行程時間 "HH:MM" -> 當天的分鐘數；無法解析時回傳 default"""
+    try:
+        t = datetime.datetime.strptime(str(hhmm)[:5], "%H:%M")
+        return t.hour * 60 + t.minute
+    except (TypeError, ValueError):
+        return default
+
+def to_hhmm(minutes):
+    """分鐘 -> HH:MM；超出當天 (午夜之後) 時拋出 ValueError，由呼叫端處理而不是截成 23:59"""
+    minutes = int(round(minutes))
+    if not 0 <= minutes < DAY_MINUTES: raise ValueError(f"{minutes} 分鐘超出一天的範圍")
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def parse_day_mask(days):
+    """營業日字串 -> 位元遮罩"""
+    mask = 0
+    for c in str(days):
+        if c.isdigit() and int(c) < 7: mask |= 1 << int(c)
+    return mask
+
+def _minutes(hhmm):
+    h, m = str(hhmm).strip().split(":")
+    return int(h) * 60 + int(m)
+
+def parse_hours(text):
+    """營業時間 "HH:MM~HH:MM" -> (開始分鐘, 結束分鐘)；結束早於開始 (過午夜) 時加 24 小時"""
+    try:
+        start, end = [_minutes(t) for t in str(text).replace("～", "~").split("~")]
+    except ValueError:
+        return -1, -1
+    if end <= start: end += DAY_MINUTES
+    return start, end
+
+def add_open_hours(df):
+    """在夜市 DataFrame 加上 day_mask / open_min / close_min 欄位"""
+    days = df['days'] if 'days' in df.columns else [""] * len(df)
+    times = df['time'] if 'time' in df.columns else [""] * len(df)
+    df['day_mask'] = np.array([parse_day_mask(d) for d in days], dtype=np.int64)
+    hours = np.array([parse_hours(t) for t in times], dtype=np.int64).reshape(-1, 2)
+    df['open_min'] = hours[:, 0]
+    df['close_min'] = hours[:, 1]
+    return df
+
+def format_day_mask(mask):
+    """位元遮罩 -> "一 二 三" 顯示用文字"""
+    return " ".join(WEEKDAY_NAMES[w] for w in range(7) if mask >> w & 1)
+
+def open_on(day_mask, weekday):
+    """每個夜市在 weekday (0=週一) 是否有營業 (不看時段)"""
+    day_mask = np.asarray(day_mask)
+    return (day_mask == 0) | (day_mask >> weekday & 1).astype(bool)
+
+def open_at(day_mask, open_min, close_min, weekday, minute):
+    """
+    每個夜市在 weekday 的 minute (0~1439) 是否營業中 (向量化)
+    - 當天有營業且 open <= minute < close
+    - 或前一天有營業且營業到凌晨 (minute + 1440 < close)
+    沒有營業時間資料的夜市只看營業日
+    """
+    day_mask = np.asarray(day_mask)
+    open_min, close_min = np.asarray(open_min), np.asarray(close_min)
+    unknown = open_min < 0
+    today = open_on(day_mask, weekday) & (unknown | ((open_min <= minute) & (minute < close_min)))
+    spill = open_on(day_mask, (weekday - 1) % 7) & ~unknown & (minute + DAY_MINUTES < close_min)
+    return today | spill
+
+def open_at_datetime(df, when):
+    """df (add_open_hours 後的夜市) 在 datetime when 是否營業中，回傳布林陣列"""
+    return open_at(df['day_mask'], df['open_min'], df['close_min'], when.weekday(), when.hour * 60 + when.minute)
+
+def covers(day_mask, open_min, close_min, weekday, start, end):
+    """
+    單一夜市：weekday 的 [start, end] 分鐘是否都在營業時間內
+    回傳 None 表示可以，否則回傳原因 ("closed" 公休 / "hours" 不在營業時間)
+    """
+    if day_mask and not day_mask >> weekday & 1:
+        # 凌晨的行程可能落在前一天營業到過午夜的時段
+        if open_min >= 0 and day_mask >> ((weekday - 1) % 7) & 1 and end + DAY_MINUTES <= close_min:
+            return None
+        return "closed"
+    if open_min < 0: return None
+    if open_min <= start and end <= close_min: return None
+    if day_mask >> ((weekday - 1) % 7) & 1 and end + DAY_MINUTES <= close_min: return None
+    return "hours"
@@ -0,0 +1,329 @@
+"""
+每日行程路線最佳化
+
+給定一天內有經緯度的行程，計算接近最短的拜訪順序：
+最近鄰 (從每個起點各試一次) 建立初始路徑，再以 2-opt 與 Or-opt 反覆改善。
+路徑為開放路徑 (不需回到起點)；距離優先取自預先計算的 DistanceMatrix，否則依座標計算並快取。
+"""
+import datetime
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from opening_hours import DAY_MINUTES, add_open_hours, open_on, to_hhmm, to_minutes
+from spatial import haversine_km, travel_minutes
+
+DEFAULT_DURATION = 60    # 沒有 Start/End 時的預設停留時間 (分鐘)
+TIME_LIMIT = 0.05        # 改善階段的時間上限 (秒)
+
+@lru_cache(maxsize=256)
+def _cached_matrix(coords):
+    lat = np.array([c[0] for c in coords])
+    lon = np.array([c[1] for c in coords])
+    return haversine_km(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+
+def distance_matrix(coords):
+    """座標列表 [(lat, lon), ...] 的兩兩距離矩陣 (公里)，相同座標組合會重用快取"""
+    key = tuple((round(float(a), 6), round(float(b), 6)) for a, b in coords)
+    return _cached_matrix(key)
+
+def path_length(path, D):
+    return sum(D[a][b] for a, b in zip(path, path[1:]))
+
+def nearest_neighbour_path(D, start=0):
+    n = len(D)
+    path, left = [start], set(range(n)) - {start}
+    while left:
+        last = D[path[-1]]
+        nxt = min(left, key=lambda j: last[j])
+        path.append(nxt)
+        left.remove(nxt)
+    return path
+
+def two_opt(path, D, fixed_start=False, deadline=None):
+    """開放路徑的 2-opt：反轉 path[i:j+1]，直到沒有改善或超過期限"""
+    n = len(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1 if fixed_start else 0, n - 1):
+            a = path[i - 1] if i > 0 else None
+            b = path[i]
+            for j in range(i + 1, n):
+                c = path[j]
+                d = path[j + 1] if j + 1 < n else None
+                before = (D[a][b] if a is not None else 0) + (D[c][d] if d is not None else 0)
+                after = (D[a][c] if a is not None else 0) + (D[b][d] if d is not None else 0)
+                if after < before - 1e-9:
+                    path[i:j + 1] = reversed(path[i:j + 1])
+                    improved = True
+                    b = path[i]
+        if deadline and time.perf_counter() > deadline: break
+    return path
+
+def _link(D, a, b):
+    return D[a][b] if a is not None and b is not None else 0.0
+
+def or_opt(path, D, fixed_start=False, deadline=None):
+    """Or-opt：把長度 1~3 的片段 (可反轉) 移到其他位置，直到沒有改善或超過期限"""
+    improved = True
+    while improved:
+        improved = False
+        for seg_len in (1, 2, 3):
+            for i in range(1 if fixed_start else 0, len(path) - seg_len + 1):
+                seg = path[i:i + seg_len]
+                p = path[i - 1] if i > 0 else None
+                q = path[i + seg_len] if i + seg_len < len(path) else None
+                # 移出片段省下的距離
+                gain = _link(D, p, seg[0]) + _link(D, seg[-1], q) - _link(D, p, q)
+                rest = path[:i] + path[i + seg_len:]
+                best = None
+                for k in range(1 if fixed_start else 0, len(rest) + 1):
+                    if k == i: continue
+                    u = rest[k - 1] if k > 0 else None
+                    v = rest[k] if k < len(rest) else None
+                    for x, y, rev in ((seg[0], seg[-1], False), (seg[-1], seg[0], True)):
+                        cost = _link(D, u, x) + _link(D, y, v) - _link(D, u, v)
+                        if cost < gain - 1e-9 and (best is None or cost < best[0]):
+                            best = (cost, k, rev)
+                if best is not None:
+                    _, k, rev = best
+                    path[:] = rest[:k] + (seg[::-1] if rev else seg) + rest[k:]
+                    improved = True
+                    break
+            if improved or (deadline and time.perf_counter() > deadline): break
+    return path
+
+def optimize_order(D, keep_first=False, time_limit=TIME_LIMIT):
+    """
+    回傳接近最短的拜訪順序 (索引列表)
+    keep_first=True 時固定第 0 個點為起點
+    """
+    n = len(D)
+    if n <= 2: return list(range(n))
+    D = D.tolist() if hasattr(D, 'tolist') else D
+    deadline = time.perf_counter() + time_limit
+
+    starts = [0] if keep_first else range(n)
+    path = min((nearest_neighbour_path(D, s) for s in starts), key=lambda p: path_length(p, D))
+    while True:
+        before = path_length(path, D)
+        two_opt(path, D, keep_first, deadline)
+        or_opt(path, D, keep_first, deadline)
+        if path_length(path, D) >= before - 1e-9 or time.perf_counter() > deadline: break
+    return path
+
+def has_coords(item):
+    lat, lon = item.get('latitude'), item.get('longitude')
+    return lat is not None and lon is not None and lat == lat and lon == lon and bool(lat or lon)
+
+def catalog_distance_matrix(items, spatial_index=None, distances=None):
+    """
+    行程間的距離矩陣：所有行程都在景點/夜市資料中時，直接從預先計算的 DistanceMatrix 取子矩陣；
+    否則 (例如手動加入的地點) 依座標計算
+    """
+    if spatial_index is not None and distances is not None:
+        positions = [spatial_index.position_of(x.get('Name')) for x in items]
+        if all(p is not None for p in positions):
+            return distances.submatrix(positions)
+    return distance_matrix([(x['latitude'], x['longitude']) for x in items])
+
+def _order_segment(segment, start, D, pos, keep_first):
+    """
+    兩個固定行程之間的一段行程：有座標的依最短路線排列 (start 為前一個固定行程，作為起點)，
+    沒有座標的維持原相對順序排在最後
+    """
+    located = [x for x in segment if id(x) in pos]
+    others = [x for x in segment if id(x) not in pos]
+    head = [start] if start is not None and id(start) in pos else []
+    nodes = head + located
+    if len(nodes) > 2:
+        idx = [pos[id(x)] for x in nodes]
+        order = optimize_order(D[np.ix_(idx, idx)], keep_first=keep_first or bool(head))
+        located = [nodes[i] for i in order][len(head):]
+    return located + others
+
+def optimize_day(items, keep_first=False, reschedule=True, round_to=5, spatial_index=None, distances=None, fixed=()):
+    """
+    重新排列一天的行程 (dict 列表) 並回傳 (新順序列表, 原距離 km, 新距離 km, 問題)
+    - spatial_index / distances 提供時，距離改由預先計算的矩陣查表
+    - fixed: 有營業時間的行程名稱 (例如夜市)；這些行程維持原本的位置與時段，只重新排列它們之間的行程
+    - 沒有座標的行程維持原相對順序，排在所屬區段的最後
+    - reschedule=True 時依序填入原本的時段：每站仍從原時段的開始時間出發 (保留使用者留下的空檔)，
+      上一站結束 + 交通時間 (以 round_to 分鐘無條件進位) 較晚時才順延
+    - 順延後會趕不上固定行程或超過午夜時不做任何變更，問題為說明文字 (沒有問題時為 None)
+    """
+    items = sorted(items, key=lambda x: x.get('Start', '00:00'))
+    located = [x for x in items if has_coords(x)]
+    if len(located) < 2: return items, 0.0, 0.0, None
+
+    D = np.asarray(catalog_distance_matrix(located, spatial_index, distances), dtype=float)
+    pos = {id(x): i for i, x in enumerate(located)}
+    def is_fixed(item):
+        return item.get('Name') in fixed and to_minutes(item.get('Start')) is not None
+    def route_km(seq):
+        stops = [pos[id(x)] for x in seq if id(x) in pos]
+        return float(sum(D[a][b] for a, b in zip(stops, stops[1:])))
+
+    # 以固定行程切成數段，各段內分別排列
+    ordered, segment, anchor = [], [], None
+    for item in items + [None]:
+        if item is not None and not is_fixed(item):
+            segment.append(item)
+            continue
+        ordered.extend(_order_segment(segment, anchor, D, pos, keep_first and anchor is None))
+        if item is not None: ordered.append(item)
+        segment, anchor = [], item
+    before_km, after_km = route_km(items), route_km(ordered)
+    if not reschedule: return ordered, before_km, after_km, None
+
+    # 非固定行程依新順序填入原本的時段 (各段的行程數不變，所以不會跨過固定行程)
+    slots = iter([to_minutes(x.get('Start')) for x in items if not is_fixed(x)])
+    clock, prev, times = to_minutes(items[0].get('Start'), 9 * 60), None, {}
+    for item in ordered:
+        start, end = to_minutes(item.get('Start')), to_minutes(item.get('End'))
+        duration = end - start if start is not None and end is not None and end > start else DEFAULT_DURATION
+        ready = clock
+        if prev is not None and id(prev) in pos and id(item) in pos:
+            ready += -(-travel_minutes(float(D[pos[id(prev)]][pos[id(item)]])) // round_to) * round_to
+        if is_fixed(item):
+            if ready > start:
+                return items, before_km, after_km, f"會趕不上 {item.get('Name')} ({item.get('Start')})"
+            clock = start + duration
+        else:
+            slot = next(slots)
+            begin = max(ready, slot) if slot is not None else ready
+            if begin + duration >= DAY_MINUTES:
+                return items, before_km, after_km, f"{item.get('Name')} 會排到午夜之後"
+            times[id(item)] = (begin, begin + duration)
+            clock = begin + duration
+        prev = item
+
+    for item in ordered:
+        if id(item) in times:
+            item['Start'], item['End'] = (to_hhmm(t) for t in times[id(item)])
+    return ordered, before_km, after_km, None
+
+# --- 自動排程 ---
+DAY_START = "09:00"
+DAY_END = "17:30"
+STOP_MINUTES = 90          # 每個景點預設停留時間
+MARKET_MINUTES = 90        # 夜市預設停留時間
+NIGHT_MARKET_COST = 300    # 夜市預估花費 (與夜市專區相同)
+TRAVEL_PENALTY = 0.03      # 每公里扣的推薦分數 (偏好鄰近景點)
+POOL_PER_DAY = 12          # 每天最多考慮的候選景點數 (依分數取前幾名)
+
+def build_itinerary(recommendations, night_markets=None, days=1, start_date=None, budget=None,
+                    skip_days=(), exclude_names=(), day_start=DAY_START, day_end=DAY_END,
+                    stop_minutes=STOP_MINUTES, market_minutes=MARKET_MINUTES, time_limit=0.5):
+    """
+    由推薦結果自動產生逐日行程 (回傳 safe_add_item 格式的 dict 列表)
+    - 每天以分數最高的剩餘景點為起點，依「分數 - 距離懲罰」挑選鄰近景點，直到排不進 day_end
+    - 當天景點以 optimize_order 排出最短路線，再依停留 + 交通時間指定時段
+    - 晚上挑當天有營業、離最後一站最近的夜市，時段落在營業時間內；預算不足時略過
+    - skip_days: 不排程的天數 (例如已有行程的天)；exclude_names: 不再排入的地點
+    整體受 time_limit 秒限制 (超過時剩下的天數只做最近鄰排序)
+    """
+    deadline = time.perf_counter() + time_limit
+    items = []
+    if recommendations is None or recommendations.empty: return items
+    if isinstance(start_date, str):
+        start_date = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+    start_date = start_date or datetime.date.today()
+    remaining_budget = budget if budget is not None else float('inf')
+    exclude = set(exclude_names)
+    plan_days = [d for d in range(1, days + 1) if d not in set(skip_days)]
+    if not plan_days: return items
+
+    # 候選池：有座標的景點，依分數取前 POOL_PER_DAY * 天數 名
+    rec = recommendations[~recommendations['name'].isin(exclude)]
+    lat = rec['latitude'].to_numpy(dtype=float)
+    lon = rec['longitude'].to_numpy(dtype=float)
+    valid = ~(np.isnan(lat) | np.isnan(lon) | ((lat == 0) & (lon == 0)))
+    rec, lat, lon = rec[valid], lat[valid], lon[valid]
+    score_col = 'similarity' if 'similarity' in rec.columns else ('score' if 'score' in rec.columns else None)
+    score = rec[score_col].to_numpy(dtype=float) if score_col else np.ones(len(rec))
+    pool_size = min(len(rec), POOL_PER_DAY * len(plan_days))
+    if pool_size < len(rec):
+        top = np.argpartition(-score, pool_size - 1)[:pool_size]
+        rec, lat, lon, score = rec.iloc[top], lat[top], lon[top], score[top]
+    names = rec['name'].to_numpy()
+    districts = rec['district'].to_numpy() if 'district' in rec.columns else np.full(len(rec), "")
+    used = np.zeros(len(rec), dtype=bool)
+
+    # 夜市：有座標、有營業時間的候選 (營業日 / 時段欄位由 add_open_hours 產生)
+    markets = None
+    if night_markets is not None and not night_markets.empty:
+        if 'day_mask' not in night_markets.columns: night_markets = add_open_hours(night_markets.copy())
+        m_lat = pd.to_numeric(night_markets['latitude'], errors='coerce').to_numpy(dtype=float)
+        m_lon = pd.to_numeric(night_markets['longitude'], errors='coerce').to_numpy(dtype=float)
+        keep = (~night_markets['name'].isin(exclude).to_numpy() & (night_markets['open_min'].to_numpy() >= 0)
+                & ~(np.isnan(m_lat) | np.isnan(m_lon) | ((m_lat == 0) & (m_lon == 0))))
+        if keep.any():
+            markets = night_markets[keep]
+            m_lat, m_lon = m_lat[keep], m_lon[keep]
+            m_names = markets['name'].to_numpy()
+            m_mask = markets['day_mask'].to_numpy(dtype=np.int64)
+            m_open = markets['open_min'].to_numpy(dtype=np.int64)
+            m_close = np.minimum(markets['close_min'].to_numpy(dtype=np.int64), DAY_MINUTES - 1)
+            m_used = np.zeros(len(markets), dtype=bool)
+
+    day_open, day_close = to_minutes(day_start, 9 * 60), to_minutes(day_end, 17 * 60 + 30)
+    for day in plan_days:
+        # 1. 挑選當天景點
+        stops = []
+        if not used.all():
+            seed = int(np.argmax(np.where(used, -np.inf, score)))
+            stops.append(seed); used[seed] = True
+            clock = day_open + stop_minutes
+            while not used.all():
+                last = stops[-1]
+                km = haversine_km(lat[last], lon[last], lat, lon)
+                utility = np.where(used, -np.inf, score - TRAVEL_PENALTY * km)
+                nxt = int(np.argmax(utility))
+                travel = -(-travel_minutes(km[nxt]) // 5) * 5
+                if clock + travel + stop_minutes > day_close: break
+                stops.append(nxt); used[nxt] = True
+                clock += travel + stop_minutes
+
+        # 2. 當天路線最佳化並指定時段
+        if len(stops) > 1:
+            D = distance_matrix(list(zip(lat[stops], lon[stops])))
+            remaining_time = max(0.0, deadline - time.perf_counter())
+            order = optimize_order(D, time_limit=min(TIME_LIMIT, remaining_time / max(1, len(plan_days))))
+            stops = [stops[i] for i in order]
+        clock, prev = day_open, None
+        for s in stops:
+            if prev is not None:
+                clock += -(-travel_minutes(float(haversine_km(lat[prev], lon[prev], lat[s], lon[s]))) // 5) * 5
+            items.append({
+                "Name": names[s], "Day": day, "Start": to_hhmm(clock), "End": to_hhmm(clock + stop_minutes),
+                "Cost": 0, "Note": f"AI排程 - {districts[s]}",
+                "latitude": float(lat[s]), "longitude": float(lon[s])
+            })
+            clock += stop_minutes
+            prev = s
+
+        # 3. 晚上的夜市：當天有營業、還有預算、離最後一站最近
+        if markets is None or remaining_budget < NIGHT_MARKET_COST: continue
+        weekday = (start_date + datetime.timedelta(days=day - 1)).weekday()
+        if prev is not None:
+            km = haversine_km(lat[prev], lon[prev], m_lat, m_lon)
+            arrive = clock + np.ceil(travel_minutes(km) / 5) * 5
+        else:
+            km, arrive = np.zeros(len(m_lat)), np.full(len(m_lat), clock)
+        start = np.maximum(np.maximum(arrive, m_open), 18 * 60)
+        ok = open_on(m_mask, weekday) & ~m_used & (start + market_minutes <= m_close)
+        if not ok.any(): continue
+        best = np.flatnonzero(ok)[np.argmin(km[ok])]
+        start = int(start[best])
+        m_used[best] = True
+        remaining_budget -= NIGHT_MARKET_COST
+        items.append({
+            "Name": m_names[best], "Day": day, "Start": to_hhmm(start), "End": to_hhmm(start + market_minutes),
+            "Cost": NIGHT_MARKET_COST, "Note": "夜市",
+            "latitude": float(m_lat[best]), "longitude": float(m_lon[best])
+        })
+    return items
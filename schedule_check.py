@@ -0,0 +1,128 @@
+"""
+行程時段檢查 (每天一個區間索引)
+
+- overlap: 與同一天其他行程的時段重疊
+- travel:  與上一站的間隔少於估計交通時間
+- closed:  夜市排在公休日或營業時間外
+- time:    結束時間早於開始時間
+
+ScheduleChecker 依「當天內容簽章」快取結果：只有被修改的那一天會重新計算，
+其餘天數每次 rerun 只需組出簽章 (O(n)) 即可取回結果。
+"""
+import datetime
+import heapq
+import math
+import threading
+from collections import OrderedDict
+
+from opening_hours import WEEKDAY_NAMES, add_open_hours, covers, to_minutes
+from route_planner import has_coords
+from spatial import haversine_km, travel_minutes
+
+TRAVEL_TOLERANCE = 5     # 間隔比交通時間短不超過此分鐘數時不提示
+CACHE_DAYS = 256         # 保留的每日檢查結果數
+
+def _signature(item):
+    lat, lon = (float(item['latitude']), float(item['longitude'])) if has_coords(item) else (None, None)
+    return (item.get('Name'), item.get('Start'), item.get('End'), lat, lon)
+
+class DaySchedule:
+    """單日的區間索引：依開始時間排序的 (start, end, 位置)"""
+
+    def __init__(self, signatures):
+        self.intervals = []
+        for pos, (_, start, end, _, _) in enumerate(signatures):
+            s = to_minutes(start)
+            if s is None: continue
+            e = to_minutes(end, s)
+            self.intervals.append((s, e, pos))
+        self.intervals.sort()
+
+    def overlaps(self):
+        """所有重疊的配對 (位置 a, 位置 b)；以最小堆積維護仍在進行中的行程"""
+        active, pairs = [], []
+        for s, e, pos in self.intervals:
+            while active and active[0][0] <= s: heapq.heappop(active)
+            pairs.extend((other, pos) for _, other in active)
+            if e > s: heapq.heappush(active, (e, pos))
+        return pairs
+
+    def consecutive(self):
+        """依時間相鄰的行程 (前一站結束, 前一站位置, 下一站開始, 下一站位置)"""
+        return [(a[1], a[2], b[0], b[2]) for a, b in zip(self.intervals, self.intervals[1:])]
+
+class ScheduleChecker:
+    """
+    行程檢查器；night_markets 為夜市資料 (name / day_mask / open_min / close_min，缺少時由 days / time 轉換)
+    check_day() 回傳與輸入順序對應的問題列表 [[(kind, 訊息), ...], ...]
+    """
+
+    def __init__(self, night_markets=None):
+        self.markets = {}
+        if night_markets is not None and not night_markets.empty:
+            if 'day_mask' not in night_markets.columns: night_markets = add_open_hours(night_markets.copy())
+            for name, mask, o, c in zip(night_markets['name'], night_markets['day_mask'],
+                                        night_markets['open_min'], night_markets['close_min']):
+                self.markets[name] = (int(mask), int(o), int(c))
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()   # 以 st.cache_resource 在各個 session 間共用
+        self.hits = 0
+        self.misses = 0
+
+    def check_day(self, items, date=None):
+        if isinstance(date, str): date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        key = (tuple(_signature(x) for x in items), date.weekday() if date else None)
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = self._check(*key)
+        with self._lock:
+            self._cache[key] = result
+            if len(self._cache) > CACHE_DAYS: self._cache.popitem(last=False)
+        return result
+
+    def check_itinerary(self, itinerary, start_date, days):
+        """整份行程：回傳 {Day: (當天行程, 問題列表)}"""
+        if isinstance(start_date, str): start_date = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+        by_day = {d: [] for d in range(1, days + 1)}
+        for item in itinerary:
+            by_day.setdefault(item['Day'], []).append(item)
+        return {d: (items, self.check_day(items, start_date + datetime.timedelta(days=d - 1)))
+                for d, items in by_day.items()}
+
+    def _check(self, signatures, weekday):
+        issues = [[] for _ in signatures]
+        index = DaySchedule(signatures)
+
+        for a, b in index.overlaps():
+            issues[a].append(("overlap", f"與 {signatures[b][0]} 時段重疊"))
+            issues[b].append(("overlap", f"與 {signatures[a][0]} 時段重疊"))
+
+        for prev_end, a, next_start, b in index.consecutive():
+            gap = next_start - prev_end
+            (_, _, _, lat1, lon1), (_, _, _, lat2, lon2) = signatures[a], signatures[b]
+            if gap < 0 or lat1 is None or lat2 is None: continue
+            need = math.ceil(travel_minutes(float(haversine_km(lat1, lon1, lat2, lon2))))
+            if gap + TRAVEL_TOLERANCE < need:
+                issues[b].append(("travel", f"距上一站 {signatures[a][0]} 只隔 {gap} 分鐘，交通約需 {need} 分鐘"))
+
+        for pos, (name, start, end, _, _) in enumerate(signatures):
+            s, e = to_minutes(start), to_minutes(end)
+            if s is not None and e is not None and e < s:
+                issues[pos].append(("time", "結束時間早於開始時間"))
+            if name not in self.markets: continue
+            if s is None: continue
+            mask, open_min, close_min = self.markets[name]
+            # 沒有日期時只檢查時段 (不可改到 weekday，後面的夜市也要用)
+            day = 0 if weekday is None else weekday
+            if weekday is None: mask = 0
+            reason = covers(mask, open_min, close_min, day, s, e if e is not None else s)
+            if reason == "closed":
+                issues[pos].append(("closed", f"週{WEEKDAY_NAMES[day]}公休"))
+            elif reason == "hours":
+                issues[pos].append(("closed", "不在營業時間內"))
+        return issues
@@ -0,0 +1,137 @@
+"""
+景點搜尋索引 (自行選擇分頁的篩選)
+
+- 行政區 / 類別：每個值一個 bitset (Python int，第 i 位元代表第 i 列)，組合條件即位元 AND / OR
+- 關鍵字：名稱 + 原始標籤的字元 n-gram 倒排索引 (1-gram、2-gram)，
+  中文子字串查詢先交集各 2-gram 的列表，只對候選列確認一次
+- 各行政區 / 類別的結果筆數 (facet) 直接由 bitset 交集的 bit_count() 得出
+查詢過程不複製 DataFrame，只在最後取出目前頁面的列。
+"""
+import unicodedata
+from collections import OrderedDict, defaultdict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from spatial import haversine_km
+
+SORT_OPTIONS = ["預設順序", "名稱", "行政區", "距離地圖中心", "符合偏好"]
+KEYWORD_CACHE_SIZE = 256
+
+SearchResult = namedtuple("SearchResult", ["bits", "count", "district_counts", "category_counts"])
+
+_EMPTY = np.array([], dtype=np.int32)
+
+def normalize_text(text):
+    """全形/半形統一、英文轉小寫"""
+    return unicodedata.normalize("NFKC", str(text)).lower()
+
+def _ngrams(text):
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    grams.discard("\n")
+    return grams
+
+def to_bitset(positions, n):
+    """列位置 -> bitset"""
+    if len(positions) == 0: return 0
+    flags = np.zeros(n, dtype=bool)
+    flags[np.asarray(positions)] = True
+    return int.from_bytes(np.packbits(flags, bitorder="little").tobytes(), "little")
+
+def bitset_positions(bits, n):
+    """bitset -> 由小到大的列位置陣列"""
+    if not bits: return np.array([], dtype=np.int64)
+    raw = np.frombuffer(bits.to_bytes((n + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(raw, bitorder="little")[:n])
+
+class SearchIndex:
+    """df 為 load_data() 的景點資料 (需有 name / district / tags / tag_mask)；categories 對應 tag_mask 的位元順序"""
+
+    def __init__(self, df, categories):
+        n = self.n = len(df)
+        self.all_bits = (1 << n) - 1
+        self.names = df['name'].fillna("").astype(str).to_numpy(dtype=str)
+        self.districts = df['district'].fillna("").astype(str).to_numpy(dtype=str)
+        self.lat = pd.to_numeric(df['latitude'], errors='coerce').to_numpy(dtype=float)
+        self.lon = pd.to_numeric(df['longitude'], errors='coerce').to_numpy(dtype=float)
+
+        self.district_bits = {d: to_bitset(np.flatnonzero(self.districts == d), n)
+                              for d in sorted(set(self.districts))}
+        masks = df['tag_mask'].to_numpy(dtype=np.int64) if 'tag_mask' in df.columns else np.zeros(n, dtype=np.int64)
+        self.category_bits = {c: to_bitset(np.flatnonzero(masks & (1 << i)), n) for i, c in enumerate(categories)}
+
+        tags = df['tags'].fillna("").astype(str).to_numpy() if 'tags' in df.columns else np.full(n, "")
+        self.texts = [normalize_text(f"{name}\n{tag}") for name, tag in zip(self.names, tags)]
+        postings = defaultdict(list)
+        for i, text in enumerate(self.texts):
+            for gram in _ngrams(text): postings[gram].append(i)
+        self.postings = {g: np.array(p, dtype=np.int32) for g, p in postings.items()}
+        self._keyword_cache = OrderedDict()
+
+    # --- 查詢 ---
+    def keyword_bits(self, keyword):
+        """名稱或原始標籤包含 keyword 的列 (bitset)"""
+        kw = normalize_text(keyword).strip()
+        if not kw: return self.all_bits
+        if kw in self._keyword_cache:
+            self._keyword_cache.move_to_end(kw)
+            return self._keyword_cache[kw]
+
+        grams = {kw} if len(kw) == 1 else {kw[i:i + 2] for i in range(len(kw) - 1)}
+        lists = sorted((self.postings.get(g, _EMPTY) for g in grams), key=len)
+        candidates = lists[0]
+        for p in lists[1:]:
+            if not len(candidates): break
+            candidates = np.intersect1d(candidates, p, assume_unique=True)
+        # 3 個字以上時 2-gram 全部出現不代表連續出現，逐一確認候選列
+        if len(kw) > 2: candidates = [i for i in candidates if kw in self.texts[i]]
+        bits = to_bitset(candidates, self.n)
+
+        self._keyword_cache[kw] = bits
+        if len(self._keyword_cache) > KEYWORD_CACHE_SIZE: self._keyword_cache.popitem(last=False)
+        return bits
+
+    def _union(self, table, keys):
+        if not keys: return self.all_bits
+        bits = 0
+        for k in keys: bits |= table.get(k, 0)
+        return bits
+
+    def query(self, districts=(), categories=(), keyword=""):
+        """
+        行政區 (任一) AND 類別 (任一) AND 關鍵字
+        facet 筆數：每個行政區在「其他條件」下的筆數，類別同理 (不受自身選取影響)
+        """
+        d_bits = self._union(self.district_bits, districts)
+        c_bits = self._union(self.category_bits, categories)
+        k_bits = self.keyword_bits(keyword)
+        bits = d_bits & c_bits & k_bits
+        ck, dk = c_bits & k_bits, d_bits & k_bits
+        return SearchResult(
+            bits, bits.bit_count(),
+            {d: (b & ck).bit_count() for d, b in self.district_bits.items()},
+            {c: (b & dk).bit_count() for c, b in self.category_bits.items()})
+
+    def positions(self, bits):
+        return bitset_positions(bits, self.n)
+
+    # --- 排序 ---
+    def sort(self, positions, sort_by, center=None, scores=None):
+        """
+        依排序方式重排列位置 (只用索引內的欄位陣列，不碰 DataFrame)
+        center: (緯度, 經度)；scores: 與 positions 對應的偏好分數；缺少時維持原順序
+        """
+        positions = np.asarray(positions)
+        if sort_by == "名稱":
+            order = np.argsort(self.names[positions], kind='stable')
+        elif sort_by == "行政區":
+            order = np.lexsort((self.names[positions], self.districts[positions]))
+        elif sort_by == "距離地圖中心" and center is not None:
+            dist = haversine_km(center[0], center[1], self.lat[positions], self.lon[positions])
+            order = np.argsort(np.where(np.isnan(dist), np.inf, dist), kind='stable')
+        elif sort_by == "符合偏好" and scores is not None:
+            order = np.argsort(-np.asarray(scores, dtype=float), kind='stable')
+        else:
+            return positions
+        return positions[order]
@@ -0,0 +1,255 @@
+"""
+景點與夜市的空間索引 (BallTree + haversine 距離)
+
+建立一次後可在每次 rerun 查詢：
+- nearest(): 最近的 k 個地點
+- within(): 半徑內的所有地點 (依距離排序)
+
+DistanceMatrix: 所有地點兩兩距離的預先計算結果 (float32，memory map 檔案，依資料版本快取)
+- 地點數少時存完整矩陣；超過 DENSE_LIMIT 時只存每個點半徑內最近的鄰居 (稀疏模式)
+"""
+import glob
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+from data_cache import CACHE_DIR
+
+EARTH_RADIUS_KM = 6371.0088
+AVG_SPEED_KMH = 30.0     # 市區平均車速
+ROAD_FACTOR = 1.3        # 直線距離換算道路距離的係數
+DENSE_LIMIT = 4000       # 地點數超過此值改用稀疏模式 (4000^2 float32 約 64MB)
+SPARSE_RADIUS_KM = 10.0  # 稀疏模式只保存此半徑內的鄰居
+SPARSE_NEIGHBORS = 64    # 稀疏模式每個點最多保存的鄰居數
+BLOCK_ROWS = 1024        # 分塊計算，避免一次配置整個中間陣列
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """兩點 (或兩組陣列) 間的大圓距離 (公里)，支援 numpy 廣播"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def travel_minutes(km):
+    """估計交通時間 (分鐘)"""
+    return km * ROAD_FACTOR / AVG_SPEED_KMH * 60
+
+def _valid_coords(lat, lon):
+    return lat is not None and lon is not None and lat == lat and lon == lon and (lat or lon)
+
+class SpatialIndex:
+    """地點空間索引；points 為含 name / latitude / longitude 欄位的 DataFrame"""
+
+    def __init__(self, points):
+        lat = pd.to_numeric(points['latitude'], errors='coerce')
+        lon = pd.to_numeric(points['longitude'], errors='coerce')
+        valid = lat.notna() & lon.notna() & ~((lat == 0) & (lon == 0))
+        self.points = points[valid].reset_index(drop=True)
+        self.coords = np.radians(np.column_stack([lat[valid].to_numpy(float), lon[valid].to_numpy(float)]))
+        self.tree = BallTree(self.coords, metric='haversine') if len(self.coords) else None
+        # 以 numpy 欄位陣列組結果，避免每次查詢都經過 DataFrame 索引
+        self.columns = {c: self.points[c].to_numpy() for c in self.points.columns}
+        self.lat_lon = np.degrees(self.coords)
+        # 名稱 -> 位置 (同名時取第一個)
+        self.positions = {}
+        for i, name in enumerate(self.columns.get('name', [])):
+            self.positions.setdefault(name, i)
+
+    def position_of(self, name):
+        return self.positions.get(name)
+
+    @classmethod
+    def from_frames(cls, attractions, night_markets=None):
+        """合併景點 (kind='attraction') 與夜市 (kind='night_market') 建立索引"""
+        cols = ['name', 'latitude', 'longitude', 'image_url', 'district']
+        frames = []
+        if attractions is not None and not attractions.empty:
+            a = attractions.reindex(columns=cols + ['id']).copy()
+            a['kind'] = 'attraction'
+            frames.append(a)
+        if night_markets is not None and not night_markets.empty:
+            n = night_markets.rename(columns={'area': 'district'}).reindex(columns=cols).copy()
+            n['id'] = None
+            n['kind'] = 'night_market'
+            frames.append(n)
+        points = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=cols + ['id', 'kind'])
+        return cls(points)
+
+    def __len__(self):
+        return len(self.points)
+
+    def query_knn(self, lat, lon, k=5):
+        """回傳 (位置陣列, 距離公里陣列)，依距離由近到遠"""
+        if self.tree is None or not _valid_coords(lat, lon): return np.array([], int), np.array([])
+        k = min(k, len(self.coords))
+        dist, idx = self.tree.query(np.radians([[float(lat), float(lon)]]), k=k)
+        return idx[0], dist[0] * EARTH_RADIUS_KM
+
+    def query_radius(self, lat, lon, radius_km):
+        """回傳半徑內的 (位置陣列, 距離公里陣列)，依距離由近到遠"""
+        if self.tree is None or not _valid_coords(lat, lon): return np.array([], int), np.array([])
+        idx, dist = self.tree.query_radius(np.radians([[float(lat), float(lon)]]),
+                                           r=radius_km / EARTH_RADIUS_KM, return_distance=True, sort_results=True)
+        return idx[0], dist[0] * EARTH_RADIUS_KM
+
+    def _rows(self, idx, dist, exclude_names=(), limit=None):
+        """將查詢結果轉為 dict 列表 (含 distance_km)，可排除指定名稱"""
+        names = self.columns['name']
+        rows = []
+        for i, d in zip(idx, dist):
+            if exclude_names and names[i] in exclude_names: continue
+            row = {c: col[i] for c, col in self.columns.items()}
+            row['distance_km'] = float(d)
+            rows.append(row)
+            if limit is not None and len(rows) >= limit: break
+        return rows
+
+    def nearest(self, lat, lon, k=5, exclude_names=()):
+        """最近的 k 個地點 (可排除指定名稱，例如地點本身)"""
+        exclude = set(exclude_names)
+        idx, dist = self.query_knn(lat, lon, k + len(exclude))
+        return self._rows(idx, dist, exclude, limit=k)
+
+    def within(self, lat, lon, radius_km, exclude_names=()):
+        """半徑 radius_km 內的所有地點 (依距離排序)"""
+        idx, dist = self.query_radius(lat, lon, radius_km)
+        return self._rows(idx, dist, set(exclude_names))
+
+def dataset_version(lat_lon):
+    """座標陣列的版本鍵 (順序或任一座標改變即不同)"""
+    arr = np.ascontiguousarray(lat_lon, dtype=np.float64)
+    return hashlib.sha256(arr.tobytes()).hexdigest()[:16] + f"-{len(arr)}"
+
+def _save_npy(path, array):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def _remove_stale(cache_dir, prefix):
+    """刪除其他資料版本的距離快取檔 (仍被其他程序 memory map 時刪除失敗，下次再清)"""
+    for path in glob.glob(os.path.join(cache_dir, "distances-*.npy")):
+        if not path.startswith(prefix + "."):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class DistanceMatrix:
+    """
+    地點兩兩距離 (公里) 與估計交通時間 (分鐘)
+    - dense: dist[i, j] 直接查表
+    - sparse: 每列保存最近 SPARSE_NEIGHBORS 個 (半徑 SPARSE_RADIUS_KM 內) 鄰居，
+      其餘配對即時以 haversine 計算
+    """
+
+    def __init__(self, lat_lon, dense=None, nbr_idx=None, nbr_dist=None):
+        self.lat_lon = np.asarray(lat_lon, dtype=np.float64)
+        self.dense = dense
+        self.nbr_idx = nbr_idx
+        self.nbr_dist = nbr_dist
+
+    @property
+    def is_dense(self):
+        return self.dense is not None
+
+    def __len__(self):
+        return len(self.lat_lon)
+
+    # --- 建立 / 載入 ---
+    @classmethod
+    def build(cls, lat_lon, dense_limit=DENSE_LIMIT, radius_km=SPARSE_RADIUS_KM, max_neighbors=SPARSE_NEIGHBORS):
+        """在記憶體中建立 (分塊向量化計算)"""
+        lat_lon = np.asarray(lat_lon, dtype=np.float64).reshape(-1, 2)
+        n = len(lat_lon)
+        lat, lon = lat_lon[:, 0], lat_lon[:, 1]
+        if n <= dense_limit:
+            dense = np.empty((n, n), dtype=np.float32)
+            for s in range(0, n, BLOCK_ROWS):
+                e = min(n, s + BLOCK_ROWS)
+                dense[s:e] = haversine_km(lat[s:e, None], lon[s:e, None], lat[None, :], lon[None, :])
+            return cls(lat_lon, dense=dense)
+
+        k = min(max_neighbors + 1, n)
+        tree = BallTree(np.radians(lat_lon), metric='haversine')
+        nbr_idx = np.full((n, k - 1), -1, dtype=np.int32)
+        nbr_dist = np.full((n, k - 1), np.inf, dtype=np.float32)
+        for s in range(0, n, BLOCK_ROWS):
+            e = min(n, s + BLOCK_ROWS)
+            dist, idx = tree.query(np.radians(lat_lon[s:e]), k=k)
+            dist = dist * EARTH_RADIUS_KM
+            # 去掉自己：座標重複時自己不一定排第 0 個，也可能不在結果中 (此時去掉最遠的一個)
+            own = idx == np.arange(s, e)[:, None]
+            own[~own.any(axis=1), -1] = True
+            dist, idx = dist[~own].reshape(e - s, k - 1), idx[~own].reshape(e - s, k - 1)
+            # 去掉半徑外的鄰居
+            far = dist > radius_km
+            idx[far] = -1
+            dist[far] = np.inf
+            nbr_idx[s:e] = idx
+            nbr_dist[s:e] = dist
+        return cls(lat_lon, nbr_idx=nbr_idx, nbr_dist=nbr_dist)
+
+    @classmethod
+    def load_or_build(cls, lat_lon, cache_dir=CACHE_DIR, **kwargs):
+        """
+        依資料版本讀取 memory map 快取檔；不存在時建立並寫入 (同時刪除舊版本的快取檔)
+        檔名: distances-<版本>.dense.npy 或 .nbr_idx.npy / .nbr_dist.npy
+        """
+        lat_lon = np.asarray(lat_lon, dtype=np.float64).reshape(-1, 2)
+        prefix = os.path.join(cache_dir, f"distances-{dataset_version(lat_lon)}")
+        try:
+            if os.path.exists(prefix + ".dense.npy"):
+                return cls(lat_lon, dense=np.load(prefix + ".dense.npy", mmap_mode="r"))
+            if os.path.exists(prefix + ".nbr_idx.npy") and os.path.exists(prefix + ".nbr_dist.npy"):
+                return cls(lat_lon, nbr_idx=np.load(prefix + ".nbr_idx.npy", mmap_mode="r"),
+                           nbr_dist=np.load(prefix + ".nbr_dist.npy", mmap_mode="r"))
+        except (OSError, ValueError) as e:
+            print(f"Distance cache read error: {e}")
+
+        matrix = cls.build(lat_lon, **kwargs)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            if matrix.is_dense:
+                _save_npy(prefix + ".dense.npy", matrix.dense)
+            else:
+                _save_npy(prefix + ".nbr_idx.npy", matrix.nbr_idx)
+                _save_npy(prefix + ".nbr_dist.npy", matrix.nbr_dist)
+            _remove_stale(cache_dir, prefix)
+        except OSError as e:
+            print(f"Distance cache write error: {e}")
+        return matrix
+
+    # --- 查詢 ---
+    def distance(self, i, j):
+        """第 i 與第 j 個地點的距離 (公里)"""
+        if i == j: return 0.0
+        if self.is_dense: return float(self.dense[i, j])
+        hit = np.flatnonzero(self.nbr_idx[i] == j)
+        if len(hit): return float(self.nbr_dist[i, hit[0]])
+        return float(haversine_km(self.lat_lon[i, 0], self.lat_lon[i, 1], self.lat_lon[j, 0], self.lat_lon[j, 1]))
+
+    def minutes(self, i, j):
+        """第 i 到第 j 個地點的估計交通時間 (分鐘)"""
+        return travel_minutes(self.distance(i, j))
+
+    def submatrix(self, positions):
+        """指定地點之間的距離矩陣 (公里，float64)"""
+        pos = np.asarray(positions, dtype=np.int64)
+        if self.is_dense:
+            return np.asarray(self.dense[np.ix_(pos, pos)], dtype=np.float64)
+        lat, lon = self.lat_lon[pos, 0], self.lat_lon[pos, 1]
+        return haversine_km(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+
+    def neighbors(self, i, radius_km=SPARSE_RADIUS_KM):
+        """第 i 個地點半徑內的鄰居 (位置陣列, 距離陣列)，依距離排序"""
+        if self.is_dense:
+            row = np.asarray(self.dense[i])
+            idx = np.flatnonzero(row <= radius_km)
+            idx = idx[idx != i]
+            order = np.argsort(row[idx], kind='stable')
+            return idx[order], row[idx][order].astype(np.float64)
+        keep = np.asarray(self.nbr_dist[i]) <= radius_km
+        return np.asarray(self.nbr_idx[i])[keep].astype(np.int64), np.asarray(self.nbr_dist[i])[keep].astype(np.float64)
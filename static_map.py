@@ -0,0 +1,250 @@
+"""
+靜態行程地圖 (匯出用 PNG)
+
+以 Web Mercator 圖磚 (z/x/y，每張 256px) 拼出涵蓋所有行程的底圖，再用 PIL 畫上
+每天的路線折線與依順序編號的標記，不需要 Google Static Maps 的 API key。
+
+- TileCache:   圖磚磁碟快取 (data/.cache/tiles/z/x/y.png)，超過容量時依最後使用時間 (LRU) 淘汰
+- 圖磚來源:    HttpTileSource (URL 樣板，預設 OpenStreetMap，可指向本機的圖磚伺服器)、
+               DirectoryTileSource (事先下載好的圖磚資料夾)；取不到時以空白底色代替
+"""
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageDraw, ImageFont
+
+from data_cache import CACHE_DIR
+
+TILE_SIZE = 256
+TILE_CACHE_DIR = os.path.join(CACHE_DIR, "tiles")
+TILE_CACHE_BYTES = 200 * 1024 * 1024   # 圖磚快取容量上限
+DEFAULT_TILE_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+USER_AGENT = "kaohsiung_travel_planner_app_v1"
+FETCH_TIMEOUT = 5
+FETCH_WORKERS = 4
+MAX_ZOOM = 16
+MAP_SIZE = (800, 600)
+PADDING = 40                           # 行程點與圖片邊緣的最小距離 (px)
+BACKGROUND = (236, 236, 232)
+DAY_COLORS = ["#2a81cb", "#2aad27", "#9c2bcb", "#cb8427", "#a52a2a", "#4a7f8c", "#1e5e20", "#cb2b8f"]
+
+# --- 座標轉換 ---
+def to_world_pixel(lat, lon, zoom):
+    """經緯度 -> 該縮放等級的全球像素座標"""
+    scale = TILE_SIZE * 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = (lon + 180.0) / 360.0 * scale
+    s = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)) * scale
+    return x, y
+
+def fit_zoom(points, size=MAP_SIZE, padding=PADDING, max_zoom=MAX_ZOOM):
+    """能把所有點放進圖片 (扣除邊距) 的最大縮放等級"""
+    for zoom in range(max_zoom, 0, -1):
+        xs, ys = zip(*(to_world_pixel(lat, lon, zoom) for lat, lon in points))
+        if max(xs) - min(xs) <= size[0] - 2 * padding and max(ys) - min(ys) <= size[1] - 2 * padding:
+            return zoom
+    return 1
+
+# --- 圖磚來源 ---
+class HttpTileSource:
+    """依 URL 樣板 ({z}/{x}/{y}) 下載圖磚；共用連線"""
+
+    def __init__(self, url_template=DEFAULT_TILE_URL, timeout=FETCH_TIMEOUT):
+        self.url_template = url_template
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+
+    def fetch(self, z, x, y):
+        resp = self.session.get(self.url_template.format(z=z, x=x, y=y), timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.content
+
+class DirectoryTileSource:
+    """事先準備好的圖磚資料夾 (root/z/x/y.png)"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def fetch(self, z, x, y):
+        path = os.path.join(self.root, str(z), str(x), f"{y}.png")
+        if not os.path.exists(path): return None
+        with open(path, "rb") as f:
+            return f.read()
+
+# --- 圖磚快取 ---
+class TileCache:
+    """圖磚磁碟快取；以檔案修改時間記錄最後使用時間，總大小超過 max_bytes 時淘汰最久未用的圖磚"""
+
+    def __init__(self, directory=TILE_CACHE_DIR, max_bytes=TILE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # path -> 大小，最久未用的在前
+        self.total_bytes = 0
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".png"): continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self.total_bytes += size
+
+    def path(self, z, x, y):
+        return os.path.join(self.directory, str(z), str(x), f"{y}.png")
+
+    def get(self, z, x, y):
+        path = self.path(z, x, y)
+        with self._lock:
+            if path not in self._entries: return None
+            self._entries.move_to_end(path)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.total_bytes -= self._entries.pop(path, 0)
+            return None
+        return data
+
+    def put(self, z, x, y, data):
+        path = self.path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self.total_bytes += len(data) - self._entries.pop(path, 0)
+            self._entries[path] = len(data)
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                old, size = self._entries.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len(self._entries)
+
+class TileFetcher:
+    """先查快取，再向來源平行下載；來源失敗一次後這次拼圖的其餘圖磚直接用空白底色"""
+
+    def __init__(self, source, cache=None, workers=FETCH_WORKERS):
+        self.source = source
+        self.cache = cache
+        self.workers = workers
+
+    def fetch_many(self, keys):
+        tiles = {}
+        missing = []
+        for key in keys:
+            data = self.cache.get(*key) if self.cache is not None else None
+            if data is None: missing.append(key)
+            else: tiles[key] = data
+        if not missing or self.source is None: return tiles
+
+        failed = threading.Event()
+        def fetch(key):
+            if failed.is_set(): return key, None
+            try:
+                data = self.source.fetch(*key)
+            except requests.RequestException:
+                failed.set()
+                return key, None
+            if data and self.cache is not None:
+                try:
+                    self.cache.put(*key, data)
+                except OSError:
+                    pass
+            return key, data
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for key, data in pool.map(fetch, missing):
+                if data: tiles[key] = data
+        return tiles
+
+# --- 繪製 ---
+def _day_key(day):
+    """天數依數字排序 (Day 10 排在 Day 9 之後)"""
+    try:
+        return int(day)
+    except (TypeError, ValueError):
+        return math.inf
+
+def _route_points(items):
+    """有座標的行程 -> {天: [(緯度, 經度), ...]} (依開始時間排序)"""
+    by_day = {}
+    for item in sorted(items, key=lambda x: (_day_key(x.get('Day', 1)), x.get('Start') or '00:00')):
+        try:
+            lat, lon = float(item.get('latitude')), float(item.get('longitude'))
+        except (TypeError, ValueError):
+            continue
+        if math.isnan(lat) or math.isnan(lon) or (lat == 0 and lon == 0): continue
+        by_day.setdefault(item.get('Day', 1), []).append((lat, lon))
+    return by_day
+
+def render_static_map(items, fetcher, size=MAP_SIZE):
+    """畫出行程地圖，回傳 PNG bytes；沒有任何座標時回傳 None"""
+    by_day = _route_points(items)
+    points = [p for pts in by_day.values() for p in pts]
+    if not points: return None
+
+    width, height = size
+    zoom = fit_zoom(points, size)
+    xs, ys = zip(*(to_world_pixel(lat, lon, zoom) for lat, lon in points))
+    left = (min(xs) + max(xs)) / 2 - width / 2
+    top = (min(ys) + max(ys)) / 2 - height / 2
+
+    # 底圖：拼接涵蓋畫面的圖磚
+    n_tiles = 2 ** zoom
+    tx0, ty0 = int(left // TILE_SIZE), int(top // TILE_SIZE)
+    tx1, ty1 = int((left + width) // TILE_SIZE), int((top + height) // TILE_SIZE)
+    keys = [(zoom, tx % n_tiles, ty) for tx in range(tx0, tx1 + 1) for ty in range(ty0, ty1 + 1) if 0 <= ty < n_tiles]
+    tiles = fetcher.fetch_many(keys)
+    img = Image.new("RGB", size, BACKGROUND)
+    for tx in range(tx0, tx1 + 1):
+        for ty in range(ty0, ty1 + 1):
+            data = tiles.get((zoom, tx % n_tiles, ty))
+            if not data: continue
+            try:
+                tile = Image.open(io.BytesIO(data)).convert("RGB")
+            except OSError:
+                continue
+            img.paste(tile, (int(tx * TILE_SIZE - left), int(ty * TILE_SIZE - top)))
+
+    # 每天的路線與編號標記
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default(size=12)
+    for i, (day, pts) in enumerate(sorted(by_day.items(), key=lambda kv: _day_key(kv[0]))):
+        color = DAY_COLORS[i % len(DAY_COLORS)]
+        px = [(x - left, y - top) for x, y in (to_world_pixel(lat, lon, zoom) for lat, lon in pts)]
+        if len(px) > 1: draw.line(px, fill=color, width=4, joint="curve")
+        for n, (x, y) in enumerate(px, 1):
+            draw.ellipse((x - 9, y - 9, x + 9, y + 9), fill=color, outline="white", width=2)
+            draw.text((x, y), str(n), fill="white", font=font, anchor="mm")
+        # 圖例
+        draw.rectangle((10, 10 + i * 18, 22, 22 + i * 18), fill=color)
+        draw.text((28, 16 + i * 18), f"Day {day}", fill="black", font=font, anchor="lm")
+
+    draw.text((width - 6, height - 4), "© OpenStreetMap contributors", fill=(60, 60, 60), font=font, anchor="rd")
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from geopy.exc import GeocoderServiceError
+from geopy.geocoders import Nominatim
+
+from geocoding import NOMINATIM_BUCKET, TokenBucket, geocode_candidates
+
+# 假的 Nominatim：只認得這些查詢字串
+PLACES = {
+    "台灣高雄市鼓山區蓮海路70號": (22.6248, 120.2658),
+    "台灣高雄市鼓山區蓮海路": (22.6270, 120.2650),
+}
+
+def make_handler(log, status=200, delay=0.0):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+            log.append((time.monotonic(), query))
+            time.sleep(delay)
+            if status != 200:
+                self.send_error(status)
+                return
+            hit = PLACES.get(query)
+            body = json.dumps([{"lat": str(hit[0]), "lon": str(hit[1]), "display_name": query}] if hit else [])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+def make_lookup(base_url):
+    geolocator = Nominatim(user_agent="test", domain=base_url.split("://", 1)[1], scheme="http")
+    def lookup(query, timeout):
+        location = geolocator.geocode(query, timeout=timeout)
+        return (location.latitude, location.longitude) if location else None
+    return lookup
+
+def test_default_bucket_has_no_burst():
+    assert NOMINATIM_BUCKET.capacity == 1
+
+def test_prefers_full_address_and_falls_back_to_road(local_server):
+    log = []
+    lookup = make_lookup(local_server(make_handler(log)))
+    bucket = TokenBucket(rate=50, capacity=1)
+    full = geocode_candidates(["台灣高雄市鼓山區蓮海路70號", "台灣高雄市鼓山區蓮海路"], lookup, bucket=bucket)
+    road = geocode_candidates(["台灣高雄市鼓山區蓮海路99號", "台灣高雄市鼓山區蓮海路"], lookup, bucket=bucket)
+    assert full == pytest.approx(PLACES["台灣高雄市鼓山區蓮海路70號"])
+    assert road == pytest.approx(PLACES["台灣高雄市鼓山區蓮海路"])
+
+def test_not_found_returns_none(local_server):
+    lookup = make_lookup(local_server(make_handler([])))
+    assert geocode_candidates(["台灣高雄市不存在路1號"], lookup, bucket=TokenBucket(50)) is None
+
+def test_requests_are_spaced_by_the_bucket(local_server):
+    log = []
+    lookup = make_lookup(local_server(make_handler(log)))
+    bucket = TokenBucket(rate=10, capacity=1)
+    queries = [f"台灣高雄市測試路{i}號" for i in range(4)]
+    threads = [threading.Thread(target=geocode_candidates, args=([q], lookup), kwargs={"bucket": bucket})
+               for q in queries]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    stamps = sorted(t for t, _ in log)
+    assert len(stamps) == 4
+    # 容量 1：同時送出的請求也要間隔約 1 / rate 秒
+    assert all(b - a >= 0.08 for a, b in zip(stamps, stamps[1:]))
+
+def test_server_error_is_raised_not_treated_as_not_found(local_server):
+    lookup = make_lookup(local_server(make_handler([], status=500)))
+    with pytest.raises(GeocoderServiceError):
+        geocode_candidates(["台灣高雄市鼓山區蓮海路70號"], lookup, bucket=TokenBucket(50))
+
+def test_deadline_exceeded_raises_timeout(local_server):
+    lookup = make_lookup(local_server(make_handler([], delay=1.0)))
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        geocode_candidates(["台灣高雄市鼓山區蓮海路70號"], lookup, deadline=0.3, bucket=TokenBucket(50))
+    assert time.monotonic() - start < 0.9
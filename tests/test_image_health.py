@@ -0,0 +1,98 @@
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pandas as pd
+import pytest
+
+from image_health import (MAX_BODY, check_url, check_urls, dead_urls, is_dead, merge_results, read_report,
+                          replace_dead_images, write_report)
+from thumbnails import make_session
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 64
+JPEG = b"\xff\xd8\xff\xe0\0\x10JFIF\0" + b"\0" * 64
+
+# 路徑 -> (狀態碼, Content-Type, 內容, 延遲秒數)
+ROUTES = {
+    "/ok.png": (200, "image/png", PNG, 0),
+    "/missing.png": (404, "text/html", b"not found", 0),
+    "/gone.png": (410, "text/html", b"gone", 0),
+    "/page.png": (200, "text/html", b"<html></html>", 0),
+    "/busy.png": (503, "text/html", b"busy", 0),
+    "/limited.png": (429, "text/html", b"slow down", 0),
+    "/slow.png": (200, "image/png", PNG, 2),
+    "/octet.jpg": (200, "application/octet-stream", JPEG, 0),
+}
+
+class Handler(BaseHTTPRequestHandler):
+    def _reply(self, body=True):
+        status, content_type, data, delay = ROUTES.get(self.path, (404, "text/html", b"", 0))
+        time.sleep(delay)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body: self.wfile.write(data)
+
+    def _endless(self, body=True):
+        # 沒有 Content-Length、永遠傳不完的主體
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.end_headers()
+        if body:
+            try:
+                while True: self.wfile.write(b"\0" * 65536)
+            except OSError:
+                pass
+
+    def do_HEAD(self):
+        if self.path == "/endless.png": self._endless(body=False)
+        else: self._reply(body=False)
+
+    def do_GET(self):
+        if self.path == "/endless.png": self._endless()
+        else: self._reply()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def results(local_server):
+    base = local_server(Handler)
+    return {r["url"].rsplit("/", 1)[1]: r for r in
+            check_urls([base + path for path in ROUTES], workers=4, timeout=0.5, session=make_session(4))}
+
+def test_only_definite_failures_are_dead(results):
+    assert results["ok.png"]["ok"] and not is_dead(results["ok.png"])
+    # CDN 以 application/octet-stream 回傳的 JPEG 依檔頭判斷為圖片
+    assert results["octet.jpg"]["ok"] and results["octet.jpg"]["sniffed_type"] == "image/jpeg"
+    assert {name for name, r in results.items() if is_dead(r)} == {"missing.png", "gone.png", "page.png"}
+    for name in ("busy.png", "limited.png", "slow.png"):
+        assert not results[name]["ok"] and not is_dead(results[name])
+
+def test_transient_errors_keep_previous_status(results, tmp_path):
+    path = str(tmp_path / "image_health.csv")
+    previous = [dict(r, ok=True, status=200, content_type="image/png", error="") for r in results.values()]
+    write_report(previous, path)
+    assert dead_urls(path) == set()
+
+    write_report(merge_results(list(results.values()), read_report(path)), path)
+    report = read_report(path)
+    assert {url.rsplit("/", 1)[1] for url in dead_urls(path)} == {"missing.png", "gone.png", "page.png"}
+    assert report[results["busy.png"]["url"]]["status"] == "200"
+    assert report[results["slow.png"]["url"]]["ok"] == "True"
+
+def test_transient_errors_without_history_are_not_dead(results, tmp_path):
+    path = str(tmp_path / "image_health.csv")
+    write_report(merge_results(list(results.values()), {}), path)
+    df = pd.DataFrame({"image_url": [r["url"] for r in results.values()]})
+    replaced = replace_dead_images(df, "default.jpg", path)["image_url"].tolist()
+    assert replaced.count("default.jpg") == 3
+    for name in ("ok.png", "busy.png", "limited.png", "slow.png", "octet.jpg"):
+        assert results[name]["url"] in replaced
+
+def test_body_without_length_is_read_up_to_the_limit(local_server):
+    base = local_server(Handler)
+    start = time.perf_counter()
+    record = check_url(make_session(1), base + "/endless.png", timeout=2)
+    assert record["ok"] and record["bytes"] == f"≥{MAX_BODY}"
+    assert time.perf_counter() - start < 5
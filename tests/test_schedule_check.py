@@ -0,0 +1,28 @@
+import datetime
+
+import pandas as pd
+
+from schedule_check import ScheduleChecker
+
+# 兩個週一公休的夜市 (0=週一)
+MARKETS = pd.DataFrame({
+    "name": ["瑞豐夜市", "凱旋夜市"],
+    "days": ["1,2,3,4,5,6", "1,2,3,4,5,6"],
+    "time": ["18:00~24:00", "18:00~02:00"],
+})
+
+def day_items():
+    return [{"Name": "瑞豐夜市", "Start": "18:00", "End": "19:30"},
+            {"Name": "凱旋夜市", "Start": "20:00", "End": "21:30"}]
+
+def kinds(issues):
+    return [[kind for kind, _ in item] for item in issues]
+
+def test_without_date_only_hours_are_checked_for_every_market():
+    assert kinds(ScheduleChecker(MARKETS).check_day(day_items())) == [[], []]
+
+def test_closed_day_is_reported_for_every_market():
+    monday = datetime.date(2024, 1, 1)
+    issues = ScheduleChecker(MARKETS).check_day(day_items(), monday)
+    assert kinds(issues) == [["closed"], ["closed"]]
+    assert all("週一公休" in msg for item in issues for _, msg in item)
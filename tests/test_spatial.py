@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+
+from spatial import DistanceMatrix
+
+def grid(n):
+    rng = np.random.default_rng(0)
+    return np.column_stack([22.6 + rng.random(n) * 0.2, 120.3 + rng.random(n) * 0.2])
+
+def test_sparse_neighbours_skip_self_with_duplicate_coordinates():
+    lat_lon = grid(20)
+    lat_lon[5] = lat_lon[6] = lat_lon[7] = lat_lon[3]
+    matrix = DistanceMatrix.build(lat_lon, dense_limit=0, max_neighbors=5)
+    for i in range(len(lat_lon)):
+        idx, _ = matrix.neighbors(i)
+        assert i not in idx
+        assert len(set(idx)) == len(idx)
+    assert set(matrix.neighbors(3)[0][:3]) == {5, 6, 7}
+    assert matrix.distance(3, 5) == 0.0
+
+def test_new_version_removes_stale_cache_files(tmp_path):
+    cache_dir = str(tmp_path)
+    DistanceMatrix.load_or_build(grid(10), cache_dir=cache_dir)
+    DistanceMatrix.load_or_build(grid(12), cache_dir=cache_dir, dense_limit=0)
+    files = sorted(os.listdir(cache_dir))
+    assert len(files) == 2 and all(f.endswith((".nbr_idx.npy", ".nbr_dist.npy")) for f in files)
+    assert len({f.split(".")[0] for f in files}) == 1
@@ -0,0 +1,63 @@
+import io
+from http.server import BaseHTTPRequestHandler
+
+from PIL import Image
+
+from static_map import (BACKGROUND, MAP_SIZE, TILE_SIZE, HttpTileSource, TileCache, TileFetcher, _day_key,
+                        _route_points, render_static_map)
+
+TILE_COLOR = (10, 200, 30)
+
+def make_handler(requests_seen, status=200):
+    tile = io.BytesIO()
+    Image.new("RGB", (TILE_SIZE, TILE_SIZE), TILE_COLOR).save(tile, format="PNG")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            if status != 200:
+                self.send_error(status)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.end_headers()
+            self.wfile.write(tile.getvalue())
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+def itinerary(days):
+    return [{"Name": f"stop {d}-{i}", "Day": d, "Start": f"{9 + i:02d}:00",
+             "latitude": 22.62 + 0.01 * d, "longitude": 120.28 + 0.01 * i} for d in days for i in range(2)]
+
+def test_days_sort_numerically():
+    assert list(_route_points(itinerary([10, 2, 1, 9]))) == [1, 2, 9, 10]
+    assert sorted(["10", 2, "1"], key=_day_key) == ["1", 2, "10"]
+
+def test_renders_from_local_tile_server_and_caches_tiles(local_server, tmp_path):
+    seen = []
+    source = HttpTileSource(local_server(make_handler(seen)) + "/{z}/{x}/{y}.png")
+    fetcher = TileFetcher(source, TileCache(str(tmp_path)))
+
+    png = render_static_map(itinerary([1, 2]), fetcher)
+    img = Image.open(io.BytesIO(png)).convert("RGB")
+    assert img.size == MAP_SIZE
+    assert img.getpixel((MAP_SIZE[0] // 2, 5)) == TILE_COLOR
+    assert seen and all(path.count("/") == 3 and path.endswith(".png") for path in seen)
+
+    # 第二次只讀快取
+    n_requests = len(seen)
+    assert render_static_map(itinerary([1, 2]), fetcher) == png
+    assert len(seen) == n_requests
+
+def test_tile_server_errors_fall_back_to_background(local_server, tmp_path):
+    seen = []
+    source = HttpTileSource(local_server(make_handler(seen, status=500)) + "/{z}/{x}/{y}.png")
+    fetcher = TileFetcher(source, TileCache(str(tmp_path)), workers=1)
+
+    img = Image.open(io.BytesIO(render_static_map(itinerary([1]), fetcher))).convert("RGB")
+    assert img.getpixel((MAP_SIZE[0] // 2, 5)) == BACKGROUND
+    # 第一個錯誤之後不再向伺服器要其餘圖磚
+    assert len(seen) == 1
+    assert len(fetcher.cache) == 0
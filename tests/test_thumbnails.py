@@ -0,0 +1,65 @@
+import io
+import time
+from http.server import BaseHTTPRequestHandler
+
+from PIL import Image
+
+from thumbnails import NEGATIVE_TTL, RETRY_TTL, ThumbnailStore, make_session
+
+def jpeg():
+    out = io.BytesIO()
+    Image.new("RGB", (800, 600), (200, 30, 30)).save(out, format="JPEG")
+    return out.getvalue()
+
+# 路徑 -> (狀態碼, Content-Type, 內容)
+ROUTES = {
+    "/photo.jpg": (200, "image/jpeg", jpeg()),
+    "/missing.jpg": (404, "text/html", b"not found"),
+    "/page.jpg": (200, "text/html", b"<html></html>"),
+    "/busy.jpg": (503, "text/html", b"busy"),
+}
+
+def make_handler(seen):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen.append(self.path)
+            status, content_type, data = ROUTES[self.path]
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+def expires_in(store, url):
+    with store._lock:
+        row = store._conn.execute("SELECT expires FROM urls WHERE url = ?", (url,)).fetchone()
+    return row[0] - time.time()
+
+def test_only_definite_failures_are_cached_for_a_day(local_server, tmp_path):
+    seen = []
+    base = local_server(make_handler(seen))
+    store = ThumbnailStore(str(tmp_path / "thumbs"), ":memory:", session=make_session(2), timeout=2)
+
+    photo = store.get(base + "/photo.jpg")
+    assert photo != store.placeholder and Image.open(photo).size == (480, 360)
+    for path in ("/missing.jpg", "/page.jpg", "/busy.jpg"):
+        assert store.get(base + path) == store.placeholder
+
+    assert expires_in(store, base + "/missing.jpg") > NEGATIVE_TTL - 60
+    assert expires_in(store, base + "/page.jpg") > NEGATIVE_TTL - 60
+    assert 0 < expires_in(store, base + "/busy.jpg") <= RETRY_TTL
+
+    # 快取期限內都不再向伺服器要
+    n_requests = len(seen)
+    store.get_many([base + p for p in ROUTES])
+    assert len(seen) == n_requests
+
+def test_connection_error_is_retried_soon(tmp_path):
+    store = ThumbnailStore(str(tmp_path / "thumbs"), ":memory:", session=make_session(1), timeout=1)
+    url = "http://127.0.0.1:9/unreachable.jpg"
+    assert store.get(url) == store.placeholder
+    assert 0 < expires_in(store, url) <= RETRY_TTL
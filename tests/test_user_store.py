@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+
+from user_store import UserStore, WriteBehindWriter
+
+class SlowStore(UserStore):
+    """寫入前先等待，讓兩次 flush 的時間重疊"""
+
+    def write_user_payload(self, username, payload, expected_version=None):
+        time.sleep(0.2)
+        return super().write_user_payload(username, payload, expected_version)
+
+def test_overlapping_flushes_of_one_session_do_not_conflict(tmp_path):
+    store = SlowStore(str(tmp_path / "users.sqlite"))
+    store.create_user("alice", "pw")
+    writer = WriteBehindWriter(store, interval=60)
+
+    # 計時器 flush 寫入中時，同一個分頁又排入新狀態並在換頁時 flush (仍帶著舊版本 0)
+    writer.enqueue("tab", "alice", {"budget": 1}, 0)
+    timer_flush = threading.Thread(target=writer.flush)
+    timer_flush.start()
+    time.sleep(0.05)
+    writer.enqueue("tab", "alice", {"budget": 2}, 0)
+    writer.flush(session_id="tab")
+    timer_flush.join()
+
+    user = store.get_user("alice")
+    assert writer.pop_conflict("tab") is None
+    assert (user["version"], user["data"]) == (2, {"budget": 2})
+    assert writer.current_version("tab", 0) == 2
+    assert writer.stats()["dropped"] == 0
+
+def test_other_session_with_stale_version_conflicts(tmp_path):
+    store = UserStore(str(tmp_path / "users.sqlite"))
+    store.create_user("alice", "pw")
+    writer = WriteBehindWriter(store, interval=60)
+
+    writer.enqueue("a", "alice", {"budget": 1}, 0)
+    writer.flush(session_id="a")
+    writer.enqueue("b", "alice", {"budget": 9}, 0)
+    writer.flush(session_id="b")
+
+    assert writer.pop_conflict("b") == 1
+    assert store.get_user("alice")["data"] == {"budget": 1}
+
+def test_concurrent_migrations_import_once(tmp_path):
+    json_path = tmp_path / "users_db.json"
+    json_path.write_text(json.dumps({
+        "alice": {"password": "pw", "data": {"budget": 1}, "history": {"trip": {"saved_at": "2024-01-01"}}},
+        "bob": {"password": "pw2", "data": {}},
+    }), encoding="utf-8")
+    db_path = str(tmp_path / "users.sqlite")
+    stores = [UserStore(db_path) for _ in range(4)]
+    barrier = threading.Barrier(len(stores))
+    results, errors = [], []
+
+    def migrate(store):
+        barrier.wait()
+        try:
+            results.append(store.migrate_from_json(str(json_path)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=migrate, args=(s,)) for s in stores]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert errors == []
+    assert sorted(results) == [0, 0, 0, 2]
+    assert not json_path.exists() and (tmp_path / "users_db.json.migrated").exists()
+    assert stores[0].get_user("alice")["data"] == {"budget": 1}
+    assert list(stores[0].get_history("alice")) == ["trip"]
@@ -0,0 +1,225 @@
+"""
+景點照片縮圖快取
+
+卡片上的 image_url 多半是第三方的原尺寸照片 (有些 1920x1080)，每次 rerun 瀏覽器都要重新下載。
+ThumbnailStore 只在第一次用到時下載一次 (共用連線池)，縮成小圖後存到 data/.cache/thumbs/，
+之後 st.image 直接使用本機檔案。
+
+- 縮圖檔名為原始圖片內容的 SHA-256 + 尺寸，不同網址的同一張圖只存一份
+- 網址 -> 縮圖 的對照存在 SQLite；確定失效 (404 / 410、不是圖片) 的網址記錄為 negative (保存 1 天)，改用預設圖；
+  逾時、連線錯誤、5xx 等暫時性錯誤只記錄幾分鐘，之後重試
+- 縮圖總大小超過上限時依最後使用時間 (LRU) 刪除
+"""
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageDraw, ImageFont, UnidentifiedImageError
+from requests.adapters import HTTPAdapter
+
+from data_cache import CACHE_DIR
+
+THUMB_DIR = os.path.join(CACHE_DIR, "thumbs")
+THUMB_DB_FILE = os.path.join(CACHE_DIR, "thumbs.sqlite")
+THUMB_SIZE = 480                      # 縮圖最長邊 (px)
+THUMB_QUALITY = 80
+MAX_BYTES = 100 * 1024 * 1024         # 縮圖總大小上限
+MAX_DOWNLOAD = 15 * 1024 * 1024       # 單張原圖的下載上限
+POSITIVE_TTL = 30 * 24 * 3600         # 成功的網址 30 天後重新確認
+NEGATIVE_TTL = 24 * 3600              # 確定失效的網址 1 天後重試
+RETRY_TTL = 5 * 60                    # 暫時性錯誤 5 分鐘後重試
+DEAD_STATUSES = (404, 410)            # 視為確定失效的狀態碼 (與 image_health 相同)
+FETCH_TIMEOUT = 8
+FETCH_WORKERS = 8
+USER_AGENT = "kaohsiung_travel_planner_app_v1"
+
+def make_session(pool_size=FETCH_WORKERS):
+    """共用連線池的 requests.Session (同一個圖床的多張圖片重用連線)"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+def make_thumbnail(data, max_side=THUMB_SIZE):
+    """原始圖片 bytes -> JPEG 縮圖 bytes (不是圖片時拋出 ValueError)"""
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (max_side, max_side))   # JPEG 解碼時直接縮小，省記憶體
+        img = img.convert("RGB")
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError(f"not an image: {e}") from e
+    img.thumbnail((max_side, max_side))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+    return out.getvalue()
+
+class ThumbnailStore:
+    """縮圖快取 (執行緒安全)；get() 回傳可直接交給 st.image 的本機檔案路徑"""
+
+    def __init__(self, directory=THUMB_DIR, db_path=THUMB_DB_FILE, max_bytes=MAX_BYTES,
+                 session=None, timeout=FETCH_TIMEOUT, workers=FETCH_WORKERS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.session = session or make_session(workers)
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        with self._lock, self._conn:
+            if db_path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS urls (
+                    url      TEXT NOT NULL,
+                    size     INTEGER NOT NULL,
+                    file     TEXT,
+                    expires  REAL NOT NULL,
+                    PRIMARY KEY (url, size)
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    file      TEXT PRIMARY KEY,
+                    bytes     INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_files_last_used ON files(last_used)")
+        self.placeholder = self._make_placeholder()
+
+    def _make_placeholder(self):
+        path = os.path.join(self.directory, "placeholder.jpg")
+        if not os.path.exists(path):
+            img = Image.new("RGB", (THUMB_SIZE, THUMB_SIZE * 2 // 3), (225, 225, 220))
+            draw = ImageDraw.Draw(img)
+            draw.text((img.width / 2, img.height / 2), "No image", fill=(140, 140, 135),
+                      font=ImageFont.load_default(size=28), anchor="mm")
+            img.save(path, format="JPEG", quality=THUMB_QUALITY)
+        return path
+
+    # --- 查詢 ---
+    def _lookup(self, url, size):
+        """回傳 (是否命中, 檔案路徑或 None)"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT file, expires FROM urls WHERE url = ? AND size = ?", (url, size)).fetchone()
+            if row is None or row[1] < now: return False, None
+            if row[0] is None: return True, None
+            path = os.path.join(self.directory, row[0])
+            if not os.path.exists(path): return False, None
+            self._conn.execute("UPDATE files SET last_used = ? WHERE file = ?", (now, row[0]))
+        return True, path
+
+    def get(self, url, size=THUMB_SIZE):
+        """image_url -> 本機縮圖路徑；空網址或無法下載時回傳預設圖"""
+        url = str(url or "").strip()
+        if not url.startswith(("http://", "https://")): return self.placeholder
+        hit, path = self._lookup(url, size)
+        if hit:
+            self.hits += 1
+            return path or self.placeholder
+        self.misses += 1
+        return self._fetch(url, size) or self.placeholder
+
+    def get_many(self, urls, size=THUMB_SIZE):
+        """一次取得多張縮圖 (未快取的平行下載)，回傳 {網址: 路徑}"""
+        urls = list(dict.fromkeys(str(u or "").strip() for u in urls))
+        result, missing = {}, []
+        for url in urls:
+            if not url.startswith(("http://", "https://")):
+                result[url] = self.placeholder
+                continue
+            hit, path = self._lookup(url, size)
+            if hit:
+                self.hits += 1
+                result[url] = path or self.placeholder
+            else:
+                missing.append(url)
+        if missing:
+            self.misses += len(missing)
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for url, path in zip(missing, pool.map(lambda u: self._fetch(u, size), missing)):
+                    result[url] = path or self.placeholder
+        return result
+
+    # --- 下載與寫入 ---
+    def _download(self, url):
+        with self.session.get(url, timeout=self.timeout, stream=True) as resp:
+            resp.raise_for_status()
+            chunks, total = [], 0
+            for chunk in resp.iter_content(64 * 1024):
+                total += len(chunk)
+                if total > MAX_DOWNLOAD: raise ValueError("image too large")
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _fetch(self, url, size):
+        """下載並存成縮圖，回傳路徑；失敗時記錄 negative (期限依失敗種類) 並回傳 None"""
+        try:
+            data = self._download(url)
+            name = f"{hashlib.sha256(data).hexdigest()}_{size}.jpg"
+            path = os.path.join(self.directory, name)
+            if not os.path.exists(path):
+                thumb = make_thumbnail(data, size)
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(thumb)
+                os.replace(tmp, path)
+        except requests.HTTPError as e:
+            gone = e.response is not None and e.response.status_code in DEAD_STATUSES
+            return self._fail(url, size, NEGATIVE_TTL if gone else RETRY_TTL)
+        except ValueError:
+            # 不是圖片 / 超過下載上限
+            return self._fail(url, size, NEGATIVE_TTL)
+        except (requests.RequestException, OSError):
+            # 逾時、連線錯誤、本機寫入失敗：短時間後重試
+            return self._fail(url, size, RETRY_TTL)
+        self._record(url, size, name, os.path.getsize(path))
+        return path
+
+    def _fail(self, url, size, ttl):
+        self.failures += 1
+        self._record(url, size, None, ttl=ttl)
+        return None
+
+    def _record(self, url, size, name, nbytes=0, ttl=NEGATIVE_TTL):
+        now = time.time()
+        with self._lock, self._conn:
+            if name is None:
+                self._conn.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, NULL, ?)", (url, size, now + ttl))
+                return
+            self._conn.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)", (url, size, name, now + POSITIVE_TTL))
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (name, nbytes, now))
+            self._evict(keep=name)
+
+    def _evict(self, keep=None):
+        """縮圖總大小超過上限時，刪除最久未使用的檔案 (對應的網址下次會重新下載)；keep 為剛寫入的檔案"""
+        total = self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM files").fetchone()[0]
+        if total <= self.max_bytes: return
+        for name, nbytes in self._conn.execute("SELECT file, bytes FROM files ORDER BY last_used").fetchall():
+            if total <= self.max_bytes: break
+            if name == keep: continue
+            self._conn.execute("DELETE FROM files WHERE file = ?", (name,))
+            self._conn.execute("DELETE FROM urls WHERE file = ?", (name,))
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= nbytes
+
+    def stats(self):
+        with self._lock:
+            n_files, n_bytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM files").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "failures": self.failures,
+                "files": n_files, "bytes": n_bytes}
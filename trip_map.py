@@ -0,0 +1,101 @@
+"""
+行程地圖 (folium)
+
+- 行程 / 焦點景點 / 全部景點圖層依內容算出簽章，相同簽章直接重用已 render 過的 folium.Map，
+  rerun 時不必重新建立標記與產生 HTML
+- 行程點數多時改用 MarkerCluster 分群；全部景點圖層用 FastMarkerCluster，
+  座標以單一 JSON 陣列送到瀏覽器端再建立標記 (不是一個標記一個 Python 物件)
+"""
+import hashlib
+import json
+from collections import OrderedDict
+
+import folium
+import numpy as np
+import pandas as pd
+from folium.plugins import FastMarkerCluster, MarkerCluster
+
+CLUSTER_THRESHOLD = 30   # 行程點數超過此數量時分群顯示
+MAP_CACHE_SIZE = 8       # 每個使用者保留的地圖數
+DAY_COLORS = ["blue", "green", "purple", "orange", "darkred", "cadetblue", "darkgreen", "pink"]
+
+# FastMarkerCluster 在瀏覽器端建立標記：row = [緯度, 經度, 名稱]
+_CATALOG_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 6, color: "#888", fillOpacity: 0.7});
+    marker.bindTooltip(row[2]);
+    return marker;
+};
+"""
+
+def _valid(lat, lon):
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return False
+    return not (np.isnan(lat) or np.isnan(lon) or (lat == 0 and lon == 0))
+
+def catalog_points(df):
+    """景點資料 -> [[緯度, 經度, 名稱], ...] (略過沒有座標的列)"""
+    if df is None or df.empty: return []
+    lat = pd.to_numeric(df['latitude'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(df['longitude'], errors='coerce').to_numpy(dtype=float)
+    ok = ~(np.isnan(lat) | np.isnan(lon) | ((lat == 0) & (lon == 0)))
+    names = df['name'].astype(str).to_numpy()
+    return [[round(float(a), 6), round(float(b), 6), n] for a, b, n in zip(lat[ok], lon[ok], names[ok])]
+
+def map_signature(center, items, focus=None, catalog=None):
+    """地圖內容簽章：中心點、行程 (名稱 / 天 / 座標)、焦點景點、全部景點圖層"""
+    payload = {
+        "center": [round(float(c), 5) for c in center],
+        "items": [(x.get('Name'), x.get('Day'), x.get('latitude'), x.get('longitude')) for x in items
+                  if _valid(x.get('latitude'), x.get('longitude'))],
+        "focus": (focus.get('name'), focus.get('lat'), focus.get('lon')) if focus else None,
+        "catalog": len(catalog) if catalog else 0,
+    }
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+def build_map(center, items, focus=None, catalog=None, zoom_start=12):
+    """建立並 render 地圖；catalog 為 catalog_points() 的結果 (None 表示不顯示全部景點)"""
+    m = folium.Map(location=list(center), zoom_start=zoom_start)
+
+    if catalog:
+        FastMarkerCluster(catalog, callback=_CATALOG_CALLBACK, name="全部景點").add_to(m)
+
+    # 行程 (依天數上色)；點數多時分群
+    points = [x for x in items if _valid(x.get('latitude'), x.get('longitude'))]
+    layer = MarkerCluster(name="行程").add_to(m) if len(points) > CLUSTER_THRESHOLD else m
+    for item in points:
+        day = item.get('Day', 1)
+        color = DAY_COLORS[(int(day) - 1) % len(DAY_COLORS)] if str(day).isdigit() else "blue"
+        folium.Marker([float(item['latitude']), float(item['longitude'])], popup=item['Name'],
+                      tooltip=f"Day {day} {item['Name']}", icon=folium.Icon(color=color, icon="info-sign")).add_to(layer)
+
+    # 焦點景點 (紅色)
+    if focus and _valid(focus.get('lat'), focus.get('lon')):
+        folium.Marker([float(focus['lat']), float(focus['lon'])], popup=focus['name'], tooltip=f"📍 {focus['name']}",
+                      icon=folium.Icon(color="red", icon="star")).add_to(m)
+
+    m.get_root().render()
+    return m
+
+class MapCache:
+    """簽章 -> 已 render 的 folium.Map (LRU)"""
+
+    def __init__(self, size=MAP_CACHE_SIZE):
+        self.size = size
+        self._maps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, center, items, focus=None, catalog=None):
+        key = map_signature(center, items, focus, catalog)
+        m = self._maps.get(key)
+        if m is not None:
+            self._maps.move_to_end(key)
+            self.hits += 1
+            return m
+        self.misses += 1
+        m = self._maps[key] = build_map(center, items, focus, catalog)
+        if len(self._maps) > self.size: self._maps.popitem(last=False)
+        return m
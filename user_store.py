@@ -0,0 +1,305 @@
+"""
+使用者資料庫 (SQLite，WAL 模式)
+
+取代整份改寫的 users_db.json：每位使用者一列、每個歷史行程一列，
+更新時只寫入變動的那一列。第一次啟動時會自動從舊的 JSON 檔匯入一次。
+
+多個工作程序 / 副本共用同一個資料庫檔案：
+- 每筆寫入都是單一 SQLite 交易 (原子性，當機不會留下寫一半的資料)，跨程序由 SQLite 檔案鎖協調
+- 使用者的行程狀態帶有 version 欄位 (樂觀鎖)，以過期版本覆寫時拋出 VersionConflict
+
+WriteBehindWriter: 目前行程狀態的延遲寫入層，短時間內的多次修改合併為一次寫入
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class VersionConflict(Exception):
+    """使用者資料已被其他工作階段/副本更新 (樂觀鎖版本不符)"""
+
+    def __init__(self, username, expected, current):
+        super().__init__(f"{username}: expected version {expected}, found {current}")
+        self.username = username
+        self.expected = expected
+        self.current = current
+
+def _json_default(value):
+    # trip_info 的 start_date 可能仍是 datetime.date，統一轉為字串
+    return str(value)
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=_json_default)
+
+def _loads(text, default=None):
+    if text is None: return default
+    try: return json.loads(text)
+    except ValueError: return default
+
+class UserStore:
+    """使用者帳號、目前行程狀態 (data) 與歷史行程 (history) 的儲存區"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    username   TEXT PRIMARY KEY,
+                    password   TEXT NOT NULL,
+                    data       TEXT NOT NULL DEFAULT '{}',
+                    version    INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )""")
+            # 舊版資料表沒有 version 欄位時補上
+            columns = [r[1] for r in self._conn.execute("PRAGMA table_info(users)")]
+            if "version" not in columns:
+                self._conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+                    name     TEXT NOT NULL,
+                    snapshot TEXT NOT NULL,
+                    saved_at TEXT,
+                    PRIMARY KEY (username, name)
+                )""")
+
+    # --- 帳號 ---
+    def get_user(self, username):
+        """回傳 {"password", "data", "version"}，使用者不存在時回傳 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT password, data, version FROM users WHERE username = ?", (username,)
+            ).fetchone()
+        if row is None: return None
+        return {"password": row[0], "data": _loads(row[1], {}), "version": row[2]}
+
+    def create_user(self, username, password):
+        """註冊新帳號；帳號已存在時回傳 False"""
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO users (username, password, data, updated_at) VALUES (?, ?, '{}', ?)",
+                (username, password, time.time()))
+        return cur.rowcount == 1
+
+    def set_password(self, username, new_password):
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "UPDATE users SET password = ?, updated_at = ? WHERE username = ?",
+                (new_password, time.time(), username))
+        return cur.rowcount == 1
+
+    def update_user_data(self, username, data_value, expected_version=None):
+        """
+        覆寫使用者目前的行程狀態 (只寫入該使用者一列)
+        expected_version 不為 None 時，只有資料庫版本相同才寫入，否則拋出 VersionConflict
+        回傳寫入後的新版本；使用者不存在時回傳 None
+        """
+        return self.write_user_payload(username, _dumps(data_value), expected_version)
+
+    def write_user_payload(self, username, payload, expected_version=None):
+        """同 update_user_data，payload 為已序列化的 JSON 字串"""
+        with self._lock, self._conn:
+            if expected_version is None:
+                cur = self._conn.execute(
+                    "UPDATE users SET data = ?, version = version + 1, updated_at = ? WHERE username = ?",
+                    (payload, time.time(), username))
+            else:
+                cur = self._conn.execute(
+                    "UPDATE users SET data = ?, version = version + 1, updated_at = ? "
+                    "WHERE username = ? AND version = ?",
+                    (payload, time.time(), username, expected_version))
+            row = self._conn.execute("SELECT version FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None: return None
+        if cur.rowcount == 0: raise VersionConflict(username, expected_version, row[0])
+        return row[0]
+
+    # --- 歷史行程 ---
+    def get_history(self, username):
+        """回傳 {存檔名稱: 快照}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, snapshot FROM history WHERE username = ?", (username,)
+            ).fetchall()
+        return {name: _loads(snapshot, {}) for name, snapshot in rows}
+
+    def save_history(self, username, name, snapshot):
+        with self._lock, self._conn:
+            if not self._conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+                return False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO history (username, name, snapshot, saved_at) VALUES (?, ?, ?, ?)",
+                (username, name, _dumps(snapshot), snapshot.get("saved_at")))
+        return True
+
+    def delete_history(self, username, name):
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "DELETE FROM history WHERE username = ? AND name = ?", (username, name))
+        return cur.rowcount == 1
+
+    # --- 舊資料匯入 ---
+    def migrate_from_json(self, json_path):
+        """
+        一次性匯入舊版 users_db.json (僅在資料庫沒有任何使用者時執行)
+        匯入後將 JSON 改名為 .migrated，回傳匯入的使用者數
+        多個程序/副本同時啟動時，檢查與匯入在同一個 BEGIN IMMEDIATE 交易內，只有一個會匯入
+        """
+        if not os.path.exists(json_path): return 0
+        try:
+            with open(json_path, "r", encoding="utf-8") as f: db = json.load(f)
+        except (OSError, ValueError) as e:
+            # 另一個程序剛匯入並改名時也會走到這裡
+            print(f"User DB migration skipped: {e}")
+            return 0
+
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone(): return 0
+            for username, entry in db.items():
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO users (username, password, data, updated_at) VALUES (?, ?, ?, ?)",
+                    (username, entry.get("password", ""), _dumps(entry.get("data") or {}), now))
+                for name, snapshot in (entry.get("history") or {}).items():
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO history (username, name, snapshot, saved_at) VALUES (?, ?, ?, ?)",
+                        (username, name, _dumps(snapshot), snapshot.get("saved_at")))
+        try:
+            os.replace(json_path, json_path + ".migrated")
+        except FileNotFoundError:
+            pass
+        return len(db)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class WriteBehindWriter:
+    """
+    目前行程狀態 (users.data) 的延遲寫入層
+    - enqueue() 只記錄該工作階段 (瀏覽器分頁) 的最新狀態，interval 秒後統一寫入一次；
+      只有同一個工作階段的修改會合併，同一帳號的不同分頁各自寫入
+    - 排入時立即序列化成 JSON 快照，之後 session_state 的修改不會影響待寫入的內容
+    - 每次排入都帶著該工作階段持有的版本 (樂觀鎖)；寫入成功後以 current_version() 取回新版本，
+      其他分頁/副本已更新時放棄這次寫入並記錄衝突，由該工作階段以 pop_conflict() 取得後重新載入
+    - flush() 可在登出/換頁時立即寫入；程式結束時也會自動 flush
+    - 同一個工作階段的 flush (計時器與換頁) 依序執行：取出待寫入狀態、解析版本、寫入、記錄新版本
+      都在該工作階段的鎖內完成，後一次 flush 一定看得到前一次寫入後的版本
+    """
+
+    def __init__(self, store, interval=3.0):
+        self.store = store
+        self.interval = interval
+        self.requested = 0
+        self.written = 0
+        self.dropped = 0
+        self._pending = {}     # session_id -> (username, payload, expected_version)
+        self._acked = {}       # session_id -> {寫入時依據的版本: 寫入後的版本}
+        self._conflicts = {}   # session_id -> 資料庫目前版本
+        self._session_locks = {}   # session_id -> 該工作階段的 flush 鎖
+        self._timer = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def enqueue(self, session_id, username, data_value, expected_version):
+        # 在呼叫端 (腳本執行緒) 序列化，計時器執行緒只寫入字串
+        payload = _dumps(data_value)
+        with self._lock:
+            self._pending[session_id] = (username, payload, expected_version)
+            self.requested += 1
+            self._schedule()
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.interval, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def _resolve(self, session_id, version):
+        # 這個工作階段自己已寫入較新的版本時 (session_state 還沒取回)，沿用最新的版本
+        chain = self._acked.get(session_id, {})
+        while version in chain: version = chain[version]
+        return version
+
+    def current_version(self, session_id, version):
+        """工作階段持有 version 時，經過它自己已完成的寫入後的最新版本"""
+        with self._lock:
+            return self._resolve(session_id, version)
+
+    def forget(self, session_id):
+        """登入/登出/重新載入時清除該工作階段的寫入紀錄 (待寫入的狀態不受影響)"""
+        with self._lock:
+            self._acked.pop(session_id, None)
+            self._conflicts.pop(session_id, None)
+
+    def is_dirty(self, session_id=None):
+        with self._lock:
+            return bool(self._pending) if session_id is None else session_id in self._pending
+
+    def pop_conflict(self, session_id):
+        """取出該工作階段的版本衝突 (資料庫目前版本)，沒有衝突時回傳 None"""
+        with self._lock:
+            return self._conflicts.pop(session_id, None)
+
+    def flush(self, session_id=None, username=None):
+        """
+        寫入待處理的狀態，回傳實際寫入筆數
+        指定 session_id 只寫該工作階段；指定 username 寫入該帳號所有分頁；都不指定時寫入全部
+        """
+        with self._lock:
+            if session_id is not None:
+                keys = [session_id] if session_id in self._pending else []
+            elif username is not None:
+                keys = [k for k, (user, _, _) in self._pending.items() if user == username]
+            else:
+                keys = list(self._pending)
+            locks = [self._session_locks.setdefault(k, threading.Lock()) for k in keys]
+
+        done = 0
+        for sid, session_lock in zip(keys, locks):
+            with session_lock:
+                # 取得鎖之後才取出：另一個 flush 已寫入時，這裡會拿到較新的狀態 (或已沒有待寫入的狀態)
+                with self._lock:
+                    entry = self._pending.pop(sid, None)
+                    if entry is None: continue
+                    user, payload, expected = entry
+                    expected = self._resolve(sid, expected)
+                try:
+                    version = self.store.write_user_payload(user, payload, expected_version=expected)
+                    done += 1
+                    if version is not None:
+                        with self._lock:
+                            chain = self._acked.setdefault(sid, {})
+                            chain[expected] = version
+                            while len(chain) > 16: chain.pop(next(iter(chain)))
+                except VersionConflict as e:
+                    with self._lock:
+                        self._conflicts[sid] = e.current
+                        self.dropped += 1
+        with self._lock:
+            self.written += done
+        return done
+
+    @property
+    def saved_writes(self):
+        """因合併而省下的寫入次數 (仍待寫入及因衝突放棄的不計)"""
+        with self._lock:
+            return self.requested - self.written - self.dropped - len(self._pending)
+
+    def stats(self):
+        with self._lock:
+            return {"requested": self.requested, "written": self.written,
+                    "pending": len(self._pending), "dropped": self.dropped,
+                    "saved": self.requested - self.written - self.dropped - len(self._pending)}
@@ -3,10 +3,24 @@ import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 import streamlit as st
 import os
+import json
+import hashlib
 import requests
 import datetime
+import re
+from collections import namedtuple, deque
 from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
+from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
+from data_cache import read_cached_frame, write_cached_frame
+from spatial import SpatialIndex, DistanceMatrix
+from geocoding import GeocodeCache, Gazetteer, GEOCODE_DEADLINE, geocode_candidates
+from schedule_check import ScheduleChecker
+from search_index import SearchIndex
+from opening_hours import add_open_hours
+from trip_map import catalog_points
+from thumbnails import THUMB_SIZE, ThumbnailStore
+from image_health import replace_dead_images
+from static_map import DEFAULT_TILE_URL, MAP_SIZE, DirectoryTileSource, HttpTileSource, TileCache, TileFetcher, render_static_map
 
 # 定義標籤映射 (將 CSV 雜亂標籤歸類為標準類別)
 TAG_MAPPING = {
@@ -24,16 +38,88 @@ TAG_MAPPING = {
     "🏘️ 眷村故事": ["眷村", "軍事", "老屋", "日式", "海軍", "空軍", "陸軍"]
 }
 
-@st.cache_data
-def load_data():
-    """讀取景點資料庫 CSV 檔案"""
-    file_path = 'data/data.csv'
-    try:
-        df = pd.read_csv(file_path, encoding='utf-8')
-    except Exception as e:
-        st.error(f"無法讀取資料庫，請確認 '{file_path}' 是否存在。錯誤: {e}")
-        return pd.DataFrame()
+TAG_CATEGORIES = list(TAG_MAPPING.keys())
+
+def build_tag_automaton(mapping=TAG_MAPPING):
+    """
+    將 TAG_MAPPING 所有關鍵字編成 Aho-Corasick 自動機
+    回傳 (goto, fail, out)：out[state] 為該狀態命中的類別位元遮罩 (已合併 fail 鏈)
+    """
+    goto, fail, out = [{}], [0], [0]
+    for bit, keywords in enumerate(mapping.values()):
+        for kw in keywords:
+            state = 0
+            for ch in kw:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({}); fail.append(0); out.append(0)
+                state = nxt
+            out[state] |= 1 << bit
+
+    # BFS 建立 fail 連結
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for ch, nxt in goto[state].items():
+            queue.append(nxt)
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            out[nxt] |= out[fail[nxt]]
+    return goto, fail, out
+
+_TAG_AUTOMATON = build_tag_automaton()
+
+def match_tag_mask(text, automaton=_TAG_AUTOMATON):
+    """掃描一段文字，回傳其中出現的 TAG_MAPPING 類別位元遮罩"""
+    goto, fail, out = automaton
+    state, mask = 0, 0
+    for ch in text:
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        mask |= out[state]
+    return mask
+
+def classify_tag_masks(names, tags=None):
+    """
+    一次掃描所有景點的名稱與標籤，回傳每列的類別位元遮罩
+    各標籤以換行分隔，避免關鍵字跨越兩個標籤被誤判
+    """
+    if tags is None: tags = [''] * len(names)
+    masks = []
+    for name, tag_str in zip(names, tags):
+        parts = [t.strip() for t in str(tag_str).split(',')]
+        masks.append(match_tag_mask(str(name) + '\n' + '\n'.join(parts)))
+    return masks
 
+def mask_to_tags(mask):
+    """將類別位元遮罩轉回類別名稱列表 (依 TAG_MAPPING 順序)"""
+    return [c for bit, c in enumerate(TAG_CATEGORIES) if mask >> bit & 1]
+
+def masks_to_tag_lists(masks):
+    """批次將位元遮罩轉為類別列表 (相同遮罩只轉換一次)"""
+    lookup = {}
+    result = []
+    for m in masks:
+        m = int(m)
+        if m not in lookup: lookup[m] = mask_to_tags(m)
+        result.append(list(lookup[m]))
+    return result
+
+DATA_FILE = 'data/data.csv'
+# 景點沒有可用圖片時留空 (卡片顯示「📷 無圖」)
+DEFAULT_ATTRACTION_IMAGE = ""
+DEFAULT_NIGHT_MARKET_IMAGE = "https://images.unsplash.com/photo-1528164344705-47542687000d?q=80&w=600&auto=format&fit=crop"
+
+# 資料整理邏輯的版本 (整理步驟或 TAG_MAPPING 變動時，二進位快取自動失效)
+PREP_VERSION = "2-" + hashlib.sha256(json.dumps(TAG_MAPPING, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+
+def prepare_data(df):
+    """補齊景點欄位並推導 tag_mask / mapped_tags"""
     if 'tags' in df.columns: df['tags'] = df['tags'].fillna('')
     if 'image_url' not in df.columns: df['image_url'] = ""
     if 'latitude' not in df.columns: df['latitude'] = 0.0
@@ -41,127 +127,313 @@ def load_data():
     if 'district' not in df.columns: df['district'] = "未分類"
     else: df['district'] = df['district'].fillna("未分類")
 
-    # 產生 mapped_tags
-    # 產生 mapped_tags
-    def get_mapped_tags(row):
-        mapped = set()
-        # 1. Check Tags
-        for tag in str(row['tags']).split(','):
-            t = tag.strip()
-            for category, keywords in TAG_MAPPING.items():
-                if t in keywords or any(k in t for k in keywords):
-                    mapped.add(category)
-        
-        # 2. Check Name (Keywords in Name)
-        # e.g. "旗山車站" contains "車站" -> matches 鐵道交通
-        name = str(row['name'])
-        for category, keywords in TAG_MAPPING.items():
-            if any(k in name for k in keywords):
-                mapped.add(category)
-                
-        return list(mapped)
-    
-    df['mapped_tags'] = df.apply(get_mapped_tags, axis=1)
+    # 產生 mapped_tags (名稱 + 標籤一次掃描，得到類別位元遮罩)
+    df['tag_mask'] = classify_tag_masks(df['name'], df['tags'] if 'tags' in df.columns else None)
+    df['mapped_tags'] = masks_to_tag_lists(df['tag_mask'])
     return df
 
+def read_data_frame(file_path=DATA_FILE, use_cache=True):
+    """
+    讀取並整理景點資料；快取新鮮時直接 memory map 讀取二進位檔
+    CSV 讀取失敗時拋出例外
+    """
+    df = read_cached_frame(file_path, PREP_VERSION) if use_cache else None
+    if df is not None:
+        df['mapped_tags'] = masks_to_tag_lists(df['tag_mask'])
+    else:
+        df = prepare_data(pd.read_csv(file_path, encoding='utf-8'))
+        # mapped_tags 可由 tag_mask 還原，不寫入快取
+        if use_cache: write_cached_frame(file_path, df.drop(columns=['mapped_tags']), PREP_VERSION)
+    # image_health.py 記錄為失效的圖片網址 (不寫入快取，重新檢查後即生效)
+    return replace_dead_images(df, DEFAULT_ATTRACTION_IMAGE)
+
 @st.cache_data
-def load_night_markets():
-    """讀取夜市資料庫 CSV"""
+def load_data():
+    """讀取景點資料庫 CSV 檔案"""
+    file_path = DATA_FILE
+    try:
+        return read_data_frame(file_path)
+    except Exception as e:
+        st.error(f"無法讀取資料庫，請確認 '{file_path}' 是否存在。錯誤: {e}")
+        return pd.DataFrame()
+
+def night_markets_path():
+    """夜市 CSV 路徑 (data 資料夾優先，找不到時退回根目錄)"""
     # [Fix] Point to the correct data folder
     file_path = os.path.join(os.path.dirname(__file__), "data", "night_markets.csv")
     
     if not os.path.exists(file_path):
         # Fallback to root if data folder version missing (backward compatibility)
         file_path = os.path.join(os.path.dirname(__file__), "night_markets.csv")
-        
+    return file_path
+
+def prepare_night_markets(df):
+    """補齊夜市欄位與預設圖片"""
+    if 'image_url' not in df.columns: df['image_url'] = ""
+    df['image_url'] = df['image_url'].fillna("")
+    
+    # [Fix] Ensure lat/lon columns exist
+    if 'latitude' not in df.columns: df['latitude'] = 0.0
+    if 'longitude' not in df.columns: df['longitude'] = 0.0
+    df['latitude'] = df['latitude'].fillna(0.0)
+    df['longitude'] = df['longitude'].fillna(0.0)
+    
+    # Apply default Taiwan Night Market Image to empty strings
+    df.loc[df['image_url'].str.strip() == "", 'image_url'] = DEFAULT_NIGHT_MARKET_IMAGE
+
+    # 營業日 / 營業時間預先轉為位元遮罩與分鐘數 (見 opening_hours.py)
+    return add_open_hours(df)
+
+def read_night_markets_frame(file_path=None, use_cache=True):
+    """讀取並整理夜市資料；快取新鮮時直接 memory map 讀取二進位檔"""
+    file_path = file_path or night_markets_path()
+    df = read_cached_frame(file_path, PREP_VERSION) if use_cache else None
+    if df is None:
+        df = prepare_night_markets(pd.read_csv(file_path))
+        if use_cache: write_cached_frame(file_path, df, PREP_VERSION)
+    return replace_dead_images(df, DEFAULT_NIGHT_MARKET_IMAGE)
+
+@st.cache_data
+def load_night_markets():
+    """讀取夜市資料庫 CSV"""
+    file_path = night_markets_path()
     if not os.path.exists(file_path):
         return pd.DataFrame()
         
     try:
-        df = pd.read_csv(file_path)
-        if 'image_url' not in df.columns: df['image_url'] = ""
-        df['image_url'] = df['image_url'].fillna("")
-        
-        # [Fix] Ensure lat/lon columns exist
-        if 'latitude' not in df.columns: df['latitude'] = 0.0
-        if 'longitude' not in df.columns: df['longitude'] = 0.0
-        df['latitude'] = df['latitude'].fillna(0.0)
-        df['longitude'] = df['longitude'].fillna(0.0)
-        
-        # Default Taiwan Night Market Image
-        default_img = "https://images.unsplash.com/photo-1528164344705-47542687000d?q=80&w=600&auto=format&fit=crop"
-        
-        # Apply default to empty strings
-        df.loc[df['image_url'].str.strip() == "", 'image_url'] = default_img
-        return df
+        return read_night_markets_frame(file_path)
     except Exception as e:
         print(f"Error loading night markets: {e}")
         return pd.DataFrame()
 
-def calculate_recommendations(df, user_prefs, specific_tags=[], days=1):
-    """計算推薦景點"""
-    if df.empty: return None
+@st.cache_resource
+def load_spatial_index():
+    """景點 + 夜市座標的空間索引 (最近 k 個 / 半徑查詢)"""
+    return SpatialIndex.from_frames(load_data(), load_night_markets())
 
-    # 1. 計算類別分數 (根據 mapped_tags)
-    def calculate_score(row):
-        score = 0
-        tags = row['mapped_tags']
-        
-        # 1. Attribute-based Scoring (Base Score from CSV columns 0~1)
-        # 屬性欄位: nature, culture, entertainment, food
-        
-        # 自然 (Nature) -> nature
-        score += row.get('nature', 0) * user_prefs.get('nature', 0.5)
-        
-        # 歷史/文化 (History) -> culture
-        score += row.get('culture', 0) * user_prefs.get('history', 0.5)
-        
-        # 玩樂/親子 (Fun) -> entertainment + activity
-        # Combine ent and activity for better coverage
-        fun_score = (row.get('entertainment', 0) + row.get('activity', 0)) / 2
-        score += fun_score * user_prefs.get('fun', 0.5)
-        
-        # 都市/美食 (Urban) -> food + entertainment
-        urban_score = (row.get('food', 0) + row.get('entertainment', 0)) / 2
-        score += urban_score * user_prefs.get('urban', 0.5)
-        
-        # 新潮流 (Trend) - No direct column, use Tags + partial Culture
-        if "🎨 藝文文創" in tags or "📸 網美打卡" in tags:
-             score += user_prefs.get('trend', 0.5)
-        
-        # 特定標籤加權 (來自使用者選取的 Pill Tags)
-        for t in specific_tags:
-            if t in tags:
-                score += 0.5
-        
-        return score
+@st.cache_resource
+def load_distance_matrix():
+    """所有景點 + 夜市的兩兩距離矩陣 (與 load_spatial_index() 的位置對應，memory map 快取)"""
+    return DistanceMatrix.load_or_build(load_spatial_index().lat_lon)
 
-    df['score'] = df.apply(calculate_score, axis=1)
-    
-    # 正規化分數
-    if df['score'].max() > 0:
-        df['similarity'] = df['score'] / df['score'].max()
+@st.cache_resource
+def get_thumbnail_store():
+    """景點照片的本機縮圖快取 (跨 session 共用)"""
+    return ThumbnailStore()
+
+def thumbnail(url, size=THUMB_SIZE):
+    """image_url -> 本機縮圖路徑 (給 st.image 用)；無法下載時為預設圖"""
+    return get_thumbnail_store().get(url, size)
+
+def prefetch_thumbnails(urls, size=THUMB_SIZE):
+    """列表顯示前先平行下載尚未快取的縮圖"""
+    return get_thumbnail_store().get_many([u for u in urls if u], size)
+
+@st.cache_data
+def load_catalog_points():
+    """地圖「顯示所有景點」圖層的座標列表"""
+    return catalog_points(load_data())
+
+@st.cache_resource
+def load_schedule_checker():
+    """行程時段檢查器 (重疊 / 交通時間 / 夜市營業日)，跨 rerun 共用每日檢查結果"""
+    return ScheduleChecker(load_night_markets())
+
+@st.cache_resource
+def load_search_index():
+    """自行選擇分頁的搜尋索引 (行政區 / 類別 bitset + 名稱與標籤的 n-gram 索引)"""
+    return SearchIndex(load_data(), TAG_CATEGORIES)
+
+def build_data_caches():
+    """建置步驟：重新整理兩份資料集並寫入二進位快取，回傳寫出的檔案路徑"""
+    written = []
+    for file_path, prepare, kwargs in [
+        (DATA_FILE, prepare_data, {'encoding': 'utf-8'}),
+        (night_markets_path(), prepare_night_markets, {}),
+    ]:
+        if not os.path.exists(file_path): continue
+        df = prepare(pd.read_csv(file_path, **kwargs))
+        if 'mapped_tags' in df.columns: df = df.drop(columns=['mapped_tags'])
+        path = write_cached_frame(file_path, df, PREP_VERSION)
+        if path: written.append(path)
+    return written
+
+# 評分用屬性欄位 (CSV 中 0~1 的數值欄)
+SCORE_ATTRS = ['nature', 'culture', 'entertainment', 'food', 'activity']
+# 新潮流 (Trend) 沒有對應欄位，改看這兩個標籤
+TREND_TAGS = ["🎨 藝文文創", "📸 網美打卡"]
+# 使用者選取的 Pill Tag 每命中一個的加分
+SPECIFIC_TAG_BONUS = 0.5
+# 推薦結果只保留卡片 / 自動排程用得到的欄位
+RECOMMENDATION_COLUMNS = ['id', 'name', 'district', 'latitude', 'longitude', 'image_url', 'mapped_tags']
+
+ScoreMatrix = namedtuple("ScoreMatrix", ["features", "categories", "cards"])
+
+def build_score_matrix(df):
+    """
+    預先計算評分矩陣 (每列一個景點)
+    欄位: [nature, history, fun, urban, trend, 各 TAG_MAPPING 類別的 0/1 位元]
+    偏好向量與此矩陣做一次矩陣乘法即可得到所有景點的分數
+    cards: 推薦結果欄位的 numpy 陣列 (Arrow 字串欄位每次 take 前幾名也要數毫秒，這裡只轉換一次)
+    """
+    n = len(df)
+    attrs = {}
+    for col in SCORE_ATTRS:
+        if col in df.columns:
+            attrs[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.0).to_numpy(dtype=np.float64)
+        else:
+            attrs[col] = np.zeros(n, dtype=np.float64)
+
+    # 標籤位元矩陣 (n x 類別數)
+    categories = TAG_CATEGORIES
+    cat_index = {c: j for j, c in enumerate(categories)}
+    tag_bits = np.zeros((n, len(categories)), dtype=np.float64)
+    if 'tag_mask' in df.columns:
+        masks = df['tag_mask'].to_numpy(dtype=np.int64)
+        tag_bits[:] = (masks[:, None] >> np.arange(len(categories))) & 1
+    elif 'mapped_tags' in df.columns:
+        for i, tags in enumerate(df['mapped_tags']):
+            for t in tags:
+                j = cat_index.get(t)
+                if j is not None: tag_bits[i, j] = 1.0
+
+    trend_cols = [cat_index[t] for t in TREND_TAGS]
+    # column-major：只有十幾欄，features @ weights 逐欄連續讀取比逐列快約 3 倍
+    features = np.empty((n, 5 + len(categories)), dtype=np.float64, order='F')
+    features[:, 0] = attrs['nature']
+    features[:, 1] = attrs['culture']
+    features[:, 2] = (attrs['entertainment'] + attrs['activity']) / 2  # 玩樂/親子
+    features[:, 3] = (attrs['food'] + attrs['entertainment']) / 2       # 都市/美食
+    features[:, 4] = tag_bits[:, trend_cols].max(axis=1) if n else 0.0  # 新潮流
+    features[:, 5:] = tag_bits
+    cards = {c: df[c].to_numpy(dtype=object if df[c].dtype == object or pd.api.types.is_string_dtype(df[c]) else None)
+             for c in RECOMMENDATION_COLUMNS if c in df.columns}
+    return ScoreMatrix(features, categories, cards)
+
+@st.cache_resource
+def load_score_matrix():
+    """快取景點資料庫的評分矩陣 (與 load_data() 的列順序相同)"""
+    return build_score_matrix(load_data())
+
+def build_preference_vector(user_prefs, specific_tags, categories):
+    """將使用者偏好轉為與評分矩陣欄位對應的權重向量"""
+    weights = np.zeros(5 + len(categories), dtype=np.float64)
+    weights[0] = user_prefs.get('nature', 0.5)
+    weights[1] = user_prefs.get('history', 0.5)
+    weights[2] = user_prefs.get('fun', 0.5)
+    weights[3] = user_prefs.get('urban', 0.5)
+    weights[4] = user_prefs.get('trend', 0.5)
+    for t in specific_tags or []:
+        if t in categories:
+            weights[5 + categories.index(t)] += SPECIFIC_TAG_BONUS
+    return weights
+
+def score_rows(features, weights):
+    """features @ weights，四捨五入到 1e-9：相加順序 (記憶體配置) 不同造成的誤差不會打破同分"""
+    return np.round(features @ weights, 9)
+
+def top_k_indices(scores, k):
+    """取分數最高的 k 個位置 (部分選取，不做全排序；同分依原順序)"""
+    n = len(scores)
+    if k >= n:
+        candidates = np.arange(n)
     else:
-        df['similarity'] = 0
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        # 邊界同分時補齊，維持與穩定排序相同的結果
+        kth = scores[candidates].min()
+        ties = np.flatnonzero(scores == kth)
+        candidates = np.union1d(candidates[scores[candidates] > kth], ties)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order][:k]
 
-    # 依照分數排序
+def calculate_recommendations(df, user_prefs, specific_tags=[], days=1, matrix=None):
+    """
+    計算推薦景點
+    matrix: build_score_matrix(df) 的結果，未提供時即時建立
+    """
+    if df.empty: return None
+
+    if matrix is None or len(matrix.features) != len(df):
+        matrix = build_score_matrix(df)
+
+    # 1. 一次矩陣乘法算出所有景點分數
+    weights = build_preference_vector(user_prefs, specific_tags, matrix.categories)
+    scores = score_rows(matrix.features, weights)
+
+    # 2. 只挑出前 rec_limit 名
     rec_limit = max(10, days * 6) # 動態限制數量
-    recommendations = df.sort_values(by='similarity', ascending=False).head(rec_limit)
+    top = top_k_indices(scores, rec_limit)
+
+    # 正規化分數 (最高分必定在 top 內)
+    top_scores = scores[top].astype(float)
+    max_score = float(top_scores[0]) if len(top) else 0.0
+    similarity = top_scores / max_score if max_score > 0 else np.zeros(len(top))
+
+    # 只取前幾名的卡片欄位 (不複製整份資料的其他欄位)
+    columns = {c: values[top] for c, values in matrix.cards.items()}
+    columns.update(score=top_scores, similarity=similarity)
+    return pd.DataFrame(columns, index=df.index[top])
+
+def compact_recommendations(recommendations):
+    """
+    將推薦結果壓縮為 [景點 id, 分數] 列表以便儲存
+    (景點其他欄位可由 expand_recommendations 從資料庫還原)
+    """
+    if recommendations is None or recommendations.empty: return None
+    if 'id' not in recommendations.columns or 'score' not in recommendations.columns:
+        return recommendations.to_dict('records')
+    return [[int(i), float(s)] for i, s in zip(recommendations['id'], recommendations['score'])]
+
+def expand_recommendations(rec_data, catalog):
+    """
+    還原儲存的推薦結果：[id, 分數] 依原順序與景點資料庫 (load_data()) 合併
+    舊版存檔 (完整欄位的 records) 直接轉回 DataFrame；已不在資料庫中的景點會被略過
+    """
+    if not rec_data: return None
+    if isinstance(rec_data[0], dict): return pd.DataFrame(rec_data)
+    if catalog is None or catalog.empty: return None
+
+    pairs = pd.DataFrame(rec_data, columns=['id', 'score'])
+    base = catalog[[c for c in RECOMMENDATION_COLUMNS if c in catalog.columns]]
+    recommendations = pairs.merge(base, on='id', how='inner', sort=False)
+    if recommendations.empty: return None
+    recommendations = recommendations[list(base.columns) + ['score']]
+
+    max_score = recommendations['score'].max()
+    recommendations['similarity'] = recommendations['score'] / max_score if max_score > 0 else 0
     return recommendations
 
-def get_static_map_image(itinerary_data, api_key):
-    """取得 Google Static Maps 圖片"""
-    if not api_key: return None
-    base_url = "https://maps.googleapis.com/maps/api/staticmap?"
-    markers_str = ""
-    # 只取前 15 個點以免 URL 過長
-    for item in itinerary_data[:15]: 
-        # 注意：這裡假設 itinerary_data 裡面還沒有自動填入 lat/lon，
-        # 如果未來有加入，可以直接用。目前是用名稱去猜或忽略。
-        pass
-        
-    # 範例回傳 None (因需要重寫完整座標邏輯)
-    return None
+# --- 搜尋結果分頁 ---
+def preference_scores(user_prefs, rows=None, specific_tags=(), matrix=None):
+    """景點資料庫 (load_data() 列順序) 中指定列的偏好分數"""
+    matrix = matrix if matrix is not None else load_score_matrix()
+    weights = build_preference_vector(user_prefs, list(specific_tags), matrix.categories)
+    if rows is None: return score_rows(matrix.features, weights)
+    rows = np.asarray(rows)
+    # features 為 column-major，取大量列時整份計算後再取比較快
+    if len(rows) * 8 > len(matrix.features): return score_rows(matrix.features, weights)[rows]
+    return score_rows(matrix.features[rows], weights)
+
+def result_page(df, positions, page, page_size):
+    """回傳 (該頁的 DataFrame, 修正後的頁碼, 總頁數)；只取出該頁的列"""
+    n_pages = max(1, -(-len(positions) // page_size))
+    page = min(max(0, page), n_pages - 1)
+    return df.iloc[positions[page * page_size:(page + 1) * page_size]], page, n_pages
+
+@st.cache_resource
+def get_tile_fetcher():
+    """
+    靜態地圖的圖磚來源 + 磁碟快取 (跨 session 共用)
+    預設下載 OpenStreetMap 圖磚；環境變數 TILE_URL 可改用其他圖磚伺服器 (例如本機)，
+    TILE_DIR 可改用事先下載好的圖磚資料夾 (完全離線)
+    """
+    tile_dir = os.environ.get("TILE_DIR")
+    source = DirectoryTileSource(tile_dir) if tile_dir else HttpTileSource(os.environ.get("TILE_URL", DEFAULT_TILE_URL))
+    return TileFetcher(source, TileCache())
+
+def get_static_map_image(itinerary_data, size=MAP_SIZE, fetcher=None):
+    """行程地圖 PNG (每天的路線 + 依順序編號的標記)；沒有任何座標時回傳 None"""
+    return render_static_map(list(itinerary_data), fetcher or get_tile_fetcher(), size)
 
 def create_txt(itinerary, trip_name, total_budget):
     """
@@ -205,46 +477,94 @@ def create_txt(itinerary, trip_name, total_budget):
     
     return "\n".join(lines).encode('utf-8')
 
-@st.cache_data
-def get_coordinates(address):
+@st.cache_resource
+def get_geolocator():
+    """共用的 Nominatim 客戶端 (不必每次查詢都重新建立)"""
+    return Nominatim(user_agent="kaohsiung_travel_planner_app_v1")
+
+@st.cache_resource
+def get_geocode_cache():
+    """持久化的地理編碼快取 (SQLite，重新啟動後仍保留)"""
+    return GeocodeCache()
+
+@st.cache_resource
+def load_gazetteer():
+    """由景點與夜市資料建立的離線地名索引"""
+    return Gazetteer.from_frames(load_data(), load_night_markets())
+
+def geocode_queries(address):
     """
-    使用 OpenStreetMap (Nominatim) 將地址轉換為經緯度
-    具備自動降級搜尋功能 (完整地址 -> 路名 -> 失敗)
+    產生依優先順序排列的查詢字串 (完整地址 -> 路名)
     """
-    try:
-        geolocator = Nominatim(user_agent="kaohsiung_travel_planner_app_v1")
+    # Helper to ensure region context
+    def format_addr(addr):
+        # 強制加上台灣，避免搜尋到中國同名地點
+        prefix = ""
+        if "台灣" not in addr and "臺灣" not in addr:
+            prefix += "台灣"
+        if "高雄" not in addr:
+            prefix += "高雄市"
         
-        # Helper to ensure region context
-        def format_addr(addr):
-            # 強制加上台灣，避免搜尋到中國同名地點
-            prefix = ""
-            if "台灣" not in addr and "臺灣" not in addr:
-                prefix += "台灣"
-            if "高雄" not in addr:
-                prefix += "高雄市"
-            
-            return f"{prefix}{addr}" if prefix else addr
+        return f"{prefix}{addr}" if prefix else addr
 
-        # 1. 嘗試完整地址
-        targets = [address]
+    # 1. 嘗試完整地址
+    targets = [address]
+    
+    # 2. 嘗試去除門牌號碼 (簡易正則：去除數字+號)
+    road_only = re.sub(r'\d+號?', '', address).strip()
+    if road_only and road_only != address:
+        targets.append(road_only)
         
-        # 2. 嘗試去除門牌號碼 (簡易正則：去除數字+號)
-        import re
-        road_only = re.sub(r'\d+號?', '', address).strip()
-        if road_only and road_only != address:
-            targets.append(road_only)
-            
-        # 3. 嘗試去除 "高雄市" 等前綴後的關鍵字
-        # simple_name = address.replace("高雄市", "").replace("台灣", "")
-        # targets.append(simple_name)
-
-        for target in targets:
-            full_query = format_addr(target)
-            location = geolocator.geocode(full_query, timeout=10)
-            if location:
-                return location.latitude, location.longitude
-                
-        return None
+    # 3. 嘗試去除 "高雄市" 等前綴後的關鍵字
+    # simple_name = address.replace("高雄市", "").replace("台灣", "")
+    # targets.append(simple_name)
+
+    return [format_addr(t) for t in targets]
+
+def geocode_address(address, geolocator=None, deadline=GEOCODE_DEADLINE):
+    """
+    使用 OpenStreetMap (Nominatim) 將地址轉換為經緯度 (不經快取)
+    具備自動降級搜尋功能：完整地址與路名同時查詢，優先採用完整地址的結果
+    網路錯誤或超過期限時拋出例外，查無結果回傳 None
+    """
+    geolocator = geolocator or get_geolocator()
+
+    def lookup(query, timeout):
+        location = geolocator.geocode(query, timeout=timeout)
+        return (location.latitude, location.longitude) if location else None
+
+    return geocode_candidates(geocode_queries(address), lookup, deadline=deadline)
+
+@st.cache_data
+def lookup_coordinates(address):
+    """
+    將地址轉換為經緯度 (精確位置)
+    1. 先查離線地名索引 (景點名稱、行政區、路名)
+    2. 再查持久化快取 (含查無結果的記錄)，未命中才呼叫 Nominatim 並寫回快取
+    查無結果回傳 None；網路錯誤時拋出例外 (不寫入任何快取，下次重試)
+    """
+    coords = load_gazetteer().lookup(address)
+    if coords: return coords
+
+    cache = get_geocode_cache()
+    hit, coords = cache.get(address)
+    if not hit:
+        coords = geocode_address(address)
+        cache.put(address, coords)
+    return coords
+
+def get_coordinates(address):
+    """
+    回傳 (座標, 是否為概略位置)
+    - 確定查無結果時為 (None, False)
+    - 離線或逾時才退回地址中行政區/路名的概略位置 (不經 st.cache_data 快取，網路恢復後會重新查詢)
+    """
+    try:
+        return lookup_coordinates(address), False
+    except (GeocoderTimedOut, GeocoderUnavailable, TimeoutError, OSError) as e:
+        print(f"Geocoding unavailable, using approximate location: {e}")
+        coords = load_gazetteer().approximate(address)
+        return coords, coords is not None
     except Exception as e:
         print(f"Geocoding error: {e}")
-        return None
+        return None, False